@@ -23,7 +23,6 @@ sys.path.pop(0)
 # Append neatseq_flow path to list (when using installed version, will find it before getting to this search path)
 # Problem that might arrise: When trying to run a local copy when it is installed in site-packages/
 sys.path.append(os.path.realpath(os.path.expanduser(os.path.dirname(os.path.abspath(__file__))+os.sep+"..")))
-from neatseq_flow.PLC_main import NeatSeqFlow
 
 # Parse arguments:
 parser = argparse.ArgumentParser(description="""
@@ -49,6 +48,19 @@ parser.add_argument("--clean-all", help="Remove all old workflow directories", a
 parser.add_argument("-V", "--verbose", help="Print admonitions?", action='store_true')
 parser.add_argument("-v", "--version", help="Print version and exit.", action='store_true')
 parser.add_argument("--list_modules", help="List modules available in modules_paths.", action='store_true')
+parser.add_argument("-j", "--jobs", help="Number of steps to build in parallel. 0 for the number of CPUs. Default: 1",
+                    type=int, default=1)
+parser.add_argument("--incremental", help="Rebuild only steps which changed since the previous run with the same "
+                                          "run ID (e.g. with '-r curr'). Other steps' scripts are left as they are.",
+                    action='store_true')
+parser.add_argument("--profile", help="Record the time and memory used by each phase of building the workflow and by "
+                                      "each step. The report is written to objects/profile.json",
+                    action='store_true')
+parser.add_argument("--compact_json", help="Write the JSON files in objects/ without indentation",
+                    action='store_true')
+parser.add_argument("--no_param_cache", help="Parse the parameter files without using or updating the cache of "
+                                             "parsed parameter files",
+                    action='store_true')
 
 args = parser.parse_args()
 
@@ -93,6 +105,8 @@ if args.sample_file is None or args.param_file is None:
 # Converting list of parameter files into comma-separated list. This is deciphered by the neatseq_flow class.
 args.param_file = ",".join(args.param_file)
 
+# Imported only when needed, so that --help and --version do not load the whole package
+from neatseq_flow.PLC_main import NeatSeqFlow
 
 NeatSeqFlow(sample_file   = args.sample_file,
             param_file    = args.param_file,
@@ -101,4 +115,9 @@ NeatSeqFlow(sample_file   = args.sample_file,
             message       = args.message,
             runid         = args.runid,
             verbose       = args.verbose,
-            list_modules  = args.list_modules)
+            list_modules  = args.list_modules,
+            build_jobs    = args.jobs,
+            incremental   = args.incremental,
+            profile       = args.profile,
+            compact_json  = args.compact_json,
+            param_cache   = not args.no_param_cache)
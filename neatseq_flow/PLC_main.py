@@ -23,6 +23,13 @@ from collections import OrderedDict
 
 from .modules.parse_sample_data import parse_sample_file,parse_grouping_file
 from .modules.parse_param_data import parse_param_file
+from .modules.step_graph import StepGraph
+from .modules.layered_sample_data import json_default
+from .modules.sample_data_store import SampleDataStore, DEFAULT_CACHE_SIZE
+from .modules.generation_writer import GenerationWriter
+from .modules.module_index import ModuleIndex
+from .modules.profiler import Profiler, PROFILE_FILENAME
+from .modules.workflow_json import WorkflowJSONWriter
 
 from .PLC_step import Step, AssertionExcept
 
@@ -39,12 +46,27 @@ class NeatSeqFlow(object):
                  message = None,
                  runid = None,
                  verbose = False,
-                 list_modules = False):
+                 list_modules = False,
+                 build_jobs = 1,
+                 incremental = False,
+                 profile = False,
+                 compact_json = False,
+                 param_cache = True):
         """
         Initialize and create all workflow scripts.
         :returns: A workflow object
         """
+        # Number of steps to build in parallel (see build_scripts()). 0 or None for the number of CPUs:
+        self.build_jobs = build_jobs
+        # Index lines and dirs collected while building the steps' scripts. Written when building is done
+        self.generation_writer = GenerationWriter()
+        # Time and memory used by each phase and step. Written to objects/profile.json with --profile
+        self.profiler = Profiler(enabled=profile)
+        # Write the JSON files without indentation (see write_json_files())
+        self.compact_json = compact_json
+
         # Read and parse the sample and parameter files:
+        self.profiler.start_phase("read_files")
 
         sys.stdout.write("Reading files...\n")
         sys.stdout.flush()
@@ -58,7 +80,8 @@ class NeatSeqFlow(object):
             raise
 
         try:
-            self.param_data = parse_param_file(param_file)
+            # The parsed parameter files are cached, unless param_cache is False (see parse_param_file())
+            self.param_data = parse_param_file(param_file, use_cache=param_cache)
 
         except Exception as raisedex:
             
@@ -125,6 +148,7 @@ class NeatSeqFlow(object):
 
         sys.stdout.write("Preparing objects...\n")
         sys.stdout.flush()
+        self.profiler.start_phase("prepare")
 
         # Prepare dictionary for pipe data
         self.pipe_data = dict()
@@ -189,6 +213,12 @@ class NeatSeqFlow(object):
             self.pipe_data["Default_wait"] = self.param_data["Global"]["Default_wait"]
         if "job_limit" in list(self.param_data["Global"].keys()):
             self.pipe_data["job_limit"] = self.param_data["Global"]["job_limit"]
+        if "submit_pacing" in list(self.param_data["Global"].keys()):
+            self.pipe_data["submit_pacing"] = self.param_data["Global"]["submit_pacing"]
+        if "sample_data_store" in list(self.param_data["Global"].keys()):
+            self.pipe_data["sample_data_store"] = self.param_data["Global"]["sample_data_store"]
+        if "array_jobs" in list(self.param_data["Global"].keys()):
+            self.pipe_data["array_jobs"] = self.param_data["Global"]["array_jobs"]
 
         self.manage_qsub_params()
 
@@ -222,11 +252,27 @@ class NeatSeqFlow(object):
         # Create script execution script:
         self.create_script_execution_script()
 
+        # Create script for running the workflow with a scheduler, if the executor has one:
+        self.create_scheduler_script()
+
+        # Create script for re-executing the failed jobs:
+        self.create_recovery_script()
+
         # Create file md5sum registration file:
         self.create_registration_file()
         
         # Backup parameter and sample files:
         self.backup_source_files(param_file, sample_file)
+
+        # With incremental, steps unchanged since the previous run are not rebuilt (see build_scripts()).
+        # Otherwise, the cache of the previous run is removed, since the scripts are rebuilt.
+        # (Modules used only when building scripts are imported where used, so that listing modules is fast.)
+        from .modules.build_cache import BuildCache
+        if incremental:
+            self.build_cache = BuildCache(self)
+        else:
+            self.build_cache = None
+            BuildCache.remove(self.pipe_data)
         
         # Make the directory for the step-wise kill scripts (must be done before make_step_instances()
         # because the steps need to know the directory):
@@ -238,6 +284,7 @@ class NeatSeqFlow(object):
         # Create step instances:
         sys.stdout.write("Making step instances...\n")
         sys.stdout.flush()
+        self.profiler.start_phase("make_step_instances")
         self.make_step_instances()
 
         # Create a dictionary for storing all step sample data
@@ -257,19 +304,21 @@ class NeatSeqFlow(object):
         # Do the actual script building:
         # Also, catching assetion exceptions raised by class build_scripts() and 
         sys.stdout.write("Building scripts...\n")
+        self.profiler.start_phase("build_scripts")
         try:
             self.build_scripts()
             
         except AssertionExcept as assertErr:
             print(assertErr.get_error_str())
             print("An error has occurred. See comment above.\nPrinting current JSON and exiting\n")
-            with open(self.pipe_data["objects_dir"]+"WorkflowData.json", "w") as json_fh:
-                json_fh.write(self.get_json_encoding())
+            self.write_json_files(qsub_names=False)
             # sys.exit()
             self.cleanup()
+            self.write_profile()
             return
 
         # Make main script:
+        self.profiler.start_phase("main_scripts")
         self.make_main_pipeline_script()
 
         # Make main scripts for tags:
@@ -283,21 +332,23 @@ class NeatSeqFlow(object):
 
         # Make js graphical representation (maybe add parameter to not include this feature?)
         sys.stdout.write("Making workflow plots...\n")
+        self.profiler.start_phase("plots")
         self.create_js_graphic()
         self.create_diagrammer_graphic()
         
         # Writing JSON encoding ofg pipeline:
         sys.stdout.write("Writing JSON files...\n")
-        with open(self.pipe_data["objects_dir"]+"WorkflowData.json", "w") as json_fh:
-            json_fh.write(self.get_json_encoding())
-        # Writing JSON encoding of qsub names (can be used by remote progress monitor)
-        with open(self.pipe_data["objects_dir"]+"qsub_names.json", "w") as json_fh:
-            json_fh.write(self.get_qsub_names_json_encoding())
+        self.profiler.start_phase("json")
+        self.write_json_files()
 
         # Step cleanup
+        self.profiler.start_phase("cleanup")
         [step_n.cleanup() for step_n in self.step_list]
+        self.close_sample_data_store()
         
         self.create_log_plotter()
+
+        self.write_profile()
         
         sys.stderr.flush()
         sys.stdout.flush()
@@ -358,30 +409,91 @@ class NeatSeqFlow(object):
         
     def build_scripts(self):
         """ Run the actual script building
+            If more than one build job is requested, steps whose bases are built are built in parallel.
+            See modules/parallel_build.py
+            The index files and sample dirs are written when building is done (see modules/generation_writer.py)
+            When building incrementally, steps which are unchanged since the previous run are not rebuilt (see
+            modules/build_cache.py)
         """
 
-        # For each step name (step_n), set sample_data based on the steps base(s) and then create scripts
-        for step_n in self.step_list:
-           
-            # step_name = step_n.get_step_name()
-            # step_step = step_n.get_step_step()
-
-            # Find base step(s) for current step: (If does not exist return None)
-            base_name_list = step_n.get_base_step_name()    
-
-            # For merge, 1st step, this will be true, passing the original sample_data to the step:
-            if base_name_list is None:
-                step_n.set_sample_data(self.sample_data)
-                step_n.set_base_step([])
-            # For the others, finds the instance(s) of the base step(s) and
-            # calls set_base_step() with the list of bases:
-            else:
-                # Note: set_base_step() takes a list of step objects, not names.
-                # Finding them is done by the .index() method.
-                step_n.set_base_step([self.step_list[self.step_list_index.index(base_name)] for base_name in base_name_list])
+        from .modules.parallel_build import ParallelStepBuilder, can_fork, get_build_jobs
+
+        try:
+            build_jobs = get_build_jobs(self.build_jobs)
+            if build_jobs > 1 and can_fork():
+                ParallelStepBuilder(self, build_jobs).run()
+                return
 
-            # Do the actual script building for step_n
-            step_n.create_all_scripts()
+            # For each step name (step_n), set sample_data based on the steps base(s) and then create scripts
+            for step_n in self.step_list:
+
+                with self.profiler.measure_step(step_n, "build"):
+                    self.set_step_base_data(step_n)
+
+                    if self.restore_cached_step(step_n):
+                        self.profiler.set_step_status(step_n, "cached")
+                    else:
+                        if step_n.skip_scripts:
+                            self.profiler.set_step_status(step_n, "skipped")
+                        # Do the actual script building for step_n
+                        step_n.create_step_scripts()
+
+                with self.profiler.measure_step(step_n, "register"):
+                    step_n.register_step_scripts()
+        finally:
+            # Write the index files and make the dirs of the steps registered so far
+            self.generation_writer.flush()
+            if self.build_cache is not None:
+                self.build_cache.save()
+                sys.stdout.write("Reused the scripts of {reused} of {total} steps\n".
+                                 format(reused=len(self.build_cache.restored), total=len(self.step_list)))
+
+    def write_profile(self):
+        """ With --profile, writes the time and memory used by each phase and step to objects/profile.json
+            (see modules/profiler.py)
+        """
+
+        self.profiler.write_report(self.pipe_data["objects_dir"] + PROFILE_FILENAME,
+                                   run_code=self.run_code,
+                                   executor=self.pipe_data["Executor"],
+                                   samples=len(self.sample_data["samples"]),
+                                   steps=len(self.step_list),
+                                   build_jobs=self.build_jobs,
+                                   incremental=self.build_cache is not None)
+
+    def restore_cached_step(self, step_n):
+        """ When building incrementally, returns True if step_n is unchanged since the previous run, setting its state
+            from the build cache. Otherwise, step_n's scripts from the previous run are emptied and False is returned.
+            The base data of step_n must be set.
+        """
+
+        if self.build_cache is None:
+            return False
+        if self.build_cache.restore_step(step_n):
+            return True
+        step_n.restart_scripts()
+        return False
+
+    def set_step_base_data(self, step_n):
+        """ Set the base steps and sample_data of step_n. The bases must already be built.
+        """
+           
+        # step_name = step_n.get_step_name()
+        # step_step = step_n.get_step_step()
+
+        # Find base step(s) for current step: (If does not exist return None)
+        base_name_list = step_n.get_base_step_name()    
+
+        # For merge, 1st step, this will be true, passing the original sample_data to the step:
+        if base_name_list is None:
+            step_n.set_sample_data(self.sample_data)
+            step_n.set_base_step([])
+        # For the others, finds the instance(s) of the base step(s) and
+        # calls set_base_step() with the list of bases:
+        else:
+            # Note: set_base_step() takes a list of step objects, not names.
+            # Finding them is done by the .index() method.
+            step_n.set_base_step([self.step_list[self.step_list_index.index(base_name)] for base_name in base_name_list])
 
     def make_depends_dict(self):
         """ Creates and returns the basic depend_dict structure
@@ -397,33 +509,21 @@ class NeatSeqFlow(object):
     def expand_depends(self):
         """ Extract base info for each step from parameters and expand the dependency info
             i.e. if base(samtools)=['Bowtie_mapper'], expand it to ['merge','Bowtie_mapper']
+            The expansion is done on an integer-indexed StepGraph, which is kept in self.step_graph
+            and used for sorting the steps (see sort_step_list())
         """
         step_data = self.get_step_param_data()
         # Get the base list for each step.
         self.make_depends_dict()
 
-        # Convert from dict of lists to dict of sets:
-        depend_dict = {key:set(value) for key,value in self.depend_dict.items()}
-        new_depend_dict = deepcopy(depend_dict)
-
-        while True:
-            temp_dd = deepcopy(new_depend_dict)
-            for key in list(temp_dd.keys()):
-                for substep in temp_dd[key]:
-                    if substep:
-                        new_depend_dict[key] = new_depend_dict[key] | (temp_dd[substep] - set([""]))
-            if all([temp_dd[x] == new_depend_dict[x] for x in list(new_depend_dict.keys())]):
-                break
-        new_depend_dict = {key:list(value) if value!={''} else list()
-                           for key,value
-                           in new_depend_dict.items()}
-
-        looping_steps = [k for k,v in new_depend_dict.items() if k in v]
+        self.step_graph = StepGraph(self.depend_dict)
+
+        looping_steps = [name for cycle in self.step_graph.find_cycles() for name in cycle]
         if looping_steps:
             sys.exit("There seems to be a cycle in the workflow design. "
                      "Check dependencies of steps: {offenders}".format(offenders=", ".join(looping_steps)))
 
-        self.depend_dict = new_depend_dict
+        self.depend_dict = self.step_graph.get_closure()
 
         # Store dependencies in param structure:
         for step in step_data:
@@ -434,19 +534,23 @@ class NeatSeqFlow(object):
 
     def sort_step_list(self):
         """ This function sorts the step list
-            By default uses the list.sort function on the step list, which sorts the steps by level, i.e. all direct merge dependents first, then their dependents, etc.
+            By default uses the topological order of self.step_graph, which sorts the steps by level,
+            i.e. all direct merge dependents first, then their dependents, etc.
             A different sorting scheme can be added here for depth-wise sorting, for instance.
         """
-        
-        self.step_list.sort()    # Sort by internal __lt__ and __gt__
+
+        step_order = {name: position for position, name in enumerate(self.step_graph.topological_order())}
+        self.step_list.sort(key=lambda step_n: step_order[step_n.get_step_name()])
         
     def make_step_instances(self):
         """ Makes step instances and stores them in self.step_list.
-            The steps are also sorted based on their dependencies. See __lt__ and __gt__ in "Step" class definition.
+            The steps are also sorted based on their dependencies. See sort_step_list()
         """
         # The list of steps is created using a helper function, make_step_type_instance.
         # See definition of make_step_type_instance to see how step type is determined and imported...
         self.step_list = [self.make_step_type_instance(step_n) for step_n in self.get_step_names()]
+        # Save the module paths walked while finding the step modules
+        ModuleIndex.get_index().save()
 
         self.sort_step_list()
 
@@ -784,6 +888,12 @@ Timestamp\tEvent\tModule\tInstance\tJob name\tLevel\tHost\tJob ID\tMax mem\tStat
         self.pipe_data["run_index"] = "".join([self.pipe_data["objects_dir"], "run_index" ,  ".txt"])
         # Clearing file:
         open(self.pipe_data["run_index"], "w").close()
+        # Clearing the job state files kept with run_index (see get_helper_script() in scriptconstructorLocal):
+        shutil.rmtree(self.pipe_data["run_index"] + ".state", ignore_errors=True)
+        # Clearing the journal of job states, the rotated journal and the offsets (see run_journal.py):
+        for suffix in [".journal", ".journal.1", ".journal.offset"]:
+            if os.path.isfile(self.pipe_data["run_index"] + suffix):
+                os.remove(self.pipe_data["run_index"] + suffix)
 
         # Set depend_index filename in pipe_data
         self.pipe_data["depend_index"] = "".join([self.pipe_data["objects_dir"], "depend_index", ".txt"])
@@ -840,8 +950,19 @@ Date\tStep\tName\tScript\tFile\tmd5sum\n
         return json.dumps(self.get_dict_encoding(), 
                             sort_keys = False, 
                             indent = 4, 
-                            separators=(',', ': '))
+                            separators=(',', ': '),
+                            default=json_default)
         
+    def write_json_files(self, qsub_names=True):
+        """ Writes WorkflowData.json, as an index and a shard per step (see modules/workflow_json.py), and
+            qsub_names.json
+        """
+
+        json_writer = WorkflowJSONWriter(self.pipe_data["objects_dir"], compact=self.compact_json)
+        json_writer.write_workflow(self)
+        if qsub_names:
+            json_writer.write_qsub_names(self)
+
     def get_qsub_names_json_encoding(self):
         """ Convert qsub names dict into JSON format
         """
@@ -1138,13 +1259,14 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
     def find_modules(self):
         """ Searches all module repositories for a list of possible modules
             Meant to be used by the GUI generator for supplying the user with a list of modules he can include
+            Returns a dictionary, where module name is the key and the value is a list of dirs in which the module exists.
         """
-        
-        if "module_path" in self.param_data["Global"]:
-            module_paths = self.param_data["Global"]["module_path"]
-            
+
+        module_paths = list(self.param_data["Global"].get("module_path", list()))
         module_paths.append(os.path.dirname(os.path.abspath(__file__)))
 
+        module_index = ModuleIndex.get_index()
+        module_list = dict()
         for module_path_raw in module_paths:#.split(" "):
             # Remove trainling '/' from dir name. For some reason that botches things up!
             module_path = module_path_raw.rstrip(os.sep)
@@ -1158,26 +1280,11 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
                 
                 continue
 
-            def walkerr(err):
-                """ Helper function for os.walk below. Catches errors during walking and reports on them.
-                """
-                print("WARNING: Error while searching for modules:")
-                print(err)
-
-            # module_list is a dictionary, where module name is the key and the value is a list of dirs in which the
-            # module exists.
-            module_list = dict()
-            dir_generator = os.walk(module_path, onerror = walkerr)
-            # Each .next call on this generator returns a level tuple as follows:
-            for level in dir_generator:
-                # Repeat while expected filename is NOT in current dir contents (=level[2]. see above)
-                for file in [file for file in level[2] if re.match(".*\.py$",file)]:
-                    with open(level[0] + os.sep + file,"r") as pyt_fh:
-                        if re.search("class Step_%s"%file.strip(".py"),pyt_fh.read()):
-                            if file.strip(".py") not in module_list:
-                                module_list[file.strip(".py")] = list()
-                            module_list[file.strip(".py")].append(level[0].split(os.sep)[-1])
-            return module_list
+            for module, dir_list in module_index.list_modules(module_path).items():
+                module_list.setdefault(module, list()).extend(dir_list)
+        module_index.save()
+
+        return module_list
 
     def add_step(self, step_name, step_params):
         """ Add a step to an existing main neatseq-flow class
@@ -1226,8 +1333,7 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
         except AssertionExcept as assertErr:
             print(assertErr.get_error_str())
             print("An error has occurred. See comment above.\nPrinting current JSON and exiting\n")
-            with open(self.pipe_data["objects_dir"]+"WorkflowData.json", "w") as json_fh:
-                json_fh.write(self.get_json_encoding())
+            self.write_json_files(qsub_names=False)
             # sys.exit()
             self.cleanup()
             return
@@ -1245,11 +1351,7 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
         
         # Writing JSON encoding ofg pipeline:
         sys.stdout.write("Writing JSON files...\n")
-        with open(self.pipe_data["objects_dir"]+"WorkflowData.json", "w") as json_fh:
-            json_fh.write(self.get_json_encoding())
-        # Writing JSON encoding of qsub names (can be used by remote progress monitor)
-        with open(self.pipe_data["objects_dir"]+"qsub_names.json", "w") as json_fh:
-            json_fh.write(self.get_qsub_names_json_encoding())
+        self.write_json_files()
 
         # self.create_log_plotter()
         
@@ -1284,6 +1386,36 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
             print("Make sure the script constructor defines class method 'get_helper_script()'")
             raise
 
+    def create_scheduler_script(self):
+        """ Create 00.workflow.scheduler.sh, for running the workflow with the executor's scheduler.
+            Only for executors whose script constructor defines 'get_scheduler_script()' (i.e. Local)
+        """
+
+        modname = "neatseq_flow.script_constructors.scriptconstructor{executor}".format(
+            executor=self.pipe_data["Executor"])
+        classname = "ScriptConstructor{executor}".format(executor=self.pipe_data["Executor"])
+
+        try:
+            scriptclass = getattr(importlib.import_module(modname), classname)
+            scheduler_script = scriptclass.get_scheduler_script(self.pipe_data)
+        except AttributeError:
+            return
+
+        with open(self.pipe_data["scripts_dir"] + "00.workflow.scheduler.sh", "w") as script_fh:
+            script_fh.write(scheduler_script)
+
+    def create_recovery_script(self):
+        """ Create 00.workflow.recover.sh, for re-executing the jobs which failed and the jobs depending on them
+        """
+
+        modname = "neatseq_flow.script_constructors.scriptconstructor{executor}".format(
+            executor=self.pipe_data["Executor"])
+        classname = "ScriptConstructor{executor}".format(executor=self.pipe_data["Executor"])
+
+        scriptclass = getattr(importlib.import_module(modname), classname)
+        with open(self.pipe_data["scripts_dir"] + "00.workflow.recover.sh", "w") as script_fh:
+            script_fh.write(scriptclass.get_recovery_script(self.pipe_data))
+
     def create_run_index_cleaning_script(self):
         """
         """
@@ -1316,40 +1448,26 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
             # This happens when AssertionExeption is called from the step_specific_init function in modules
             # At this stage, steps have not yet been initialized.
             pass
+        self.close_sample_data_store()
 
     def check_cyclic_step_names(self):
         """ Check no names are prefixes of other names.
+            Names are compared after removing the final glob * (see Step.get_glob_name())
         """
 
-        def qsub_name_glob(qsubname1, qsubname2):
-            """ Helper function: Checks if name A is a prefix of name B, after removing final glob *
-                Returns True if A is prefix of B
-            """
-            # print "{i1} <---> {i2}".format(i1=qsubname1,i2=qsubname2)
-            return re.sub(pattern="\*.*$",
-                          repl="",
-                          string=qsubname2).startswith(re.sub(pattern="\*.*$",
-                                                              repl="",
-                                                              string=qsubname1))
+        glob_names = {instance.get_step_name(): re.sub(pattern="\*.*$",
+                                                       repl="",
+                                                       string=instance.get_glob_name())
+                      for instance
+                      in self.step_list}
 
         issues = False
-        for instance1 in self.step_list:
-            for instance2 in self.step_list:
-                # Don't test steps against themselves:
-                if instance1.get_step_name() == instance2.get_step_name():
-                    pass
-                else:
-                    glob_name_inst1 = instance1.get_glob_name()
-                    glob_name_inst2 = instance2.get_glob_name()
-
-                    if qsub_name_glob(glob_name_inst1,glob_name_inst2):
-                        print("* Instance '{inst1}' name is a prefix of instance '{inst2}' name, and both are from " \
-                              "the same module. This can cause cyclic dependencies! " \
-                              "Please modify '{inst1}' to avoid this.\n".format(inst1=instance1.get_step_name(),
-                                                                                inst2=instance2.get_step_name()))
-                        issues = True
-                    else:
-                        pass
+        for inst1, inst2 in StepGraph.find_prefix_collisions(glob_names):
+            print("* Instance '{inst1}' name is a prefix of instance '{inst2}' name, and both are from " \
+                  "the same module. This can cause cyclic dependencies! " \
+                  "Please modify '{inst1}' to avoid this.\n".format(inst1=inst1,
+                                                                    inst2=inst2))
+            issues = True
 
         if issues:
             sys.exit("Issues with instance names. See above")
@@ -1363,8 +1481,23 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
         :return:
         """
         self.global_sample_data = {step:{} for step in self.get_step_names()}
+
+        # Open an on-disk store for the sample data of completed steps, if requested:
+        if self.pipe_data.get("sample_data_store", "memory") == "sqlite":
+            self.sample_data_store = SampleDataStore(
+                "".join([self.pipe_data["objects_dir"], "sample_data_", self.pipe_data["run_code"], ".db"]),
+                cache_size=self.param_data["Global"].get("sample_data_cache", DEFAULT_CACHE_SIZE))
+        else:
+            self.sample_data_store = None
+
         return self.global_sample_data
 
+    def close_sample_data_store(self):
+        """ Close the sample data store, if one is used
+        """
+        if getattr(self, "sample_data_store", None) is not None:
+            self.sample_data_store.close()
+
     def create_rm_intermediate_script(self):
         """
         Create script 95.remove_intermediates.sh and add code for removal of interemediate files
@@ -17,6 +17,9 @@ import json
 from copy import *
 from pprint import pprint as pp
 from .modules.parse_param_data import manage_conda_params
+from .modules.layered_sample_data import LayeredSampleData, find_base_conflicts, get_raw_value, json_default
+from .modules.generation_writer import GenerationWriter
+from .modules.module_index import ModuleIndex
 
 __author__ = "Menachem Sklarz"
 __version__ = "1.6.0"
@@ -72,14 +75,11 @@ class Step(object):
     @classmethod
     def find_step_module(cls, step, param_data, pipe_data):
         """ A class method for finding the location of a module for a given step
+            Module paths are searched with the module index (see modules/module_index.py)
         """
 
-        def walkerr(err):
-            """ Helper function for os.walk below. Catches errors during walking and reports on them.
-            """
-            print("WARNING: Error while searching for modules:")
-            print(err)
-
+        module_index = ModuleIndex.get_index()
+        module_dir = None
         # Searching module paths passed by user in parameter file:
         if "module_path" in param_data["Global"]:
             for module_path_raw in param_data["Global"]["module_path"]:
@@ -95,75 +95,34 @@ class Step(object):
                     sys.stderr.write("WARNING: Path %s from module_path does not exist. Skipping...\n" % module_path)
                     continue
 
-                mod_t = step
-                dir_generator = os.walk(module_path, onerror = walkerr)
-                # Each .next call on this generator
-                # returns a level tuple as follows:
-                try:
-                    level = next(dir_generator)
-                    # level is a tuple with: (current dir. [list of dirs],[list of files])
-                except StopIteration:
-                    sys.stderr.write("WARNING: Module path {mod_path} seems to be empty! Possibly issue with "
-                                     "permissions...\n".format(mod_path=module_path))
-                while mod_t + ".py" not in level[2] or "__init__.py" not in level[2]:
-                    # Repeat while expected filename is NOT in current dir contents (=level[2]. see above)
-                    #   and while __init__.py is not in current dir (avoid finding modules in non-active dirs)
-                    try:
-                        level = next(dir_generator)    # Try getting another level    
-                    except StopIteration:
-                        # print "Step %s not found in path %s." % (mod_t,module_path)
-                        break # Leave while without executing "else"
-                else:
+                # Searching for the first dir containing the module file and __init__.py (avoid finding modules in
+                # non-active dirs)
+                module_dir = module_index.find_module(step, module_path)
+                if module_dir is not None:
                     # Adding module_path to search path
                     if module_path not in sys.path:
                         sys.path.append(os.path.abspath(module_path))
-                        # print ">>> ", sys.path
-                        
-                    # Backup module to backups dir:
-                    shutil.copyfile(level[0] + os.sep + mod_t + ".py", \
-                        "{bck_dir}{runcode}{ossep}{filename}".format(bck_dir = pipe_data["backups_dir"], \
-                                                                     runcode = pipe_data["run_code"], \
-                                                                     ossep = os.sep, \
-                                                                     filename = mod_t + ".py"))
-
-                    # For what this does, see below (# Build module name)...
-                    retval = (level[0].split(module_path)[1].partition(os.sep)[2].replace(os.sep,".") + "." + mod_t).lstrip(".")
-                    module_loc = level[0] + os.sep + mod_t + ".py"
-
-                    return retval, module_loc
-
+                    # Module name is the dir relative to the module path, with "." instead of os.sep
+                    retval = (module_dir.replace(os.sep, ".") + "." + step).lstrip(".")
+                    break
 
         # If not found, do the same with cls.Cwd:
-        mod_t = step
-        dir_generator = os.walk(cls.Cwd, onerror = walkerr)     # Each .next call on this generator returns a level tuple as follows:
-        try:
-            level = next(dir_generator)           # level is a tuple with: (current dir. [list of dirs],[list of files])
-        except StopIteration:
-            sys.stderr.write("WARNING: Module path %s seems to be empty! Possibly issue with permissions...\n" % self.Cwd)
+        if module_dir is None:
+            module_path = cls.Cwd
+            module_dir = module_index.find_module(step, module_path, require_init=False)
+            if module_dir is None:
+                sys.exit("Step %s not found in regular path or user defined paths." % step)
+            # Adding 'neatseq_flow' at begginning of module location.
+            retval = "neatseq_flow." + module_dir.replace(os.sep, ".") + "." + step
 
-        while(mod_t + ".py" not in level[2]):     # Repeat while expected filename is NOT in current dir contents (=level[2]. see above)
-            try:
-                level = next(dir_generator)    # Try getting another level    
-            except StopIteration:
-                sys.exit("Step %s not found in regular path or user defined paths." % mod_t)
-        
+        module_loc = os.path.normpath(os.path.join(module_path, module_dir, step + ".py"))
 
         # Backup module to backups dir:
-        shutil.copyfile(level[0] + os.sep + mod_t + ".py", \
+        shutil.copyfile(module_loc, \
                         "{bck_dir}{runcode}{ossep}{filename}".format(bck_dir = pipe_data["backups_dir"], \
                                                                      runcode = pipe_data["run_code"], \
                                                                      ossep = os.sep, \
-                                                                     filename = mod_t + ".py"))
-
-        # Build module name:
-        # 1. take dir found in search
-        # 2. split it by CWD and take 2nd part,  i.e. remove cwd from dir name...
-        # 3. partition by os.sep to remove leading os.sep
-        # 4. replace remaining os.sep's by ".".
-        # 5. Add .
-        # Adding 'neatseq_flow' at begginning of module location.
-        retval = "neatseq_flow."+level[0].split(cls.Cwd)[1].partition(os.sep)[2].replace(os.sep,".") + "." + mod_t
-        module_loc = level[0] + os.sep + mod_t + ".py"
+                                                                     filename = step + ".py"))
 
         return retval, module_loc
 
@@ -265,6 +224,11 @@ class Step(object):
         self.jid_list = []        # Initialize a list to store the list of jids of the current step
         self.glob_jid_list = []   # An experimental feature to enable shorter depend lists
 
+        # Immediate predecessor steps and their jids. Set when first requested (see get_dependency_step_list())
+        self.dependency_step_list = None
+        self.dependency_jid_list_memo = None
+        self.dependency_glob_jid_list_memo = None
+
         # The following line defines A list of jids from current step that all other steps should depend on.
         # Is used to add a prelimanry step, equivalent to the "wrapping up" step that is dependent on all previous
         # scripts
@@ -329,6 +293,18 @@ They are set automatically or module is not defined to use them""".format(parame
         
         # Create a list for filenames to register with md5sum for each script:
         self.stamped_files = list()
+        # Lines to add to the index files and dirs to make. Passed to the workflow's writer when the step's scripts are
+        # registered (see register_generation_writes())
+        self.generation_writer = GenerationWriter()
+        # Script constructor classes, by level (see import_ScriptConstructor())
+        self.script_constructor_classes = dict()
+        # Compiled low level script templates (see LowScriptConstructor.get_script_template())
+        self.script_templates = dict()
+        # Samples in each category level, by category (see get_category_index())
+        self.category_index = dict()
+        # The sample list the category index was built for, and its length
+        self.category_index_samples = None
+        self.category_index_length = 0
         # self.stamped_dirs = list()
 
         # Create a dictionary storing the step name and names of sub-scripts
@@ -336,6 +312,13 @@ They are set automatically or module is not defined to use them""".format(parame
         # used for remote run monitor
         self.qsub_names_dict = dict()
 
+        # Run the low level scripts as the tasks of a single array job (see add_array_task()). Can be set globally
+        # and overridden per step
+        self.array_jobs = bool(self.params.get("array_jobs", self.pipe_data.get("array_jobs", False)))
+        self.array_script_obj = None
+        # The step's array job, once its scripts are created: {"script_id": ..., "tasks": list of the tasks' samples}
+        self.array_job = None
+
         # # Add job_limit to params
         # # This way, job_limit can be passed globally or by step...
         # # Problematic because job_limit is treated at the class level in scriptconstructor...
@@ -489,8 +472,13 @@ Dependencies: {depends}""".format(name=self.name,
 
         ## Create kill script class
         # Done before high level script so that high level knows about the 'kill_script_path' in params
+        # Scripts of steps built in a previous run are kept until it is known whether the step has to be rebuilt
+        # (see modules/build_cache.py and restart_scripts())
+        build_cache = getattr(self.main_pl_obj, "build_cache", None)
+        self.reusing_scripts = build_cache is not None and build_cache.has_step(self.get_step_name())
+
         getScriptConstructorClass = self.import_ScriptConstructor(level="kill")
-        self.kill_script_obj = getScriptConstructorClass(master = self)
+        self.kill_script_obj = getScriptConstructorClass(master = self, reuse_script = self.reusing_scripts)
 
         # Store path to kill script in params:
         self.params["kill_script_path"] = self.kill_script_obj.script_path
@@ -501,7 +489,16 @@ Dependencies: {depends}""".format(name=self.name,
         # First, setting spec_script_name:
         self.spec_script_name = self.jid_name_sep.join([self.step,self.name])
         # Then, creating high-level script:
-        self.main_script_obj = getScriptConstructorClass(master=self)
+        self.main_script_obj = getScriptConstructorClass(master=self, reuse_script = self.reusing_scripts)
+
+    def restart_scripts(self):
+        """ Empty the high level and kill scripts kept from a previous run, when the step has to be rebuilt
+        """
+
+        if self.reusing_scripts:
+            self.main_script_obj.restart_script()
+            self.kill_script_obj.restart_script()
+            self.reusing_scripts = False
 
         
     def cleanup(self):
@@ -538,6 +535,7 @@ Dependencies: {depends}""".format(name=self.name,
         
     def get_base_sample_data(self):
         """ Get base_sample_data
+            Returns a dict of read-only views of the sample_data of all the step's dependencies.
         """
         # print [step.get_step_name()
         #        for step
@@ -564,32 +562,6 @@ Dependencies: {depends}""".format(name=self.name,
             return self.main_pl_obj.step_list[self.main_pl_obj.step_list_index.index(base_n)]
 
 
-    def sample_data_merge(self, sample_data, other_sample_data, other_step_name):
-        """ Merge a different sample_data dict into this step's sample_data
-            Used for cyclic sungrebe - basing a step on more than one base.
-        """
-        # new_smpdt = deepcopy(smpdt)
-
-        for k, v in other_sample_data.items():
-            # print smpdt
-            # print "\n\n"
-            if (k in sample_data):
-                if (isinstance(sample_data[k], dict) 
-                        and isinstance(other_sample_data[k], dict)):
-                    sample_data[k] = self.sample_data_merge(sample_data[k], other_sample_data[k], other_step_name)
-                else:
-                    # For list of active samples, merge the lists:
-                    if k == "samples":
-                        sample_data[k] = list(set(sample_data[k]) | set(other_sample_data[k]))
-
-                    # Do nothing, but check not discarding values from other_sample_data
-                    if sample_data[k] != other_sample_data[k]:
-                        self.write_warning("There is a difference from %s in key %s\n" % (other_step_name, k))
-            else:
-                sample_data[k] = deepcopy(other_sample_data[k])
-
-        return sample_data
-
     def set_sample_data(self, sample_data = None):
         """ Sets the sample_data. 
             This cannot be done in constructor because it depends on the output from previous steps.
@@ -600,28 +572,39 @@ Dependencies: {depends}""".format(name=self.name,
         # This is not usually used but might be handy when you need more than one bam, for instance (see below)
 
         if sample_data is not None:     # When passing sample_data (i.e. for merge)
-            # Copying sample_data. Just '=' would create a kind of reference
-            self.sample_data = deepcopy(sample_data)
+            # Layering over sample_data. Changes are made in the overlay, leaving sample_data unchanged
+            self.sample_data = LayeredSampleData([sample_data])
             # # Also starting a new provenance dictionary
             if self.use_provenance:
                 self.create_provenance()
-                self.sample_data_original = deepcopy(self.sample_data)
+                self.sample_data_original = LayeredSampleData([sample_data], read_only=True)
         else:   # Extract sample_data from base steps:
-            self.sample_data = dict()
-            if self.use_provenance:
-                self.provenance = dict()
-            for base_step in self.base_step_list:
-                # Merge sample_data from all base steps.
-                # Function sample_data_merge uses deepcopy as well
-                self.sample_data = self.sample_data_merge(self.get_sample_data(),
-                                                          base_step.get_sample_data(),
-                                                          base_step.get_step_name())
+            # Layering over sample_data of all base steps. Where bases differ, the first base wins
+            base_sample_data = [base_step.get_sample_data() for base_step in self.base_step_list]
+            merged_sample_data = LayeredSampleData(base_sample_data)
+            if len(base_sample_data) > 1:
+                # For list of active samples, merge the lists:
+                samples = list()
+                for base_samples in [get_raw_value(base_data, "samples") for base_data in base_sample_data]:
+                    samples_set = set(samples)
+                    samples.extend(sample for sample in base_samples if sample not in samples_set)
+                # Check not discarding values from other bases
+                if self.pipe_data["verbose"]:
+                    for base_ind, key in find_base_conflicts(base_sample_data):
+                        self.write_warning("There is a difference from %s in key %s\n" %
+                                           (self.base_step_list[base_ind].get_step_name(), key))
+                merged_sample_data["samples"] = samples
+            self.sample_data = LayeredSampleData([merged_sample_data])
 
-                if self.use_provenance:
-                    self.provenance = self.sample_data_merge(self.get_provenance(),
-                                                             base_step.get_provenance(),
-                                                             base_step.get_step_name())
-                    self.sample_data_original = deepcopy(self.sample_data)
+            if self.use_provenance:
+                # Provenance is layered over the provenance of the base steps in the same way
+                base_provenance = [base_step.get_provenance() for base_step in self.base_step_list]
+                if self.pipe_data["verbose"]:
+                    for base_ind, key in find_base_conflicts(base_provenance):
+                        self.write_warning("There is a difference from %s in key %s\n" %
+                                           (self.base_step_list[base_ind].get_step_name(), key))
+                self.provenance = LayeredSampleData(base_provenance)
+                self.sample_data_original = LayeredSampleData([merged_sample_data], read_only=True)
 
 
         # This part is experimental and not 100% complete. Changes will probably occur in the future.
@@ -697,6 +680,8 @@ Dependencies: {depends}""".format(name=self.name,
             self.sample_data.pop(sample)
 
         self.sample_data["samples"] = sample_list  #self.params["sample_list"]
+        # The category index is for the previous sample list
+        self.clear_category_index()
 
     def recover_sample_list(self,base=None):
         """ Call this function to recover the most recent sample list from history.
@@ -764,18 +749,44 @@ Dependencies: {depends}""".format(name=self.name,
         
         return self.jid_list
         
+    def get_dependency_step_list(self):
+        """ Returns the list of steps whose scripts this step's scripts should wait for.
+            These are the nearest ancestors that produce scripts: skipped bases are passed through to their own
+            dependencies, and steps which are ancestors of other steps in the list are removed (transitive
+            reduction), since waiting for a step implies waiting for all of its ancestors.
+            Is computed once, when first requested. Steps are built in dependency order, so by then all bases are
+            final.
+        """
+
+        if self.dependency_step_list is None:
+            candidate_steps = list()
+            for base_step in self.get_base_step_list() or []:
+                if base_step.skip_scripts:
+                    candidate_steps.extend(base_step.get_dependency_step_list())
+                else:
+                    candidate_steps.append(base_step)
+            candidate_steps = {step.get_step_name(): step for step in candidate_steps}
+
+            step_graph = self.main_pl_obj.step_graph
+            self.dependency_step_list = [candidate_steps[name]
+                                         for name
+                                         in step_graph.get_transitive_reduction(list(candidate_steps.keys()))]
+
+        return self.dependency_step_list
+
     def get_dependency_jid_list(self):
-        """ Returns the list of jids of all base steps
-            Recursion. beware!
+        """ Returns the list of jids of all immediate predecessor steps (see get_dependency_step_list())
+            The list is memoized. Do not modify it in place.
         """
-        
-        depend_jid_list = []
-        
-        if self.base_step_list:
-            for base_step in self.base_step_list:
-                depend_jid_list += (base_step.get_jid_list() + base_step.get_dependency_jid_list())
 
-        return depend_jid_list
+        if self.dependency_jid_list_memo is None:
+            self.dependency_jid_list_memo = [jid
+                                             for base_step
+                                             in self.get_dependency_step_list()
+                                             for jid
+                                             in base_step.get_jid_list()]
+
+        return self.dependency_jid_list_memo
 
     def get_glob_jid_list(self):
         """ Return list of jids
@@ -795,26 +806,31 @@ Dependencies: {depends}""".format(name=self.name,
                                                        runid=self.pipe_data["run_code"])
 
     def get_dependency_glob_jid_list(self):
-        """ Returns the list of jids of all base steps
-            Recursion. beware!
+        """ Returns the list of glob jids of all immediate predecessor steps (see get_dependency_step_list())
+            The list is memoized. Do not modify it in place.
         """
 
-        glob_depend_jid_list = []
-
-        if self.base_step_list:
-            for base_step in self.base_step_list:
-                glob_depend_jid_list += (base_step.get_glob_jid_list() + base_step.get_dependency_glob_jid_list())
+        if self.dependency_glob_jid_list_memo is None:
+            self.dependency_glob_jid_list_memo = [jid
+                                                  for base_step
+                                                  in self.get_dependency_step_list()
+                                                  for jid
+                                                  in base_step.get_glob_jid_list()]
 
-        return list(set(glob_depend_jid_list))
+        return self.dependency_glob_jid_list_memo
 
     def import_ScriptConstructor(self, level): #modname, classname):
         """Returns a class of "classname" from module "modname". 
+            The class is imported once per level.
         """
 
         level = level.lower().capitalize()
+        if level in self.script_constructor_classes:
+            return self.script_constructor_classes[level]
         modname = "neatseq_flow.script_constructors.scriptconstructor{executor}".format(executor=self.pipe_data["Executor"])
         classname = "{level}ScriptConstructor{executor}".format(level=level, executor=self.pipe_data["Executor"])  #SGE"
-        return getattr(importlib.import_module(modname), classname)
+        self.script_constructor_classes[level] = getattr(importlib.import_module(modname), classname)
+        return self.script_constructor_classes[level]
 
         
     def create_low_level_script(self):
@@ -822,6 +838,10 @@ Dependencies: {depends}""".format(name=self.name,
             The actual part of the script is produced by the particular step class.
             This function is responsible for the generic part: opening the file and writing the qsub parameters and the script
         """
+        if self.array_jobs:
+            self.add_array_task()
+            return
+
         getChildClass = self.import_ScriptConstructor(level="low")
         # Create ScriptConstructor for low level script.
         self.child_script_obj = getChildClass(master=self)
@@ -865,6 +885,130 @@ Dependencies: {depends}""".format(name=self.name,
         
         self.child_script_obj.__del__()
 
+    def add_array_task(self):
+        """ Adds the current low level script as a task of the step's array job, instead of writing it to its own file
+            and submitting it on its own. The array job is written by close_array_script()
+        """
+
+        if self.array_script_obj is None:
+            try:
+                getArrayClass = self.import_ScriptConstructor(level="array")
+            except AttributeError:
+                self.write_warning("Array jobs are not supported for executor %s. Creating a script per job" %
+                                   self.pipe_data["Executor"])
+                self.array_jobs = False
+                self.create_low_level_script()
+                return
+            # The array job is named like a low level script with 'array' as sample name
+            task_script_name = self.spec_script_name
+            self.spec_script_name = self.jid_name_sep.join([self.step, self.name, "array"])
+            self.array_script_obj = getArrayClass(master=self)
+            self.spec_script_name = task_script_name
+
+        task_obj = self.import_ScriptConstructor(level="low")(master=self, open_script=False)
+
+        self.dependency_jid_list = self.preliminary_jids + self.get_dependency_jid_list()
+        self.dependency_glob_jid_list = self.preliminary_jids + self.get_dependency_glob_jid_list()
+
+        # The task name is the part of the script name following the step and its name, e.g. the sample name
+        task_name = self.jid_name_sep.join(self.spec_script_name.split(self.jid_name_sep)[2:])
+        self.array_script_obj.add_task(task_obj, task_name)
+
+        # Clear stamped files list
+        self.stamped_files = list()
+
+        # The tasks are listed in qsub_names_dict, since they write their own lines to the log file
+        self.qsub_names_dict["low_qsubs"].append(task_obj.script_id)
+
+    def get_array_only_job(self):
+        """ Returns the id of the step's array job if all of the step's low level scripts run in it (i.e. there are no
+            preliminary and wrapping up scripts). Otherwise, returns None.
+        """
+
+        jid_list = self.get_jid_list()
+        if self.array_job is None or len(jid_list) != 2 or jid_list[1] != self.array_job["script_id"]:
+            return None
+        return self.array_job["script_id"]
+
+    def get_corresponding_array_steps(self):
+        """ Returns the dependency steps whose array job tasks correspond one-to-one to the tasks of this step's array
+            job: All their low level scripts run in an array job whose tasks are for the same samples (or other units
+            of parallelization) as this step's, in the same order. Each task of this step's array job need only wait
+            for the corresponding task.
+        """
+
+        if self.preliminary_jids or \
+                not self.array_script_obj.supports_task_dependencies or \
+                len(set(self.array_job["tasks"])) != len(self.array_job["tasks"]):
+            return []
+        return [step
+                for step
+                in self.get_dependency_step_list()
+                if step.get_array_only_job() and step.array_job["tasks"] == self.array_job["tasks"]]
+
+    def close_array_script(self):
+        """ Writes the step's array job script, and adds the array job to the high level script and the indices
+        """
+
+        if self.array_script_obj is None:
+            return
+
+        self.child_script_obj = self.array_script_obj
+        # The tasks are identified by the first part of their name, e.g. the sample for the script 'Sample1..PE'
+        self.array_job = {"script_id": self.child_script_obj.script_id,
+                          "tasks": [task_name.split(self.jid_name_sep)[0]
+                                    for task_name
+                                    in self.child_script_obj.task_names]}
+
+        self.dependency_jid_list = self.preliminary_jids + self.get_dependency_jid_list()
+        self.dependency_glob_jid_list = self.preliminary_jids + self.get_dependency_glob_jid_list()
+        self.add_depend_index_entry()
+
+        # Dependencies on array jobs with corresponding tasks are task-by-task, and are not added to the job's
+        # dependency lists
+        corresponding_steps = self.get_corresponding_array_steps()
+        self.child_script_obj.corresponding_jids = [step.array_job["script_id"] for step in corresponding_steps]
+        dependency_steps = [step for step in self.get_dependency_step_list() if step not in corresponding_steps]
+        self.dependency_jid_list = self.preliminary_jids + [jid
+                                                            for step
+                                                            in dependency_steps
+                                                            for jid
+                                                            in step.get_jid_list()]
+        self.dependency_glob_jid_list = self.preliminary_jids + [jid
+                                                                 for step
+                                                                 in dependency_steps
+                                                                 for jid
+                                                                 in step.get_glob_jid_list()]
+
+        self.add_jid_to_jid_list(self.child_script_obj.script_id)
+        self.child_script_obj.write_script()
+        self.main_script_obj.write_command(self.main_script_obj.get_child_command(self.child_script_obj))
+        self.add_job_script_run_indices(self.child_script_obj)
+
+        self.child_script_obj.__del__()
+        self.array_script_obj = None
+
+    def get_high_dependency_lists(self):
+        """ Returns the jid list and glob jid list the high level script depends on.
+            For steps with array jobs, only the high level scripts of dependency steps whose low level scripts all run
+            in an array job are waited for. Once these have run, the array jobs were submitted, and the step's own array
+            job can be submitted with task-by-task dependencies on them (see get_corresponding_array_steps()).
+        """
+
+        if not self.array_jobs:
+            return self.get_dependency_jid_list(), self.get_dependency_glob_jid_list()
+
+        jid_list = list()
+        glob_jid_list = list()
+        for step in self.get_dependency_step_list():
+            if step.get_array_only_job():
+                jid_list.append(step.get_jid_list()[0])
+                glob_jid_list.append(step.get_jid_list()[0])
+            else:
+                jid_list.extend(step.get_jid_list())
+                glob_jid_list.extend(step.get_glob_jid_list())
+        return jid_list, glob_jid_list
+
     def create_preliminary_script(self):
         """ Create a script that will run before all other low level scripts commence
 
@@ -978,13 +1122,13 @@ Dependencies: {depends}""".format(name=self.name,
     def add_job_script_run_indices(self, script_obj):
         """ Add current script to script_index and run_index files
         """
-        with open(self.pipe_data["script_index"], "a") as script_fh:
-            script_fh.write("{qsub_name}\t{script_name}\n".format(qsub_name   = script_obj.script_id,
-                                                                  script_name = script_obj.script_path))
-        with open(self.pipe_data["run_index"], "a") as script_fh:
-            if script_obj.level == "high":
-                script_fh.write("\n----\n")
-            script_fh.write("# {qsub_name}\n".format(qsub_name   = script_obj.script_id))
+        self.generation_writer.append(self.pipe_data["script_index"],
+                                      "{qsub_name}\t{script_name}\n".format(qsub_name   = script_obj.script_id,
+                                                                            script_name = script_obj.script_path))
+        if script_obj.level == "high":
+            self.generation_writer.append(self.pipe_data["run_index"], "\n----\n")
+        self.generation_writer.append(self.pipe_data["run_index"],
+                                      "# {qsub_name}\n".format(qsub_name   = script_obj.script_id))
         
     def add_depend_index_entry(self):
         """
@@ -992,11 +1136,18 @@ Dependencies: {depends}""".format(name=self.name,
         :return:
         """
 
-        pass
-        with open(self.pipe_data["depend_index"], "a") as script_fh:
-            for jid in self.dependency_glob_jid_list:
-                script_fh.write("{depend_jid}\t{my_jid}\n".format(my_jid= self.child_script_obj.script_id,
-                                                                  depend_jid= jid))
+        for jid in self.dependency_glob_jid_list:
+            self.generation_writer.append(self.pipe_data["depend_index"],
+                                          "{depend_jid}\t{my_jid}\n".format(my_jid= self.child_script_obj.script_id,
+                                                                             depend_jid= jid))
+
+    def register_generation_writes(self):
+        """ Pass the index lines and dirs collected while building the step to the workflow's writer, and write the
+            summary of the collected warnings
+        """
+        for admonition, summary in self.generation_writer.get_warning_summaries():
+            self.write_warning(summary, admonition = admonition)
+        self.main_pl_obj.generation_writer.update(self.generation_writer)
 
 
     def create_scripts_dir(self):
@@ -1028,11 +1179,9 @@ Dependencies: {depends}""".format(name=self.name,
 
         self.spec_script_name = self.jid_name_sep.join([self.step,self.name])
 
-        # Add qdel command to main qdel script:
-        self.main_script_obj.main_script_kill_commands(self.kill_script_filename_main)
-
-        self.dependency_jid_list = self.get_dependency_jid_list()   # + self.preliminary_jids
-        self.dependency_glob_jid_list = self.get_dependency_glob_jid_list()
+        self.dependency_jid_list, self.dependency_glob_jid_list = self.get_high_dependency_lists()
+        # Kept for the qalter command of steps with array jobs (see HighScriptConstructorSGE.get_depends_command())
+        self.high_dependency_glob_jid_list = self.dependency_glob_jid_list
 
         # Write main script preamble:
         self.main_script_obj.write_command(self.main_script_obj.get_script_preamble())
@@ -1057,6 +1206,15 @@ Dependencies: {depends}""".format(name=self.name,
 
     def create_all_scripts(self):
         """ Contains code to be done after build_scripts()
+            Creates the step's scripts and registers them in the workflow
+        """
+
+        self.create_step_scripts()
+        self.register_step_scripts()
+
+    def create_step_scripts(self):
+        """ Create the step's scripts and update the provenance. Is independent of the other steps being built, so can
+            be run in a worker process (see modules/parallel_build.py)
         """
 
         if not self.skip_scripts:
@@ -1074,6 +1232,9 @@ Dependencies: {depends}""".format(name=self.name,
                 # Create actual scripts: NOTE: This function is defined in the individual step files!
                 self.build_scripts()
 
+                # With array_jobs, write the array job running the scripts created by build_scripts()
+                self.close_array_script()
+
                 # Add a wrapping up script if it is defined in the step specific module
                 self.create_wrapping_up_script()
                 
@@ -1089,17 +1250,90 @@ Dependencies: {depends}""".format(name=self.name,
 
                 assertErr.set_step_name(self.get_step_name())
                 raise assertErr
-        # Add sample_data to collection of sample_data dicts in main class:
-        self.main_pl_obj.global_sample_data[self.get_step_name()] = deepcopy(self.sample_data)
+
         # Updating provenance data:
         if self.use_provenance:
             self.update_provenance()
 
+    def register_step_scripts(self):
+        """ Add the step's scripts and sample_data to the workflow-wide files and containers.
+            Must be called for the steps in the order of the step list.
+        """
+
+        # Caching the step's state for the next run (if building with --incremental)
+        build_cache = getattr(self.main_pl_obj, "build_cache", None)
+        if build_cache is not None:
+            build_cache.store_step(self)
+
+        if not self.skip_scripts:
+            # Add qdel command to main qdel script:
+            self.main_script_obj.main_script_kill_commands(self.kill_script_filename_main)
+        # Adding qsub_names and script paths to script_index, run_index and depend_index, and sample dirs to make
+        self.register_generation_writes()
+
+        # Add a read-only view of sample_data to collection of sample_data dicts in main class:
+        self.main_pl_obj.global_sample_data[self.get_step_name()] = LayeredSampleData([self.sample_data],
+                                                                                      read_only=True)
+
         if "stop_and_show" in self.params:
             print(self.get_stop_and_show_message())
             raise AssertionExcept("Showed. Now stopping. "
                                   "To continue, remove the 'stop_and_show' tag from %s" % self.get_step_name())
 
+        self.store_sample_data()
+
+    def get_build_state(self):
+        """ Returns the step's attributes, for passing the state of a step built in a worker process to the main
+            process. sample_data and provenance are passed as the contents of their overlays (see set_build_state())
+        """
+
+        state = {key: value
+                 for key, value
+                 in self.__dict__.items()
+                 if key not in ["sample_data", "provenance", "sample_data_original",
+                                "category_index", "category_index_samples", "category_index_length"]}
+        state["sample_data"] = self.sample_data.get_state()
+        if self.use_provenance:
+            state["provenance"] = self.provenance.get_state()
+
+        return state
+
+    def set_build_state(self, state):
+        """ Sets the step's attributes to a state returned by get_build_state()
+            dicts and lists are updated in place, since they may be referenced elsewhere (e.g. params)
+        """
+
+        state = dict(state)
+        self.sample_data.set_state(state.pop("sample_data"))
+        if "provenance" in state:
+            self.provenance.set_state(state.pop("provenance"))
+        for key, value in state.items():
+            current_value = self.__dict__.get(key)
+            if current_value is value:
+                continue
+            if type(current_value) is dict and type(value) is dict:
+                current_value.clear()
+                current_value.update(value)
+            elif type(current_value) is list and type(value) is list:
+                current_value[:] = value
+            else:
+                setattr(self, key, value)
+
+    def store_sample_data(self):
+        """ Move the sample_data and provenance of the step to the on-disk sample data store, if one is used.
+            They are replaced with read-only views of the stored data.
+        """
+
+        sample_data_store = getattr(self.main_pl_obj, "sample_data_store", None)
+        if sample_data_store is None:
+            return
+
+        self.sample_data = sample_data_store.put_step("sample_data", self.get_step_name(), self.sample_data)
+        self.main_pl_obj.global_sample_data[self.get_step_name()] = self.sample_data
+        if self.use_provenance:
+            self.provenance = sample_data_store.put_step("provenance", self.get_step_name(), self.provenance)
+            self.sample_data_original = None
+
     def get_stop_and_show_message(self):
 
         message = """\
@@ -1147,10 +1381,10 @@ Project slots:
         if self.sample_data["samples"]:  # Sample list may be empty if only project data was passed!
             if self.use_provenance:
                 all_samples = set(self.provenance.keys()) - {"project_data"}
-                uniq_prov_list = list(set([json.dumps(self.provenance[sample], sort_keys=True)
+                uniq_prov_list = list(set([json.dumps(self.provenance[sample], sort_keys=True, default=json_default)
                                            for sample
                                            in all_samples]))
-                prov_dict = {sample: json.dumps(self.provenance[sample], sort_keys=True)
+                prov_dict = {sample: json.dumps(self.provenance[sample], sort_keys=True, default=json_default)
                              for sample
                              in all_samples}
                 uniq_sample_lists = [[sample
@@ -1213,12 +1447,13 @@ Sample slots:
             return self.base_dir
 
         sample_folder = self.base_dir + sample + os.sep
-        if not os.path.isdir(sample_folder):
-            self.write_warning("Making dir at %s \n" % sample_folder, admonition = "ATTENTION")
-            os.makedirs(sample_folder) 
+        # The folder is made when the workflow's writes are flushed (see modules/generation_writer.py)
+        if not self.generation_writer.dir_exists(sample_folder):
+            self.generation_writer.add_warning("Making dirs at %s" % self.base_dir, sample, admonition = "ATTENTION")
+            self.generation_writer.make_dir(sample_folder)
         else:
             # if "verbose" in self.params:   # At the moment not set anywhere. Maybe in the future
-            self.write_warning("Dir %s exists\n" % sample_folder, admonition = "WARNING")
+            self.generation_writer.add_warning("Dirs exist at %s" % self.base_dir, sample, admonition = "WARNING")
     
         return sample_folder
         
@@ -1504,24 +1739,44 @@ Sample slots:
 
                 
     def get_step_modifiers(self):
-        """ A class method for finding the location of a module for a given step
+        """ Returns the parameters referenced in self.params in the module file (stored in self.path).
+            These are 'modifiers' that the user can modify, and that the module deals with specifically, beyond those
+            passed with redir_params. Parameters common to all modules (base, module, script_path, etc.) are excluded.
         """
-        
-        step_params = []
-        
-        # find all places in module file (stored in self.path) where a parameter is 
-        # referenced in self.params. These are 'modifiers' that the user can modify, 
-        # and that the module deals with specifically, beyond those passed with redir_params.
-        with open(self.path,"r") as modfh:
-            for line in modfh:
-                param = re.search('self.params\[\"(.*?)\"\]', line)
-                if param:
-                    step_params.append(param.group(1))
-                    
-        # Return the unique list of such params, after excluding the ones that are true for all modules:
-        # base, module, script_path, etc.
-        return list(set(step_params)-set(["redir_params","qsub_params","base", "module",
-                                          "sample_list", "exclude_sample_list", "script_path"]))
+
+        return ModuleIndex.get_index().get_step_modifiers(self.path)
+
+    def get_category_index(self, category):
+        """ Returns an index of the samples by their level in category: {level: list of samples}.
+            Levels and samples are ordered as in self.sample_data["samples"].
+            The index is built in one pass over the samples' grouping data the first time a category is requested, and
+            rebuilt if the sample list changes.
+        """
+
+        samples = self.sample_data["samples"]
+        if samples is not self.category_index_samples or len(samples) != self.category_index_length:
+            self.clear_category_index()
+            self.category_index_samples = samples
+            self.category_index_length = len(samples)
+
+        if category not in self.category_index:
+            index = dict()
+            try:
+                for sample in samples:
+                    level = get_raw_value(get_raw_value(get_raw_value(self.sample_data, sample), "grouping"), category)
+                    index.setdefault(level, list()).append(sample)
+            except KeyError:
+                raise AssertionExcept("Category {cat} not defined for all samples".format(cat=category))
+            self.category_index[category] = index
+
+        return self.category_index[category]
+
+    def clear_category_index(self):
+        """ Clear the category index. Call if the grouping data of the samples is changed.
+        """
+
+        self.category_index = dict()
+        self.category_index_samples = None
 
     def get_category_levels(self, category):
         """
@@ -1529,20 +1784,11 @@ Sample slots:
         :param: category
         :return: List of levels in category
         """
-        try:
-            return list({self.sample_data[sample]["grouping"][category]
-                         for sample
-                         in self.sample_data["samples"]})
-        except KeyError:
-            pp(self.sample_data)
-            raise AssertionExcept("Category {cat} not defined for all samples".format(cat=category))
+        return list(self.get_category_index(category))
 
     def get_samples_in_category_level(self, category, cat_level):
 
-        return [sample
-                for sample
-                in self.sample_data["samples"]
-                if self.sample_data[sample]["grouping"][category] == cat_level]
+        return list(self.get_category_index(category).get(cat_level, list()))
 
 
     def create_group_slots(self, category):
@@ -1562,84 +1808,90 @@ Sample slots:
 
     def update_provenance(self):
         """
-        Creates and updates a self.sample_data shadow dict with the formation history of each slot
+        Updates the provenance dict, a shadow dict of self.sample_data with the formation history of each slot.
+        Only the samples and slots changed in the current step are compared with the original sample data (see
+        LayeredSampleData.get_changes())
         :return:
         """
 
-        # Samples added in current step
-        for sample in [sample
-                       for sample
-                       in self.sample_data["samples"]
-                       if sample not in self.sample_data_original["samples"]]:
-            # print "sample -->", sample
-            all_keys = list()
-            if sample in self.provenance:
-                all_keys = itertools.chain(all_keys,list(self.provenance[sample].keys()))
+        step_name = self.get_step_name()
+        # Reading through read-only views, so that nothing is copied into the layered sample_data
+        sample_data = LayeredSampleData([self.sample_data], read_only=True)
+        sample_data_original = self.sample_data_original
+        changes = self.sample_data.get_changes()
+
+        if "samples" in changes:
+            samples_set = set(sample_data["samples"])
+            samples_original_set = set(sample_data_original["samples"])
+            # Samples added in current step
+            for sample in [sample
+                           for sample
+                           in sample_data["samples"]
+                           if sample not in samples_original_set]:
+                all_keys = list()
+                if sample in self.provenance:
+                    all_keys = itertools.chain(all_keys,list(self.provenance[sample].keys()))
+                else:
+                    self.provenance[sample] = dict()
+                if sample in sample_data:
+                    all_keys = itertools.chain(all_keys,list(sample_data[sample].keys()))
+                for key in all_keys:
+                    self.provenance[sample][key] = [">"+step_name]
+            # Samples removed in current step
+            for sample in [sample
+                           for sample
+                           in sample_data_original["samples"]
+                           if sample not in samples_set]:
+                all_keys = list()
+                if sample in self.provenance:
+                    all_keys = itertools.chain(all_keys,list(self.provenance[sample].keys()))
+                if sample in sample_data:
+                    all_keys = itertools.chain(all_keys,list(sample_data_original[sample].keys()))
+                for key in all_keys:
+                    self.provenance[sample][key].append(step_name+"|")
+            # Samples that were not added or removed, + project_data:
+            unchanged_samples = samples_set & samples_original_set | {"project_data"}
+        else:
+            unchanged_samples = set(sample_data_original["samples"]) | {"project_data"}
+
+        # Comparing changed slots of samples that were not added or removed
+        for sample in [sample for sample in changes if sample in unchanged_samples]:
+            if changes[sample] is None:     # sample dict was set or deleted. Comparing all slots
+                all_keys = dict()
+                for data in [sample_data, sample_data_original]:
+                    if sample in data:
+                        all_keys.update(dict.fromkeys(data[sample].keys()))
             else:
+                all_keys = changes[sample]
+            current = sample_data[sample] if sample in sample_data else dict()
+            original = sample_data_original[sample] if sample in sample_data_original else dict()
+            if sample not in self.provenance:
                 self.provenance[sample] = dict()
-            if sample in self.sample_data:
-                all_keys = itertools.chain(all_keys,list(self.sample_data[sample].keys()))
-            for key in all_keys:
-                self.provenance[sample][key] = [">"+self.get_step_name()]
-        # Samples removed in current step
-        for sample in [sample
-                       for sample
-                       in self.sample_data_original["samples"]
-                       if sample not in self.sample_data["samples"]]:
-            # print "sample -->", sample
-            all_keys = list()
-            if sample in self.provenance:
-                all_keys = itertools.chain(all_keys,list(self.provenance[sample].keys()))
-            if sample in self.sample_data:
-                all_keys = itertools.chain(all_keys,list(self.sample_data_original[sample].keys()))
-            for key in all_keys:
-                self.provenance[sample][key].append(self.get_step_name()+"|")
-
-        # Get samples that were not added or removed, + project_data:
-        sample_and_proj_list = list(set(self.sample_data["samples"]) &
-                                    set(self.sample_data_original["samples"]) |
-                                    set(["project_data"]))
-        # # sample_and_proj_list.append("project_data")
-        # print "--------- %s ---------------------" % self.get_step_name()
-        # print sample_and_proj_list
-        # print "P> ",self.provenance["project_data"].keys()
-        # print "S> ",self.sample_data["project_data"].keys()
-        # print "O> ",self.sample_data_original["project_data"].keys()
-        # print "------------------------------"
-
-        for sample in sample_and_proj_list:
-            all_keys = list()
-            if sample in self.provenance:
-                all_keys = itertools.chain(all_keys,list(self.provenance[sample].keys()))
-            if sample in self.sample_data:
-                all_keys = itertools.chain(all_keys,list(self.sample_data[sample].keys()))
-            if sample in self.sample_data_original:
-                all_keys = itertools.chain(all_keys,list(self.sample_data_original[sample].keys()))
-            # Gey unique keys!
-            all_keys = list(set(all_keys))
 
             for key in all_keys:
-                if key in self.sample_data[sample] and key in self.sample_data_original[sample]:
-                    if self.sample_data[sample][key] != self.sample_data_original[sample][key]:
-                        self.provenance[sample][key].append(self.get_step_name())
-                elif key in self.sample_data[sample]: # And not in original!
-                    self.provenance[sample][key] = [">"+self.get_step_name()]
-                elif key in self.sample_data_original[sample]:  # And not in current!
-                    self.provenance[sample][key].append(self.get_step_name()+"|")
+                if key in current and key in original:
+                    if get_raw_value(current, key) != get_raw_value(original, key):
+                        self.provenance[sample][key].append(step_name)
+                elif key in current: # And not in original!
+                    self.provenance[sample][key] = [">"+step_name]
+                elif key in original:  # And not in current!
+                    self.provenance[sample][key].append(step_name+"|")
                 else:
                     pass
 
     def create_provenance(self):
         """
-        Create a provenance dict based on sample_da
+        Create a provenance dict based on sample_data
         :return:
         """
 
-        self.provenance = dict()
-        sample_and_proj_list = deepcopy(self.sample_data["samples"])
+        self.provenance = LayeredSampleData()
+        sample_and_proj_list = list(get_raw_value(self.sample_data, "samples"))
         sample_and_proj_list.append("project_data")
         for sample in sample_and_proj_list:
-            self.provenance[sample] = {key:[">"+self.get_step_name()] for key in self.sample_data[sample]}
+            self.provenance[sample] = {key:[">"+self.get_step_name()]
+                                       for key
+                                       in get_raw_value(self.sample_data, sample)}
 
     def get_provenance(self):
         return self.provenance
@@ -1700,10 +1952,9 @@ Sample slots:
         if type(sample_dict["levels"]) == str:
             sample_dict["levels"] = [sample_dict["levels"]]
         # Check all levels exist in category
-        if not all(
-                [level in self.get_category_levels(sample_dict["category"]) for level in sample_dict["levels"]]):
-            bad_levels = ", ".join([level for level in sample_dict["levels"] if
-                                    level not in self.get_category_levels(sample_dict["category"])])
+        category_index = self.get_category_index(sample_dict["category"])
+        if not all([level in category_index for level in sample_dict["levels"]]):
+            bad_levels = ", ".join([level for level in sample_dict["levels"] if level not in category_index])
             raise AssertionExcept("Level '{lev}' is not defined for "
                                   "category '{cat}'".format(lev=bad_levels,
                                                             cat=sample_dict["category"]))
@@ -0,0 +1,274 @@
+""" Incremental regeneration of workflow scripts
+
+Used when NeatSeq-Flow is run with --incremental. After a step's scripts are built, the step's state (the attributes
+and sample_data changes passed between processes by parallel_build) is saved in a cache in the objects dir, together
+with a hash of everything the scripts are built from:
+
+    * The step parameters and the global parameters, as passed by the user (modules change the parameters of their
+      steps, not always in the same order, e.g. when building lists from sets)
+    * The source of the step's module and of the executor's script constructors
+    * The pipe_data (executor, directories, run code etc.)
+    * The output hashes of the base steps: a hash of their sample_data, provenance and job ids
+
+On the next run, a step whose hash is unchanged is not built. Its state is set from the cache and its script files are
+left as they are. Since base steps are compared by their output, a step whose parameters changed without changing its
+sample_data (e.g. different program options) does not cause the steps based on it to be rebuilt.
+
+Scripts can depend on things not covered by the hash (e.g. files read by a module while building). Run without
+--incremental to rebuild all the steps. Doing so also removes the cache.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import io
+import os
+import sys
+import json
+import pickle
+import hashlib
+
+from .layered_sample_data import json_default
+from ..script_constructors.scriptconstructor import ScriptConstructor
+
+
+BUILD_CACHE_FILENAME = "build_cache.pickle"
+# pipe_data keys that do not affect the scripts
+UNHASHED_PIPE_DATA = ["message", "verbose"]
+
+
+def hash_default(obj):
+    """ Passed as 'default' to json.dumps() when hashing. Objects which can not be encoded are hashed by their repr(),
+        which usually differs between runs, so that the step is rebuilt.
+    """
+    try:
+        return json_default(obj)
+    except TypeError:
+        return repr(obj)
+
+
+def get_hash(*items, sort_keys=False):
+    """ Returns a hash of the JSON encoding of items
+    """
+    return hashlib.sha1(json.dumps(items, default=hash_default, sort_keys=sort_keys).encode("utf8")).hexdigest()
+
+
+def get_file_hash(filename):
+
+    with open(filename, "rb") as file_fh:
+        return hashlib.sha1(file_fh.read()).hexdigest()
+
+
+class CachePickler(pickle.Pickler):
+    """ Pickles objects which exist in every run (the main object, steps and their high level and kill script
+        constructors etc.) by name, so that they are set to the objects of the current run when unpickled.
+        Open files and other script constructors are not cached.
+    """
+
+    def __init__(self, file, main_obj):
+        super(CachePickler, self).__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.names = get_named_objects(main_obj)
+
+    def persistent_id(self, obj):
+        if type(obj) is str:
+            return None
+        if id(obj) in self.names:
+            return self.names[id(obj)]
+        if isinstance(obj, (io.IOBase, ScriptConstructor)):
+            return "dropped", None
+        return None
+
+
+class CacheUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, main_obj):
+        super(CacheUnpickler, self).__init__(file)
+        self.objects = {name: obj for obj, name in get_named_objects(main_obj, by_id=False)}
+
+    def persistent_load(self, pid):
+        if pid[0] == "dropped":
+            return None
+        try:
+            return self.objects[pid]
+        except KeyError:
+            raise pickle.UnpicklingError("Object %s does not exist in the current run" % (pid,))
+
+
+def get_named_objects(main_obj, by_id=True):
+    """ Returns the objects pickled by name, as {id(object): name}, or, if by_id is False, as a list of (object, name)
+    """
+
+    named_objects = [(main_obj, ("main", None)),
+                     (main_obj.pipe_data, ("pipe_data", None)),
+                     (main_obj.param_data, ("param_data", None)),
+                     (main_obj.step_graph, ("step_graph", None)),
+                     (main_obj.global_sample_data, ("global_sample_data", None))]
+    for step in main_obj.step_list:
+        named_objects.append((step, ("step", step.get_step_name())))
+        for attr in ["main_script_obj", "kill_script_obj"]:
+            if getattr(step, attr, None) is not None:
+                named_objects.append((getattr(step, attr), ("script_obj", (step.get_step_name(), attr))))
+    if by_id:
+        return {id(obj): name for obj, name in named_objects}
+    return named_objects
+
+
+class BuildCache(object):
+    """ The cached states of the steps built in previous runs, by step name
+    """
+
+    def __init__(self, main_obj):
+        """ Must be called before the steps are made (see param_hashes)
+        """
+
+        self.main_obj = main_obj
+        self.filename = main_obj.pipe_data["objects_dir"] + BUILD_CACHE_FILENAME
+        # {step name: {"input_hash": str, "output_hash": str, "state": bytes}}
+        self.steps = dict()
+        # Hashes of the current run. Output hashes are passed on to the steps based on each step.
+        self.input_hashes = dict()
+        self.output_hashes = dict()
+        # Names of steps restored from the cache in the current run
+        self.restored = set()
+        self.file_hashes = dict()
+        # Hashes of the parameters passed by the user, by step name. Computed before the steps are made, since the
+        # modules change the parameters of their steps
+        self.param_hashes = {name: get_hash(params, sort_keys=True)
+                             for module_params
+                             in main_obj.param_data["Step"].values()
+                             for name, params
+                             in module_params.items()}
+        self.global_param_hash = get_hash(main_obj.param_data["Global"], sort_keys=True)
+
+        if os.path.isfile(self.filename):
+            try:
+                with open(self.filename, "rb") as cache_fh:
+                    cache = pickle.load(cache_fh)
+                if cache["version"] == __version__:
+                    self.steps = cache["steps"]
+            except Exception as raisedex:
+                sys.stderr.write("WARNING: Could not read build cache %s (%s). Building all steps\n" %
+                                 (self.filename, raisedex))
+
+    @classmethod
+    def remove(cls, pipe_data):
+        """ Removes the cache. Called when building without the cache, since the scripts may change
+        """
+        filename = pipe_data["objects_dir"] + BUILD_CACHE_FILENAME
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+    def has_step(self, step_name):
+        """ Returns True if step_name was built in a previous run. Used to decide whether to keep its scripts until it
+            is known whether the step has to be rebuilt.
+        """
+        return step_name in self.steps
+
+    def get_source_hash(self, cls):
+        """ Returns a hash of the source files of the classes cls is derived from
+        """
+
+        hashes = list()
+        for base_cls in cls.__mro__:
+            filename = getattr(sys.modules.get(base_cls.__module__), "__file__", None)
+            if filename is None:
+                continue
+            if filename not in self.file_hashes:
+                self.file_hashes[filename] = get_file_hash(filename)
+            hashes.append(self.file_hashes[filename])
+        return hashes
+
+    def get_input_hash(self, step):
+        """ Returns the hash of the things the step's scripts are built from. The step's base data must be set.
+        """
+
+        pipe_data = {key: value for key, value in step.pipe_data.items() if key not in UNHASHED_PIPE_DATA}
+        if step.get_base_step_list():
+            base_hashes = [(base_step.get_step_name(), self.output_hashes[base_step.get_step_name()])
+                           for base_step
+                           in step.get_base_step_list()]
+        else:
+            base_hashes = [get_hash(self.main_obj.sample_data, sort_keys=True)]
+        source_hashes = [self.get_source_hash(type(step))] + \
+                        [self.get_source_hash(step.import_ScriptConstructor(level))
+                         for level
+                         in ["high", "low", "kill"]]
+
+        return get_hash(step.get_step_name(),
+                        step.get_step_step(),
+                        step.step_number,
+                        self.param_hashes[step.get_step_name()],
+                        self.global_param_hash,
+                        pipe_data,
+                        source_hashes,
+                        base_hashes)
+
+    def get_output_hash(self, step):
+        """ Returns a hash of the data the steps based on step are built from
+        """
+
+        return get_hash(step.get_sample_data(),
+                        step.get_provenance() if step.use_provenance else None,
+                        step.get_jid_list(),
+                        step.get_glob_jid_list(),
+                        step.get_dependency_jid_list(),
+                        step.get_dependency_glob_jid_list(),
+                        step.array_job,
+                        sort_keys=True)
+
+    def restore_step(self, step):
+        """ If the step's hash is the same as in the cache, sets the step's state from the cache and returns True.
+            Otherwise, the step is removed from the cache and False is returned.
+        """
+
+        step_name = step.get_step_name()
+        self.input_hashes[step_name] = self.get_input_hash(step)
+        cached = self.steps.pop(step_name, None)
+        if cached is None or cached["input_hash"] != self.input_hashes[step_name]:
+            return False
+        # The scripts must still exist
+        if not step.skip_scripts and not all(os.path.isfile(getattr(step, attr).script_path)
+                                             for attr
+                                             in ["main_script_obj", "kill_script_obj"]):
+            return False
+        try:
+            state = CacheUnpickler(io.BytesIO(cached["state"]), self.main_obj).load()
+            step.set_build_state(state)
+        except Exception as raisedex:
+            sys.stderr.write("WARNING: Could not restore step %s from build cache (%s). Building\n" %
+                             (step_name, raisedex))
+            return False
+        self.steps[step_name] = cached
+        self.output_hashes[step_name] = cached["output_hash"]
+        self.restored.add(step_name)
+        return True
+
+    def store_step(self, step):
+        """ Stores the state of a built step. Must be called before the step's scripts are registered.
+        """
+
+        step_name = step.get_step_name()
+        if step_name in self.restored:
+            return
+        self.output_hashes[step_name] = self.get_output_hash(step)
+        state = io.BytesIO()
+        try:
+            CachePickler(state, self.main_obj).dump(step.get_build_state())
+        except Exception as raisedex:
+            step.write_warning("Step state can not be cached (%s). Will be rebuilt on every run\n" % raisedex)
+            return
+        self.steps[step_name] = {"input_hash": self.input_hashes[step_name],
+                                 "output_hash": self.output_hashes[step_name],
+                                 "state": state.getvalue()}
+
+    def save(self):
+        """ Writes the cache of the steps of the current workflow
+        """
+
+        step_names = [step.get_step_name() for step in self.main_obj.step_list]
+        cache = {"version": __version__,
+                 "steps": {step_name: self.steps[step_name] for step_name in step_names if step_name in self.steps}}
+        with open(self.filename + ".tmp", "wb") as cache_fh:
+            pickle.dump(cache, cache_fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(self.filename + ".tmp", self.filename)
@@ -0,0 +1,111 @@
+""" Buffered writes for script generation
+
+Index files (script_index, run_index and depend_index) are appended to for every script, and a results dir is made for
+every sample. Doing these one at a time is slow on network file systems, so they are collected in a GenerationWriter and
+done in bulk when the writer is flushed: Each file is opened once and missing dirs are made in one pass. Whether a dir
+exists is checked with one listing of its parent dir rather than a stat per dir.
+Warnings repeated for many items (e.g. 'Making dir' for every sample) are collected and summarized.
+
+Every step collects its writes in its own writer, which is passed to the workflow's writer when the step is registered
+(steps may be built in worker processes. See parallel_build). The workflow's writer is flushed when building is done.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+
+
+# Number of items to list in a warning summary
+SUMMARY_ITEMS = 3
+
+
+class GenerationWriter(object):
+    """ Collects file appends, dirs to make and warnings, and performs them in bulk on flush()
+    """
+
+    def __init__(self):
+
+        # {filename: list of text to append}. Files are written in the order they were first appended to
+        self.appends = dict()
+        # Dirs to make, in order (dict with None values)
+        self.dirs = dict()
+        # {(admonition, warning): list of items}
+        self.warnings = dict()
+        # Cache of the contents of listed parent dirs: {parent dir: set of names}
+        self.dir_listings = dict()
+
+    def append(self, filename, text):
+        """ Append text to filename on flush()
+        """
+        self.appends.setdefault(filename, list()).append(text)
+
+    def dir_exists(self, dirname):
+        """ Returns True if dirname exists or is going to be made on flush()
+            The parent dir is listed once, so checking all of a step's sample dirs requires one listing.
+        """
+
+        if dirname in self.dirs:
+            return True
+        parent, name = os.path.split(dirname.rstrip(os.sep))
+        if parent not in self.dir_listings:
+            try:
+                self.dir_listings[parent] = set(entry.name
+                                                for entry
+                                                in os.scandir(parent)
+                                                if entry.is_dir())
+            except OSError:   # Parent does not exist (yet)
+                self.dir_listings[parent] = set()
+        return name in self.dir_listings[parent]
+
+    def make_dir(self, dirname):
+        """ Make dirname (and missing parents) on flush()
+        """
+        self.dirs[dirname] = None
+
+    def add_warning(self, warning, item, admonition="WARNING"):
+        """ Collect a warning concerning item (e.g. a sample). Warnings are summarized by get_warning_summaries()
+        """
+        self.warnings.setdefault((admonition, warning), list()).append(item)
+
+    def get_warning_summaries(self):
+        """ Returns a list of (admonition, summary) for the collected warnings and clears them
+        """
+
+        summaries = list()
+        for (admonition, warning), items in self.warnings.items():
+            examples = ", ".join(str(item) for item in items[:SUMMARY_ITEMS])
+            if len(items) > SUMMARY_ITEMS:
+                examples += ", ... ({more} more)".format(more=len(items) - SUMMARY_ITEMS)
+            summaries.append((admonition, "{warning} ({num} times): {examples}\n".format(warning=warning,
+                                                                                       num=len(items),
+                                                                                       examples=examples)))
+        self.warnings = dict()
+
+        return summaries
+
+    def update(self, other_writer):
+        """ Adds the pending writes of other_writer (e.g. a step's writer) to this writer, and clears other_writer
+        """
+
+        for filename, texts in other_writer.appends.items():
+            self.appends.setdefault(filename, list()).extend(texts)
+        self.dirs.update(other_writer.dirs)
+        other_writer.appends = dict()
+        other_writer.dirs = dict()
+        other_writer.dir_listings = dict()
+
+    def flush(self):
+        """ Make the dirs and write the appends
+        """
+
+        for dirname in self.dirs:
+            os.makedirs(dirname, exist_ok=True)
+        self.dirs = dict()
+        self.dir_listings = dict()
+
+        for filename, texts in self.appends.items():
+            with open(filename, "a") as file_fh:
+                file_fh.write("".join(texts))
+        self.appends = dict()
@@ -2,6 +2,9 @@ __author__ = "Menachem Sklarz"
 __version__ = "1.6.0"
 
 
+import os
+
+
 ZIPPED_EXTENSIONS = ".bz2 .F .gz .lz .lzma .lzo .rz .sfark .sz .xz .z .Z .infl .dsrc2".split(" ")
 
 
@@ -11,3 +14,24 @@ ARCHIVE_EXTENSIONS = ".7z .s7z .ace .afa .alz .apk .arc .arj .b1 .ba .bh .cab .c
 
 
 KNOWN_FILE_EXTENSIONS = ".g.vcf .fastq .fasta .fa .fq .fna .faa .vlc .sam .bam".split(" ")
+
+
+# Environment variable for keeping the caches in a different dir
+CACHE_DIR_ENV_VAR = "NEATSEQ_FLOW_CACHE_DIR"
+
+
+def get_cache_dir():
+    """ The dir for caches kept between runs (e.g. the module index): $NEATSEQ_FLOW_CACHE_DIR, if set. Otherwise,
+        $XDG_CACHE_HOME/neatseq_flow or ~/.cache/neatseq_flow
+    """
+    if os.environ.get(CACHE_DIR_ENV_VAR):
+        return os.path.expanduser(os.environ[CACHE_DIR_ENV_VAR])
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                        "neatseq_flow")
+
+
+# Defaults of the 'submit_pacing' global parameter (see ScriptConstructor.get_helper_script()):
+#   rate         Maximum number of jobs submitted per second. 0 for no limit
+#   retries      Number of attempts to submit a job when the job manager reports an error (e.g. a queue limit)
+#   backoff      Seconds to wait before the first retry. Doubled on every retry, up to max_backoff
+SUBMIT_PACING_DEFAULTS = {"rate": 0, "retries": 10, "backoff": 5, "max_backoff": 300}
@@ -0,0 +1,139 @@
+""" The jobs of a workflow and the dependencies between them
+
+The jobs are read from script_index, and their dependencies from depend_index. For jobs without entries in depend_index
+(preliminary and wrapping_up jobs), the dependencies are read from the '#$ -hold_jid' line of the job's script, as done
+by NSF_exec.sh. Used by the local scheduler and by the recovery of failed runs (see local_scheduler.py and recovery.py).
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import re
+import fnmatch
+
+
+# The separator of the parts of job names (see Step.jid_name_sep)
+JID_NAME_SEP = ".."
+
+
+class Job(object):
+    """ A job in script_index. High level jobs are the jobs named step..name..run_code
+    """
+
+    def __init__(self, job_id, path, order):
+
+        self.id = job_id
+        self.path = path
+        self.order = order
+        parts = job_id.split(JID_NAME_SEP)
+        self.module, self.instance = parts[0], parts[1]
+        self.level = "high" if len(parts) == 3 else "low"
+        # The high level job of a low level job
+        self.high = JID_NAME_SEP.join([parts[0], parts[1], parts[-1]])
+        # Glob names of the jobs this job depends on, from depend_index
+        self.globs = list()
+        # Number of jobs this job is waiting for (low level) or of unfinished jobs of the step (high level)
+        self.waiting = 0
+        self.dependents = list()
+        # Used by the local scheduler:
+        # waiting, running, done, ERROR or killed
+        self.state = "waiting"
+        self.process = None
+        # Requested cpus and memory (MB)
+        self.cpus = 1
+        self.mem = 0
+        # Time the job became ready to run
+        self.ready_time = None
+
+
+class JobGraph(object):
+    """ The jobs in script_index, with the jobs each low level job waits for (Job.waiting) and the jobs waiting for
+        each job (Job.dependents). If steps is passed, only the jobs of these steps are loaded.
+    """
+
+    def __init__(self, pipe_data, steps=None):
+
+        self.pipe_data = pipe_data
+        # {job id: Job}, in script_index order
+        self.jobs = dict()
+        # {step..name: list of job ids}, for matching glob names
+        self.step_jobs = dict()
+        self.load_jobs(steps)
+        self.load_dependencies()
+
+    def load_jobs(self, steps):
+
+        with open(self.pipe_data["script_index"], "r") as script_index_fh:
+            for line in script_index_fh:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 2:
+                    continue
+                job = Job(fields[0], fields[1], len(self.jobs))
+                if steps and job.instance not in steps:
+                    continue
+                if job.id not in self.jobs:
+                    self.step_jobs.setdefault(JID_NAME_SEP.join([job.module, job.instance]), list()).append(job.id)
+                self.jobs[job.id] = job
+
+        if steps:
+            missing = set(steps) - set(job.instance for job in self.jobs.values())
+            if missing:
+                raise Exception("Steps not found in the workflow: {steps}".format(steps=", ".join(sorted(missing))),
+                                "parameters")
+
+    def get_hold_jids(self, job):
+        """ Returns the jobs in the '#$ -hold_jid' line of the job's script
+        """
+
+        try:
+            with open(job.path, "r") as script_fh:
+                for line in script_fh:
+                    if line.startswith("#$ -hold_jid"):
+                        return line.split()[2].split(",")
+                    if line.strip() and not line.startswith("#"):
+                        break
+        except (IOError, OSError):   # Reported when trying to execute the script
+            pass
+        return list()
+
+    def match_glob(self, glob):
+        """ Returns the ids of the jobs matching a glob name (e.g. step..name..*run_code)
+        """
+
+        if not re.search(r"[*?\[]", glob):
+            return [glob] if glob in self.jobs else []
+        prefix = re.split(r"[*?\[]", glob)[0].split(JID_NAME_SEP)
+        if len(prefix) > 2:
+            candidates = self.step_jobs.get(JID_NAME_SEP.join(prefix[:2]), [])
+        else:
+            candidates = self.jobs
+        return [job_id for job_id in candidates if fnmatch.fnmatchcase(job_id, glob)]
+
+    def load_dependencies(self):
+        """ Sets the jobs each low level job waits for, and the number of jobs of each high level job.
+            Jobs not in the workflow (or in steps not run) are not waited for.
+        """
+
+        with open(self.pipe_data["depend_index"], "r") as depend_index_fh:
+            for line in depend_index_fh:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 2 and fields[1] in self.jobs:
+                    self.jobs[fields[1]].globs.append(fields[0])
+
+        glob_matches = dict()
+        for job in self.jobs.values():
+            if job.level == "high":
+                continue
+            if job.high in self.jobs:
+                self.jobs[job.high].waiting += 1
+            depends = set()
+            for glob in job.globs or self.get_hold_jids(job):
+                if glob not in glob_matches:
+                    glob_matches[glob] = self.match_glob(glob)
+                depends.update(glob_matches[glob])
+            # A job's own high level job finishes only after it
+            depends.difference_update([job.id, job.high])
+            job.waiting = len(depends)
+            for depend_id in depends:
+                self.jobs[depend_id].dependents.append(job.id)
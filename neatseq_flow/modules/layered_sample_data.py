@@ -0,0 +1,362 @@
+""" Copy-on-write, layered sample_data
+
+A step's sample_data is an overlay on top of the sample_data of its bases: Reading a key returns the value set in the
+overlay or, if not set there, the value in the first base defining it. Writing and deleting only touch the overlay, so
+the sample_data of the bases is never copied and never modified.
+Nested dicts (samples, project_data, grouping etc.) are overlaid in the same way when first read, and other mutable
+values (e.g. lists of files) are copied into the overlay when first read, so that
+self.sample_data[sample][slot] can be read, set, deleted and modified in place as with a regular dict.
+String keys and values are interned, so that file names repeated across steps are stored once.
+Since changes are only made in the overlay, they can be listed without comparing the whole data with its bases (see
+get_changes(). Used for updating the provenance).
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import sys
+from copy import deepcopy
+from collections.abc import Mapping, MutableMapping
+
+
+IMMUTABLE_TYPES = (str, int, float, bool, type(None), tuple, frozenset)
+# Marks keys not found in an overlay in the memo of a lookup (see LayeredSampleData._get_raw())
+MISSING = object()
+
+
+def intern_value(value):
+    """ Interns a string, or the strings in a list (in place)
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        value[:] = [sys.intern(item) if isinstance(item, str) else item for item in value]
+    return value
+
+
+def copy_value(value):
+    """ Returns a copy of a mutable, non-dict value. Lists of immutables are copied shallowly.
+    """
+    if isinstance(value, list) and all(isinstance(item, IMMUTABLE_TYPES) for item in value):
+        return list(value)
+    return deepcopy(value)
+
+
+def is_mapping(value):
+    """ Fast check for dicts, falling back on the (slow) abstract class check
+    """
+    return type(value) is dict or isinstance(value, Mapping)
+
+
+def get_raw_value(mapping, key):
+    """ Returns mapping[key] without copying or caching anything. Raises KeyError
+        Mappings defining get_raw() (layered and stored sample_data) are read with it.
+    """
+    if type(mapping) is dict:
+        return mapping[key]
+    if hasattr(mapping, "get_raw"):
+        return mapping.get_raw(key)
+    return mapping[key]
+
+
+def find_base_conflicts(base_list):
+    """ Yields (base index, key) for every key whose value in a base in base_list differs from its value in the previous
+        bases, and is therefore hidden when layering over base_list.
+    """
+    for base_ind in range(1, len(base_list)):
+        for key in _find_conflicts(LayeredSampleData(base_list[:base_ind], read_only=True), base_list[base_ind]):
+            yield base_ind, key
+
+
+def _find_conflicts(mapping, other_mapping):
+
+    for key in other_mapping:
+        if key not in mapping:
+            continue
+        value = get_raw_value(mapping, key)
+        other_value = get_raw_value(other_mapping, key)
+        if is_mapping(value) and is_mapping(other_value):
+            for conflict in _find_conflicts(value, other_value):
+                yield conflict
+        elif value != other_value:
+            yield key
+
+
+def json_default(obj):
+    """ Passed as 'default' to json.dumps() for encoding layered and stored sample_data
+    """
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError("Object of type {type} is not JSON serializable".format(type=type(obj).__name__))
+
+
+class LayeredSampleData(MutableMapping):
+    """ A dict-like overlay on a list of base mappings (dicts or other LayeredSampleData).
+        When more than one base defines a key, the value in the first base is used. If the values are dicts,
+        they are merged in the same way.
+        If read_only is True, the overlay can not be modified and nothing is cached in it. Mutable values read from
+        it are copies.
+    """
+
+    def __init__(self, bases=None, read_only=False):
+
+        self._local = dict()
+        self._deleted = set()
+        # Keys set in the overlay (as opposed to values cached in self._local when read)
+        self._written = set()
+        self._read_only = read_only
+        # Overlays with nothing set in them are transparent. Using their bases directly.
+        # A base appearing more than once (e.g. a common ancestor of two bases) is kept only where it first appears.
+        # Since the first base defining a key is used, this does not change the data, but keeps the list from growing
+        # exponentially when steps have several bases with common ancestors.
+        self._bases = list()
+        base_ids = set()
+        for base in bases or []:
+            if isinstance(base, LayeredSampleData) and not base._local and not base._deleted:
+                new_bases = base._bases
+            else:
+                new_bases = [base]
+            for new_base in new_bases:
+                if id(new_base) not in base_ids:
+                    base_ids.add(id(new_base))
+                    self._bases.append(new_base)
+
+    def get_raw(self, key):
+        """ Returns the value of key without copying or caching. Dicts defined in more than one base are returned as a
+            read-only overlay. The value must not be modified. Raises KeyError
+        """
+
+        return self._get_raw(key, dict())
+
+    def _get_raw(self, key, memo):
+        """ memo holds the values of key in the overlays already searched in the current lookup, by id. When steps have
+            several bases with common ancestors, the same overlays are reached through several bases. Without the memo,
+            the lookup time grows exponentially with the number of such steps.
+        """
+
+        if key in self._local:
+            return self._local[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        if id(self) not in memo:
+            try:
+                value = self._get_base_value(key, memo)
+            except KeyError:
+                value = MISSING
+            # Keeping self, so that its id is not reused during the lookup
+            memo[id(self)] = (self, value)
+        value = memo[id(self)][1]
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def _get_base_value(self, key, memo=None):
+        """ Returns the raw value of key in the bases. Raises KeyError
+        """
+
+        if memo is None:
+            memo = dict()
+        values = list()
+        for base in self._bases:
+            try:
+                if isinstance(base, LayeredSampleData):
+                    value = base._get_raw(key, memo)
+                else:
+                    value = get_raw_value(base, key)
+            except KeyError:
+                continue
+            if values or is_mapping(value):
+                if is_mapping(value):
+                    values.append(value)
+            else:   # First base defining key has a non-dict value. Using it
+                return value
+        if not values:
+            raise KeyError(key)
+        if len(values) == 1:
+            return values[0]
+
+        return LayeredSampleData(values, read_only=True)
+
+    def __getitem__(self, key):
+
+        if key in self._local:
+            return self._local[key]
+
+        value = self.get_raw(key)
+        if is_mapping(value):
+            value = LayeredSampleData([value], read_only=self._read_only)
+        elif isinstance(value, IMMUTABLE_TYPES):
+            return value
+        else:
+            value = copy_value(value)
+
+        if not self._read_only:
+            # Keep the overlay (or copy) so that changes made to it are kept
+            self._local[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+
+        if self._read_only:
+            raise TypeError("Sample data of base steps can not be modified (key '{key}')".format(key=key))
+        self._deleted.discard(key)
+        key = intern_value(key)
+        self._written.add(key)
+        self._local[key] = intern_value(value)
+
+    def __delitem__(self, key):
+
+        if self._read_only:
+            raise TypeError("Sample data of base steps can not be modified (key '{key}')".format(key=key))
+        if key not in self:
+            raise KeyError(key)
+        self._local.pop(key, None)
+        self._written.discard(key)
+        if any(key in base for base in self._bases):
+            self._deleted.add(key)
+
+    def get_changes(self):
+        """ Returns a dict of the keys set, deleted or modified in the overlay (i.e. whose values may differ from the
+            values in the bases).
+            For nested overlays that were modified (and not set), the value is the list of changed keys in the nested
+            overlay. Otherwise, the value is None.
+            Keys are ordered as in the overlay, followed by the deleted keys (sorted), so that the order does not
+            depend on set ordering.
+        """
+
+        changes = dict()
+        for key, value in self._local.items():
+            if key in self._written:
+                changes[key] = None
+                continue
+            # Value was cached when read. Checking if it was modified since
+            if isinstance(value, LayeredSampleData):
+                nested_changes = value.get_changes()
+                if nested_changes:
+                    changes[key] = list(nested_changes)
+            elif value != self._get_base_value(key):
+                changes[key] = None
+        for key in sorted(self._deleted, key=str):
+            changes[key] = None
+
+        return changes
+
+    def get_state(self):
+        """ Returns the contents of the overlay, without the bases, as a tuple of picklable data.
+            Nested overlays cached in the overlay are returned as their own state. See set_state()
+        """
+
+        local = list()
+        for key, value in self._local.items():
+            if isinstance(value, LayeredSampleData):
+                if key not in self._written:
+                    local.append((key, True, value.get_state()))
+                    continue
+                # An overlay set from elsewhere. Its bases are not those of key, so passing its contents:
+                value = value.to_dict()
+            local.append((key, False, value))
+
+        return local, self._deleted, self._written
+
+    def set_state(self, state):
+        """ Sets the contents of the overlay to a state returned by get_state() of an overlay with the same bases
+            (e.g. a copy of this overlay in a different process)
+        """
+
+        local, self._deleted, self._written = state
+        self._local = dict()
+        for key, is_nested, value in local:
+            if is_nested:
+                nested_value = LayeredSampleData([self._get_base_value(key)], read_only=self._read_only)
+                nested_value.set_state(value)
+                value = nested_value
+            else:
+                value = intern_value(value)
+            self._local[intern_value(key)] = value
+
+    def __contains__(self, key):
+
+        return self._contains(key, set())
+
+    def _contains(self, key, searched):
+        """ searched holds the overlays already searched in the current lookup, i.e. which do not contain key (see
+            _get_raw())
+        """
+
+        if key in self._local:
+            return True
+        if key in self._deleted or id(self) in searched:
+            return False
+        for base in self._bases:
+            if isinstance(base, LayeredSampleData):
+                if base._contains(key, searched):
+                    return True
+            elif key in base:
+                return True
+        searched.add(id(self))
+        return False
+
+    def __iter__(self):
+        return iter(self.get_keys())
+
+    def __len__(self):
+        return len(self.get_keys())
+
+    def get_keys(self, memo=None):
+        """ Returns the keys as a dict (with None values). Keys are ordered as in the bases, followed by keys added
+            in the overlay
+            memo holds the keys of the overlays already listed in the current call, by id (see _get_raw())
+        """
+        if memo is None:
+            keys = dict()
+            if self._collect_keys(keys, set()):
+                return keys
+            memo = dict()
+        if id(self) in memo:
+            return memo[id(self)][1]
+        keys = dict()
+        for base in self._bases:
+            keys.update(dict.fromkeys(base.get_keys(memo) if isinstance(base, LayeredSampleData) else base))
+        for key in self._deleted:
+            keys.pop(key, None)
+        keys.update(dict.fromkeys(self._local))
+        memo[id(self)] = (self, keys)
+        return keys
+
+    def _collect_keys(self, keys, listed):
+        """ Adds the keys of the overlay to keys, listing each base once (listed holds the ids of the bases already
+            listed). This gives the keys in the same order as get_keys(), as long as no keys were deleted.
+            Returns False, leaving keys incomplete, if keys were deleted in the overlay or in one of its bases.
+        """
+        if id(self) in listed:
+            return True
+        listed.add(id(self))
+        if self._deleted:
+            return False
+        for base in self._bases:
+            if id(base) in listed:
+                continue
+            if isinstance(base, LayeredSampleData):
+                if not base._collect_keys(keys, listed):
+                    return False
+            else:
+                listed.add(id(base))
+                keys.update(dict.fromkeys(base))
+        keys.update(dict.fromkeys(self._local))
+        return True
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __deepcopy__(self, memo):
+        return deepcopy(self.to_dict(), memo)
+
+    def to_dict(self):
+        """ Returns the data as a regular (nested) dict. Non-dict values are not copied.
+        """
+        result = dict()
+        for key in self:
+            value = self.get_raw(key)
+            result[key] = value.to_dict() if hasattr(value, "to_dict") else value
+        return result
@@ -0,0 +1,476 @@
+""" A scheduler for running workflows built for the Local executor
+
+With the Local executor, 00.workflow.commands.sh starts an NSF_exec.sh process for every job. Each of these waits for
+the job's dependencies by checking their state every 3 seconds. The scheduler runs the whole workflow from a single
+asyncio process instead:
+
+    * The jobs are read from script_index, and their dependencies from depend_index. For jobs without entries in
+      depend_index (preliminary and wrapping_up jobs), the dependencies are read from the '#$ -hold_jid' line of the
+      job's script, as done by NSF_exec.sh.
+    * Each low level script is started as soon as the jobs it depends on have finished, and its process is waited on
+      directly.
+    * High level scripts are not executed (they only start the low level scripts). Their state is kept by the
+      scheduler: a high level job starts with its first low level job and finishes when all of them have finished.
+
+The formats of run_index and of the log file are kept, so that the kill scripts and neatseq_flow_monitor.py work as
+with 00.workflow.commands.sh. As with NSF_exec.sh, a job is executed even if a job it depends on failed.
+
+Jobs are packed onto the cores and memory of the host (or the amounts passed with --cpus and --mem): A job is started
+only if the cpus and memory it requests (see resources.py) are free. Ready jobs are started in script_index order, but
+jobs which fit in the free resources may start before earlier jobs which do not. Once a job has waited more than
+RESERVE_AFTER seconds for resources, no later jobs are started before it. An array job requests the resources of all
+its tasks, as the array script runs them at once. With --enforce_mem, the address space of each job requesting memory
+is limited to the requested memory.
+The number of jobs running at once is limited by -j and by the job_limit file, if defined in the global parameters.
+
+Usage (see scripts/00.workflow.scheduler.sh):
+    python -m neatseq_flow.modules.local_scheduler <objects dir> [-j N] [-s step1 step2 ...] [--cpus N] [--mem SIZE]
+                                                                [--enforce_mem]
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import re
+import sys
+import time
+import heapq
+import signal
+import socket
+import asyncio
+import argparse
+
+try:
+    import resource
+except ImportError:     # Not available on Windows. Memory is not enforced
+    resource = None
+
+from .workflow_json import load_index, get_step_data
+from .resources import get_step_resources, parse_mem
+from .run_journal import append_records, compact as compact_run_index
+from .job_graph import JobGraph, JID_NAME_SEP
+
+
+# Seconds between checks for the killall file and for changes in the job_limit file
+POLL_INTERVAL = 1
+# Minimal seconds between writes to the run_index journal, and between compactions of run_index
+FLUSH_INTERVAL = 0.5
+COMPACT_INTERVAL = 10
+# Seconds a job waits for resources before later jobs stop being started before it
+RESERVE_AFTER = 60
+# Final states of jobs in run_index
+FINAL_STATES = ["done", "ERROR", "killed"]
+LOG_STATUS_OK = "\033[0;32mOK\033[m"
+
+
+class RunIndex(object):
+    """ Collects the changes in the states of jobs and appends them to the run_index journal in a single write.
+        run_index itself is compacted every COMPACT_INTERVAL seconds (see run_journal.py).
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        # list of (job id, state, pid) in order of setting
+        self.pending = list()
+        self.last_flush = 0
+        self.last_compact = 0
+
+    def set_state(self, job_id, state, pid=None):
+        """ Sets the state of a job: 'hold', 'running', 'PID' (with pid) or a final state (see FINAL_STATES). The
+            changes are applied to run_index by the rules in run_journal.apply_record()
+        """
+
+        self.pending.append((job_id, state, pid))
+
+    def flush(self, compact=False):
+        """ Writes the pending changes to the journal, and compacts run_index if COMPACT_INTERVAL seconds passed since
+            the last compaction, or if compact is set. Returns False if run_index does not exist
+        """
+
+        self.last_flush = time.time()
+        if not os.path.isfile(self.filename):
+            return False
+        append_records(self.filename, self.pending)
+        self.pending = list()
+        if compact or self.last_flush - self.last_compact >= COMPACT_INTERVAL:
+            self.last_compact = self.last_flush
+            return compact_run_index(self.filename)
+        return True
+
+
+def get_host_cpus():
+    """ Returns the number of cpus the scheduler can use
+    """
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on all platforms
+        return os.cpu_count() or 1
+
+
+def get_host_mem():
+    """ Returns the physical memory of the host in MB, or 0 if not available
+    """
+
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+class LocalScheduler(JobGraph):
+    """ Runs the jobs of a workflow built for the Local executor (see module docstring)
+        cpus and mem (MB) are the resources to pack the jobs onto. None for the host's resources, 0 for not limiting
+        by the resource.
+    """
+
+    def __init__(self, objects_dir, max_jobs=0, steps=None, cpus=None, mem=None, enforce_mem=False):
+
+        index, objects_dir = load_index(objects_dir)
+        self.pipe_data = index["pipe_data"]
+        if self.pipe_data["Executor"] != "Local":
+            raise Exception("The workflow was built for the {executor} executor. The scheduler runs only workflows "
+                            "built for the Local executor".format(executor=self.pipe_data["Executor"]), "parameters")
+        self.max_jobs = max_jobs
+        self.hostname = socket.gethostname()
+        self.run_index = RunIndex(self.pipe_data["run_index"])
+
+        super(LocalScheduler, self).__init__(self.pipe_data, steps)
+
+        self.cpus = get_host_cpus() if cpus is None else cpus
+        self.mem = get_host_mem() if mem is None else mem
+        self.enforce_mem = enforce_mem and resource is not None
+        self.used_cpus = 0
+        self.used_mem = 0
+        self.load_resources(index, objects_dir)
+
+        # Low level jobs ready to run, by the resources they request: {(cpus, mem): heap of (order, job id)}
+        self.ready = dict()
+        self.running = 0
+        self.unfinished = len(self.jobs)
+        self.failed = 0
+        self.stopped = False
+        self.wakeup = None
+
+    def load_resources(self, index, objects_dir):
+        """ Sets the cpus and memory requested by each low level job, from its step's parameters.
+            Requests larger than the resources available are reduced to the available resources (the job then runs
+            alone).
+        """
+
+        step_resources = dict()
+        for job in self.jobs.values():
+            if job.level == "high":
+                continue
+            if job.instance not in step_resources:
+                try:
+                    step_resources[job.instance] = get_step_resources(
+                        get_step_data(index, objects_dir, job.instance)["param_data"])
+                except (KeyError, ValueError, IOError, OSError) as exc:
+                    sys.stderr.write("WARNING: Can't read the resources of step {step} ({exc}). Using 1 cpu\n".
+                                     format(step=job.instance, exc=exc))
+                    step_resources[job.instance] = (1, 0)
+            job.cpus, job.mem = step_resources[job.instance]
+            manifest = os.path.splitext(job.path)[0] + ".manifest"
+            if job.id.split(JID_NAME_SEP)[2] == "array" and os.path.isfile(manifest):
+                with open(manifest, "r") as manifest_fh:
+                    num_tasks = sum(1 for line in manifest_fh if line.strip())
+                job.cpus, job.mem = job.cpus * max(num_tasks, 1), job.mem * max(num_tasks, 1)
+            if self.cpus and job.cpus > self.cpus:
+                job.cpus = self.cpus
+            if self.mem and job.mem > self.mem:
+                job.mem = self.mem
+
+        for step, (cpus, mem) in step_resources.items():
+            if (self.cpus and cpus > self.cpus) or (self.mem and mem > self.mem):
+                sys.stderr.write("WARNING: The jobs of step {step} request more than the available {cpus} cpus and "
+                                 "{mem}MB memory. Running them one at a time\n".format(step=step,
+                                                                                          cpus=self.cpus,
+                                                                                          mem=self.mem))
+
+    def add_ready(self, job):
+
+        job.ready_time = time.time()
+        heapq.heappush(self.ready.setdefault((job.cpus, job.mem), list()), (job.order, job.id))
+
+    def fits(self, job):
+        """ Returns True if the resources job requests are free
+        """
+
+        return (not self.cpus or self.used_cpus + job.cpus <= self.cpus) and \
+               (not self.mem or self.used_mem + job.mem <= self.mem)
+
+    def get_next_job(self):
+        """ Removes from the ready jobs and returns the first ready job which fits in the free resources. Returns None
+            if no job fits, or if the first ready job has waited more than RESERVE_AFTER seconds for resources.
+            The jobs requesting the same resources are held in the same heap, so only the first job of each is checked.
+        """
+
+        for order, job_id in sorted(heap[0] for heap in self.ready.values()):
+            job = self.jobs[job_id]
+            if self.fits(job):
+                key = (job.cpus, job.mem)
+                heapq.heappop(self.ready[key])
+                if not self.ready[key]:
+                    del self.ready[key]
+                return job
+            if time.time() - job.ready_time > RESERVE_AFTER:
+                return None
+        return None
+
+    def write_log_lines(self, lines):
+        """ Writes lines to the log file. lines is a list of (event, job, level) tuples
+        """
+
+        date = time.strftime("%d/%m/%Y %H:%M:%S")
+        with open(self.pipe_data["log_file"], "a") as log_fh:
+            for event, job, level in lines:
+                log_fh.write("\t".join([date, event, job.module, job.instance, job.id, level, self.hostname,
+                                        str(os.getpid()), "-", LOG_STATUS_OK]) + "\n")
+
+    def get_job_limit(self):
+        """ Returns the maximal number of low level jobs to run at once, from -j and the job_limit file. None if not
+            limited. The job_limit file is read every time, so that the limit can be changed while running.
+        """
+
+        limits = [self.max_jobs] if self.max_jobs else []
+        if "job_limit" in self.pipe_data:
+            try:
+                with open(self.pipe_data["job_limit"], "r") as job_limit_fh:
+                    match = re.search(r"limit=(\d+)", job_limit_fh.read())
+                if match:
+                    limits.append(int(match.group(1)))
+            except (IOError, OSError):
+                pass
+        return min(limits) if limits else None
+
+    def start_job(self, job):
+        """ Marks the job and its high level job as running, and returns the task executing it
+        """
+
+        job.state = "running"
+        self.running += 1
+        self.used_cpus += job.cpus
+        self.used_mem += job.mem
+        high = self.jobs.get(job.high)
+        if high is not None and high.state == "waiting":
+            high.state = "running"
+            self.run_index.set_state(high.id, "running")
+            self.write_log_lines([("Started", high, "high")])
+        return asyncio.ensure_future(self.execute_job(job))
+
+    async def execute_job(self, job):
+
+        sys.stdout.write("running {id}\n".format(id=job.id))
+        sys.stdout.flush()
+        stdout_fh = open("{dir}{id}.o".format(dir=self.pipe_data["stdout_dir"], id=job.id), "w")
+        stderr_fh = open("{dir}{id}.e".format(dir=self.pipe_data["stderr_dir"], id=job.id), "w")
+        stdout_fh.write("Running job:  {id}\nRunning script:  {path}\n".format(id=job.id, path=job.path))
+        stdout_fh.flush()
+        try:
+            # Each job in its own process group, so that the kill scripts kill only the job
+            job.process = await asyncio.create_subprocess_exec("csh" if "csh" in job.path else "bash", job.path,
+                                                               stdout=stdout_fh,
+                                                               stderr=stderr_fh,
+                                                               start_new_session=True,
+                                                               preexec_fn=self.get_mem_limiter(job))
+        except OSError as exc:
+            stderr_fh.write("Failed to start {path}: {exc}\n".format(path=job.path, exc=exc))
+            self.finish_job(job, 1)
+            return
+        finally:
+            stdout_fh.close()
+            stderr_fh.close()
+        self.run_index.set_state(job.id, "PID", job.process.pid)
+        self.finish_job(job, await job.process.wait())
+
+    def get_mem_limiter(self, job):
+        """ Returns a function limiting the address space of the job's process to the memory it requested, or None if
+            memory is not enforced
+        """
+
+        if not self.enforce_mem or not job.mem:
+            return None
+        mem_bytes = job.mem * 1024 * 1024
+
+        def limit_mem():
+            resource.setrlimit(resource.RLIMIT_AS, (mem_bytes, mem_bytes))
+        return limit_mem
+
+    def finish_job(self, job, returncode):
+
+        self.running -= 1
+        self.used_cpus -= job.cpus
+        self.used_mem -= job.mem
+        self.unfinished -= 1
+        if returncode == 0:
+            job.state = "done"
+        else:
+            job.state = "killed" if returncode < 0 else "ERROR"
+            self.failed += 1
+        self.run_index.set_state(job.id, job.state)
+
+        self.release_dependents(job)
+        high = self.jobs.get(job.high)
+        if high is not None:
+            high.waiting -= 1
+            if high.waiting == 0 and high.state not in FINAL_STATES:
+                self.finish_high_job(high)
+        self.wakeup.set()
+
+    def release_dependents(self, job):
+        """ Adds the jobs waiting only for job to the jobs ready to run
+        """
+
+        for dependent_id in job.dependents:
+            dependent = self.jobs[dependent_id]
+            dependent.waiting -= 1
+            if dependent.waiting == 0 and dependent.state == "waiting":
+                self.add_ready(dependent)
+
+    def finish_high_job(self, high):
+
+        if high.state == "waiting":
+            self.write_log_lines([("Started", high, "high")])
+        high.state = "done"
+        self.unfinished -= 1
+        self.write_log_lines([("Finished", high, "high")])
+        self.run_index.set_state(high.id, "done")
+        self.release_dependents(high)
+
+    def stop(self, message, terminate=False):
+        """ Stops starting jobs. Jobs not started are marked as killed. With terminate, running jobs are terminated
+        """
+
+        if self.stopped:
+            return
+        self.stopped = True
+        sys.stderr.write(message + "\n")
+        for job in self.jobs.values():
+            if job.state == "waiting" or (job.level == "high" and job.state == "running"):
+                job.state = "killed"
+                self.unfinished -= 1
+                self.run_index.set_state(job.id, "killed")
+            elif job.state == "running" and terminate and job.process is not None:
+                try:
+                    os.killpg(job.process.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        self.ready = dict()
+        self.wakeup.set()
+
+    def check_killall(self):
+
+        if os.path.exists(self.pipe_data["run_index"] + ".killall"):
+            self.stop("{run_index}.killall file created. Stopping all waiting jobs.\nMake sure you delete the file "
+                      "before re-running!".format(run_index=self.pipe_data["run_index"]))
+
+    async def run(self):
+        """ Runs the jobs. Returns True if all jobs finished successfully
+        """
+
+        self.wakeup = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, self.stop, "Terminated. Stopping all jobs", True)
+
+        self.check_killall()
+        if not self.stopped:
+            jobs = sorted(self.jobs.values(), key=lambda job: job.order)
+            for job in jobs:
+                self.run_index.set_state(job.id, "hold")
+            self.write_log_lines([("Started", job, "Queue") for job in jobs if job.level == "low"])
+            for job in jobs:
+                if job.level == "low" and job.waiting == 0:
+                    self.add_ready(job)
+            # High level jobs without low level jobs are done
+            for job in jobs:
+                if job.level == "high" and job.waiting == 0:
+                    self.finish_high_job(job)
+        if not self.run_index.flush():
+            raise Exception("run_index file {run_index} not found".format(run_index=self.pipe_data["run_index"]),
+                            "parameters")
+
+        tasks = list()
+        while self.unfinished > 0:
+            limit = self.get_job_limit()
+            while self.ready and not self.stopped and (limit is None or self.running < limit):
+                job = self.get_next_job()
+                if job is None:
+                    break
+                tasks.append(self.start_job(job))
+            if time.time() - self.run_index.last_flush >= FLUSH_INTERVAL and not self.run_index.flush():
+                self.stop("{run_index} file deleted. Stopping all waiting jobs".
+                          format(run_index=self.pipe_data["run_index"]))
+            if self.unfinished > 0 and not self.running and not self.ready:
+                # Can only happen if the dependencies are circular
+                self.stop("No jobs can be started. Check the dependencies in {depend_index}".
+                          format(depend_index=self.pipe_data["depend_index"]))
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.check_killall()
+
+        if tasks:
+            await asyncio.wait(tasks)
+        self.run_index.flush(compact=True)
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.remove_signal_handler(signum)
+
+        return not (self.failed or self.stopped)
+
+
+def mem_arg(value):
+
+    try:
+        return parse_mem(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description="Run a workflow built for the Local executor. Jobs are started as "
+                                                 "soon as the jobs they depend on have finished.")
+    parser.add_argument("objects_dir", help="The objects dir of the workflow (or the path to its WorkflowData.json)")
+    parser.add_argument("-j", "--jobs", help="Maximal number of jobs to run at once. Default: 0 (no limit)",
+                        type=int, default=0)
+    parser.add_argument("-s", "--steps", help="Run only these steps", nargs="+")
+    parser.add_argument("--cpus", help="Number of cpus to pack the jobs onto. Default: the host's cpus. 0: Do not "
+                                       "limit by cpus", type=int)
+    parser.add_argument("--mem", help="Memory to pack the jobs onto, e.g. 200G. Default: the host's memory. 0: Do not "
+                                      "limit by memory", type=mem_arg)
+    parser.add_argument("--enforce_mem", help="Limit the memory of jobs requesting memory to the requested memory",
+                        action="store_true")
+    args = parser.parse_args(args)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        scheduler = LocalScheduler(args.objects_dir,
+                                   max_jobs=args.jobs,
+                                   steps=args.steps,
+                                   cpus=args.cpus,
+                                   mem=args.mem,
+                                   enforce_mem=args.enforce_mem)
+        success = loop.run_until_complete(scheduler.run())
+    except Exception as raisedex:
+        if len(raisedex.args) > 1 and raisedex.args[1] == "parameters":
+            sys.exit(raisedex.args[0])
+        raise
+    finally:
+        loop.close()
+    sys.stdout.write("Finished: {done} jobs done, {failed} failed\n".format(
+        done=sum(1 for job in scheduler.jobs.values() if job.level == "low" and job.state == "done"),
+        failed=scheduler.failed))
+    sys.exit(0 if success else 1)
+
+
+if __name__ == "__main__":
+    main()
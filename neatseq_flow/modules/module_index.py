@@ -0,0 +1,188 @@
+""" A persistent index of the step modules in the module paths
+
+Finding the module of a step requires walking the module paths and the built-in step_classes tree, and listing the
+available modules and their modifiers requires reading the module files. On network storage, doing this for every step
+is slow. The ModuleIndex walks each module path once and stores, for every dir, whether it contains an __init__.py and
+which .py files it contains. For module files, whether they define a Step_<module> class and the parameters they use
+(the step 'modifiers') are stored as well.
+
+The index is saved in the user's cache dir ($XDG_CACHE_HOME/neatseq_flow or ~/.cache/neatseq_flow) and reused on the
+next run:
+    * A module path is walked again if the mtime of any of its dirs changed (i.e. files or dirs were added, removed or
+      renamed in it).
+    * The data read from a module file is read again if the file's mtime or size changed.
+If the cache dir can not be written to, the index is only used for the current run.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import re
+import sys
+import json
+
+from .global_defs import get_cache_dir
+
+MODULE_INDEX_FILENAME = "module_index.json"
+# Parameters used by all modules. Not included in step modifiers
+COMMON_PARAMS = ["redir_params", "qsub_params", "base", "module", "sample_list", "exclude_sample_list", "script_path"]
+
+
+def walkerr(err):
+    """ Helper function for os.walk below. Catches errors during walking and reports on them.
+    """
+    print("WARNING: Error while searching for modules:")
+    print(err)
+
+
+class ModuleIndex(object):
+    """ The dirs and module files in the module paths. Use ModuleIndex.get_index() to get the index of the current run.
+    """
+
+    # The index of the current run, shared by all steps
+    current_index = None
+
+    @classmethod
+    def get_index(cls):
+
+        if cls.current_index is None:
+            cls.current_index = cls()
+        return cls.current_index
+
+    def __init__(self, filename=None):
+
+        self.filename = filename or os.path.join(get_cache_dir(), MODULE_INDEX_FILENAME)
+        # {module path: {"dirs": list of [relative dir, has __init__.py, list of .py files], "mtimes": {dir: mtime}}}
+        self.paths = dict()
+        # {file: {"mtime": mtime, "size": size, "step_class": str or None, "modifiers": list}}
+        self.files = dict()
+        # Module paths checked against the file system in the current run
+        self.checked_paths = set()
+        self.changed = False
+
+        try:
+            with open(self.filename, "r") as index_fh:
+                index = json.load(index_fh)
+            if index["version"] == __version__:
+                self.paths = index["paths"]
+                self.files = index["files"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            # No index, or index unreadable. Building a new one
+            pass
+
+    def save(self):
+        """ Writes the index if it changed. Failure to write is ignored (the index is then rebuilt on the next run)
+        """
+
+        if not self.changed:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.filename)):
+                os.makedirs(os.path.dirname(self.filename))
+            with open(self.filename + ".%d.tmp" % os.getpid(), "w") as index_fh:
+                json.dump({"version": __version__,
+                           "paths": self.paths,
+                           "files": self.files},
+                          index_fh)
+            os.replace(self.filename + ".%d.tmp" % os.getpid(), self.filename)
+            self.changed = False
+        except (IOError, OSError):
+            pass
+
+    def get_dirs(self, module_path):
+        """ Returns the dirs in module_path in os.walk() order, as a list of [dir relative to module_path ("" for
+            module_path itself), whether dir contains __init__.py, list of .py files in dir].
+            Returns an empty list if module_path could not be walked.
+        """
+
+        if module_path in self.checked_paths:
+            return self.paths[module_path]["dirs"]
+        self.checked_paths.add(module_path)
+
+        if module_path in self.paths:
+            try:
+                if all(os.stat(os.path.join(module_path, dirname)).st_mtime_ns == mtime
+                       for dirname, mtime
+                       in self.paths[module_path]["mtimes"].items()):
+                    return self.paths[module_path]["dirs"]
+            except OSError:   # A dir was removed
+                pass
+
+        dirs = list()
+        mtimes = dict()
+        for level in os.walk(module_path, onerror=walkerr):
+            # level is a tuple with: (current dir. [list of dirs],[list of files])
+            dirname = os.path.relpath(level[0], module_path) if level[0] != module_path else ""
+            dirs.append([dirname,
+                         "__init__.py" in level[2],
+                         [filename for filename in level[2] if filename.endswith(".py")]])
+            try:
+                mtimes[dirname] = os.stat(level[0]).st_mtime_ns
+            except OSError:
+                pass
+        if not dirs:
+            sys.stderr.write("WARNING: Module path {mod_path} seems to be empty! Possibly issue with "
+                             "permissions...\n".format(mod_path=module_path))
+        self.paths[module_path] = {"dirs": dirs, "mtimes": mtimes}
+        self.changed = True
+
+        return dirs
+
+    def find_module(self, module, module_path, require_init=True):
+        """ Returns the dir (relative to module_path) of the first dir containing module.py, or None if not found.
+            If require_init is True, only dirs with an __init__.py are searched (avoid finding modules in non-active
+            dirs).
+        """
+
+        for dirname, has_init, py_files in self.get_dirs(module_path):
+            if module + ".py" in py_files and (has_init or not require_init):
+                return dirname
+        return None
+
+    def get_file_data(self, filename):
+        """ Returns the data read from a module file: The Step class it defines, if any, and the step modifiers (the
+            parameters referenced in self.params)
+        """
+
+        stat = os.stat(filename)
+        if filename in self.files and \
+                self.files[filename]["mtime"] == stat.st_mtime_ns and \
+                self.files[filename]["size"] == stat.st_size:
+            return self.files[filename]
+
+        module = os.path.basename(filename)[:-len(".py")]
+        step_class = None
+        step_params = list()
+        with open(filename, "r") as modfh:
+            for line in modfh:
+                if step_class is None and re.search("class Step_%s" % re.escape(module), line):
+                    step_class = "Step_" + module
+                step_params.extend(re.findall(r'self.params\["(.*?)"\]', line))
+        self.files[filename] = {"mtime": stat.st_mtime_ns,
+                                "size": stat.st_size,
+                                "step_class": step_class,
+                                # Unique list of params, after excluding the ones that are true for all modules
+                                "modifiers": sorted(set(step_params) - set(COMMON_PARAMS))}
+        self.changed = True
+
+        return self.files[filename]
+
+    def get_step_modifiers(self, filename):
+
+        return list(self.get_file_data(filename)["modifiers"])
+
+    def list_modules(self, module_path):
+        """ Returns a dict of the modules (files defining a Step_<module> class) in module_path. The values are the
+            lists of names of the dirs in which each module exists.
+        """
+
+        module_list = dict()
+        for dirname, has_init, py_files in self.get_dirs(module_path):
+            for py_file in py_files:
+                file_data = self.get_file_data(os.path.join(module_path, dirname, py_file))
+                if file_data["step_class"]:
+                    module_list.setdefault(py_file[:-len(".py")], list()).\
+                        append(os.path.basename(os.path.normpath(os.path.join(module_path, dirname))))
+        return module_list
@@ -0,0 +1,265 @@
+""" Building the scripts of independent steps in parallel
+
+Used by NeatSeqFlow.build_scripts() when more than one build job is requested (--jobs).
+Each step is built in a forked worker process as soon as the steps it is based on are registered, so steps on different
+branches of the workflow are built concurrently. The worker creates the step's scripts (Step.create_step_scripts()) and
+sends the resulting step attributes and sample_data changes back to the main process, where they are set on the step.
+The steps are then registered (index files, provenance etc., see Step.register_step_scripts()) in the main process, in
+the order of the step list, so that the output is identical to building the steps one after the other.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import io
+import os
+import sys
+import pickle
+import traceback
+# multiprocessing is imported when building in parallel. Importing it slows down startup.
+
+from ..PLC_step import AssertionExcept
+from ..script_constructors.scriptconstructor import ScriptConstructor
+from .profiler import Measurement
+
+
+def can_fork():
+    """ Worker processes are forked, so that they share the workflow objects with the main process
+    """
+    import multiprocessing
+
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def get_build_jobs(build_jobs):
+    """ Returns the number of build jobs to use. 0 or None means the number of CPUs
+    """
+    if not build_jobs:
+        return os.cpu_count() or 1
+    return build_jobs
+
+
+class StatePickler(pickle.Pickler):
+    """ Pickles objects existing in the main process (steps, the main object, base sample_data etc.) by reference,
+        as their index in shared_objects. Open files and script constructors created in the worker are not passed.
+    """
+
+    def __init__(self, file, shared_objects):
+        super(StatePickler, self).__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.shared_ids = {id(obj): ind for ind, obj in enumerate(shared_objects)}
+
+    def persistent_id(self, obj):
+        if type(obj) is str:
+            return None
+        if id(obj) in self.shared_ids:
+            return "shared", self.shared_ids[id(obj)]
+        if isinstance(obj, (io.IOBase, ScriptConstructor)):
+            return "dropped", None
+        return None
+
+
+class StateUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, shared_objects):
+        super(StateUnpickler, self).__init__(file)
+        self.shared_objects = shared_objects
+
+    def persistent_load(self, pid):
+        kind, ind = pid
+        if kind == "shared":
+            return self.shared_objects[ind]
+        return None
+
+
+def get_shared_objects(main_obj):
+    """ Returns the list of objects which are passed between the main process and the workers by reference
+    """
+
+    shared_objects = [main_obj, main_obj.pipe_data, main_obj.param_data, main_obj.step_graph,
+                      main_obj.global_sample_data]
+    if getattr(main_obj, "sample_data_store", None) is not None:
+        shared_objects.append(main_obj.sample_data_store)
+    shared_objects.extend(main_obj.global_sample_data.values())
+    for step in main_obj.step_list:
+        shared_objects.append(step)
+        shared_objects.extend(getattr(step, attr)
+                              for attr
+                              in ["main_script_obj", "kill_script_obj",
+                                  "sample_data", "provenance", "sample_data_original"]
+                              if getattr(step, attr, None) is not None)
+
+    return shared_objects
+
+
+def get_script_files(step):
+    """ Returns the open files of the step's high level and kill scripts, which are written by the worker
+    """
+
+    return [value
+            for script_obj
+            in [getattr(step, "main_script_obj", None), getattr(step, "kill_script_obj", None)]
+            if script_obj is not None
+            for value
+            in vars(script_obj).values()
+            if isinstance(value, io.IOBase) and not value.closed]
+
+
+def build_step(step, connection, shared_objects):
+    """ Worker process: Creates the step's scripts and sends the step's state to the main process.
+        Sends a tuple of (status, step state or exception, stdout, stderr, profile record)
+    """
+
+    # Output is passed to the main process to be printed in order
+    sys.stdout = io.StringIO()
+    sys.stderr = io.StringIO()
+    # SQLite connections can not be used across a fork
+    sample_data_store = getattr(step.main_pl_obj, "sample_data_store", None)
+    if sample_data_store is not None:
+        sample_data_store.reconnect()
+
+    measurement = Measurement() if step.main_pl_obj.profiler.is_active() else None
+    try:
+        step.create_step_scripts()
+        result = ("built", step.get_build_state())
+    except BaseException as raisedex:
+        if not isinstance(raisedex, (AssertionExcept, SystemExit)):
+            traceback.print_exc()
+        result = ("failed", raisedex)
+    for filehandle in get_script_files(step):
+        filehandle.flush()
+    profile_record = measurement.get_record() if measurement is not None else None
+
+    payload = io.BytesIO()
+    try:
+        StatePickler(payload, shared_objects).dump(result + (sys.stdout.getvalue(),
+                                                             sys.stderr.getvalue(),
+                                                             profile_record))
+    except Exception:
+        payload = io.BytesIO()
+        StatePickler(payload, shared_objects).dump(("failed",
+                                                    Exception("Building step %s failed in worker process:\n%s" %
+                                                              (step.get_step_name(), traceback.format_exc())),
+                                                    sys.stdout.getvalue(),
+                                                    sys.stderr.getvalue(),
+                                                    None))
+    connection.send_bytes(payload.getvalue())
+    connection.close()
+
+
+class ParallelStepBuilder(object):
+    """ Builds the scripts of the steps in main_obj.step_list, up to build_jobs steps at a time.
+    """
+
+    def __init__(self, main_obj, build_jobs):
+
+        import multiprocessing
+
+        self.main_obj = main_obj
+        self.build_jobs = build_jobs
+        self.context = multiprocessing.get_context("fork")
+        # Running workers: {connection: (step name, process, shared_objects)}
+        self.running = dict()
+        self.started = set()
+        self.registered = set()
+        self.results = dict()
+
+    def run(self):
+
+        try:
+            for step in self.main_obj.step_list:
+                name = step.get_step_name()
+                while name not in self.results:
+                    self.start_ready_steps()
+                    self.receive_results()
+                self.register_step(step, self.results.pop(name))
+        finally:
+            self.stop_workers()
+
+    def is_ready(self, step):
+
+        base_name_list = step.get_base_step_name()
+        return base_name_list is None or all(base_name in self.registered for base_name in base_name_list)
+
+    def start_ready_steps(self):
+        """ Start workers for steps whose bases are registered. Steps without scripts are 'built' in the main process.
+            Steps restored from the build cache are not built.
+        """
+
+        for step in self.main_obj.step_list:
+            if len(self.running) >= self.build_jobs:
+                return
+            name = step.get_step_name()
+            if name in self.started or not self.is_ready(step):
+                continue
+            self.started.add(name)
+            # For steps built by a worker, the measurement is replaced by the worker's
+            with self.main_obj.profiler.measure_step(step, "build"):
+                self.main_obj.set_step_base_data(step)
+                if self.main_obj.restore_cached_step(step):
+                    self.results[name] = ("cached", None, "", "", None)
+                elif step.skip_scripts:
+                    step.create_step_scripts()
+                    self.results[name] = ("skipped", None, "", "", None)
+            if name in self.results:
+                continue
+            shared_objects = get_shared_objects(self.main_obj)
+            for filehandle in get_script_files(step):
+                filehandle.flush()
+            reader, writer = self.context.Pipe(duplex=False)
+            process = self.context.Process(target=build_step, args=(step, writer, shared_objects))
+            process.start()
+            writer.close()
+            self.running[reader] = (name, process, shared_objects)
+
+    def receive_results(self):
+        """ Wait for at least one worker to finish and store its result
+        """
+
+        from multiprocessing.connection import wait
+
+        if not self.running:
+            return
+        for reader in wait(list(self.running.keys())):
+            name, process, shared_objects = self.running.pop(reader)
+            try:
+                payload = reader.recv_bytes()
+            except EOFError:
+                payload = None
+            reader.close()
+            process.join()
+            if payload is None:
+                self.results[name] = ("failed",
+                                      Exception("Worker process building step %s exited unexpectedly (exit code %s)" %
+                                                (name, process.exitcode)),
+                                      "",
+                                      "",
+                                      None)
+            else:
+                self.results[name] = StateUnpickler(io.BytesIO(payload), shared_objects).load()
+
+    def register_step(self, step, result):
+
+        status, state, stdout, stderr, profile_record = result
+        sys.stdout.write(stdout)
+        sys.stderr.write(stderr)
+        if status == "failed":
+            raise state
+        if status == "built":
+            step.set_build_state(state)
+            if profile_record is not None:
+                self.main_obj.profiler.add_step_part(step, "build", profile_record)
+        self.main_obj.profiler.set_step_status(step, status)
+        with self.main_obj.profiler.measure_step(step, "register"):
+            step.register_step_scripts()
+        self.registered.add(step.get_step_name())
+
+    def stop_workers(self):
+        """ Called on exit. If building stopped on an error, the other workers are stopped
+        """
+
+        for reader, (name, process, shared_objects) in self.running.items():
+            process.terminate()
+            process.join()
+            reader.close()
+        self.running = dict()
@@ -8,13 +8,15 @@ __version__ = "1.6.0"
 
 
 import os, sys, re, yaml
+import json
+import pickle
+import hashlib
 from pprint import pprint as pp
 import collections
 from collections import OrderedDict
 
 ######################## From here: https://gist.github.com/pypt/94d747fe5180851196eb
 from yaml.constructor import ConstructorError
-from functools import reduce
 
 try:
     # from yaml import CLoader as Loader
@@ -23,9 +25,24 @@ except ImportError:
     from yaml import SafeLoader as Loader
 
 from neatseq_flow.modules.parse_sample_data import remove_comments, check_newlines
+from neatseq_flow.modules.sample_data_store import SAMPLE_DATA_STORE_TYPES
+from neatseq_flow.modules.global_defs import get_cache_dir, SUBMIT_PACING_DEFAULTS
+from neatseq_flow.modules.resources import RESOURCE_KEYS, parse_mem
 
 STEP_PARAMS_SINGLE_VALUE = ['module','redirects']
 
+MERGE_TAG = "tag:yaml.org,2002:merge"
+
+# Parsed parameter files are cached in this dir in the cache dir. Only the most recently used files are kept
+PARAM_CACHE_DIRNAME = "param_cache"
+PARAM_CACHE_SIZE = 20
+# Environment variables used while parsing (for the conda params). Part of the cache key
+PARAM_CACHE_ENV_VARS = ["CONDA_PREFIX", "CONDA_BASE", "CONDA_DEFAULT_ENV"]
+# Modules whose code parses the parameter files. Their source is part of the cache key
+PARAM_CACHE_SOURCES = ["parse_param_data.py", "var_interpol_defs.py", "resources.py", "global_defs.py"]
+# The module paths in the parameters, with whether each of them exists. Set by test_and_modify_global_params()
+checked_module_paths = []
+
 # The keys are the supported executors. The values - a str list of parameters that NeatSeq-Flow sets independently
 SUPPORTED_EXECUTORS = \
     {"SGE": "-N -e -o -q -hold_jid".split(" "),
@@ -41,10 +58,12 @@ EXECUTORS_Q_INFO = \
      "SLURMnew": "squeue",
      "Local": "-"}
 
-def parse_param_file(filename):
+def parse_param_file(filename, use_cache=True):
     """Parses a file from filename
+       The parsed parameters are cached (see get_param_cache_filename()), unless use_cache is False
     """
     file_conts = []
+    file_texts = []
 
     filenames = filename.split(",")
     for filename_raw in filenames:
@@ -55,67 +74,160 @@ def parse_param_file(filename):
             sys.exit("Parameter file %s does not exist.\n" % filename)
 
         with open(filename, encoding='utf-8') as fileh:
-            file_conts += fileh.readlines()
-           
-    check_newlines(file_conts)
+            file_lines = fileh.readlines()
+        file_conts += file_lines
+        file_texts.append("".join(file_lines))
+
+    cache_file = get_param_cache_filename(file_texts) if use_cache else None
+    cached = read_param_cache(cache_file) if use_cache else None
+    if cached is not None:
+        param_data, warnings = cached
+        sys.stderr.write("".join(warnings))
+    else:
+        check_newlines(file_conts)
+
+        # The warnings issued while parsing. Kept with the cached parameters, to repeat them when they are used
+        warnings = []
+        try:
+            param_data = get_param_data_YAML(file_conts, warnings)
+            # pp(get_param_data_YAML(file_conts))
+
+        except ConstructorError as exc:
+            error_comm = ""
+            if hasattr(exc, 'problem_mark'):
+                mark = exc.problem_mark
+                error_comm = "Error position: ({l}:{c})\n{snippet}".format(l=mark.line+1,
+                                                                           c=mark.column+1,
+                                                                           snippet=mark.get_snippet())
+            raise Exception("{error}\nPossible duplicate value passed".format(error=error_comm), "parameters")
+        except yaml.YAMLError as exc:
+            if hasattr(exc, 'problem_mark'):
+                mark = exc.problem_mark
+                print("Error position: (%s:%s)" % (mark.line+1, mark.column+1))
+                print(mark.get_snippet())
+
+            # Comment out the following line to enable classic param file format.
+            # Not recommended.
+            raise Exception("Failed to read YAML file. Make sure your parameter file is a correctly formatted YAML document.", "parameters")
+        except:
+            raise #Exception("Unrecognised exception reading the parameter file.", "parameters")
+        finally:
+            sys.stderr.write("".join(warnings))
+
+        if use_cache:
+            write_param_cache(cache_file, param_data, warnings)
+
+    # Setting global NOT_PASSABLE_EXECUTOR_PARAMS according to value of Executor (also when read from the cache)
+    global NOT_PASSABLE_EXECUTOR_PARAMS
+    NOT_PASSABLE_EXECUTOR_PARAMS = SUPPORTED_EXECUTORS[param_data["Global"]["Executor"]]
 
-    try:
-        return get_param_data_YAML(file_conts)
-        # pp(get_param_data_YAML(file_conts))
-        
-    except ConstructorError as exc:
-        error_comm = ""
-        if hasattr(exc, 'problem_mark'):
-            mark = exc.problem_mark
-            error_comm = "Error position: ({l}:{c})\n{snippet}".format(l=mark.line+1,
-                                                                       c=mark.column+1,
-                                                                       snippet=mark.get_snippet())
-        raise Exception("{error}\nPossible duplicate value passed".format(error=error_comm), "parameters")
-    except yaml.YAMLError as exc:
-        if hasattr(exc, 'problem_mark'):
-            mark = exc.problem_mark
-            print("Error position: (%s:%s)" % (mark.line+1, mark.column+1))
-            print(mark.get_snippet())
-        
-        # Comment out the following line to enable classic param file format.
-        # Not recommended.
-        raise Exception("Failed to read YAML file. Make sure your parameter file is a correctly formatted YAML document.", "parameters")
-    except:
-        raise #Exception("Unrecognised exception reading the parameter file.", "parameters")
+    return param_data
     
     # print "YAML failed. trying classic"
     # return get_param_data(file_conts)
 
+
+def get_param_cache_filename(file_texts):
+    """ Returns the cache file for the parameter files with contents file_texts. The name is a hash of the contents and
+        of everything else the parsed parameters depend on: the parsing code, the current dir (module paths can be
+        relative) and the conda environment variables.
+    """
+
+    sources = []
+    for source in PARAM_CACHE_SOURCES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source), encoding='utf-8') as source_fh:
+            sources.append(source_fh.read())
+    key = json.dumps([__version__,
+                      sources,
+                      os.getcwd(),
+                      [os.environ.get(env_var) for env_var in PARAM_CACHE_ENV_VARS],
+                      file_texts])
+
+    return os.path.join(get_cache_dir(),
+                        PARAM_CACHE_DIRNAME,
+                        hashlib.sha1(key.encode("utf8")).hexdigest() + ".pickle")
+
+
+def read_param_cache(cache_file):
+    """ Returns the parameters stored in cache_file and the warnings issued while parsing them, or None if there are
+        none or they can not be used.
+        The parameters can not be used if any of the module paths was created or removed since they were stored.
+    """
+
+    try:
+        with open(cache_file, "rb") as cache_fh:
+            cached = pickle.load(cache_fh)
+    except Exception:
+        return None
+    if any(os.path.isdir(path) != isdir for path, isdir in cached["module_paths"]):
+        return None
+
+    try:
+        # Marking the file as recently used
+        os.utime(cache_file)
+    except OSError:
+        pass
+
+    return cached["param_data"], cached["warnings"]
+
+
+def write_param_cache(cache_file, param_data, warnings):
+    """ Stores the parsed parameters in cache_file and removes the least recently used cache files.
+        Failure to write is ignored.
+    """
+
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_file + ".%d.tmp" % os.getpid(), "wb") as cache_fh:
+            pickle.dump({"param_data": param_data,
+                         "warnings": warnings,
+                         "module_paths": checked_module_paths},
+                        cache_fh,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + ".%d.tmp" % os.getpid(), cache_file)
+
+        cache_files = [os.path.join(cache_dir, cache_name)
+                       for cache_name
+                       in os.listdir(cache_dir)
+                       if cache_name.endswith(".pickle")]
+        cache_files.sort(key=os.path.getmtime, reverse=True)
+        for old_file in cache_files[PARAM_CACHE_SIZE:]:
+            os.remove(old_file)
+    except (IOError, OSError, pickle.PicklingError):
+        pass
+
 def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
     class OrderedLoader(Loader):
         pass
     def construct_mapping(loader, node, deep=False, upper_key=None):
-        ##########
-        # Detecting duplicate keys. From: https://gist.github.com/pypt/94d747fe5180851196eb
-        mapping = {}
-
-        for key_node, value_node in node.value:
-            # import pdb;
-            # pdb.set_trace()
-            key = loader.construct_object(key_node, deep=deep)
-            value = loader.construct_object(value_node, deep=deep)
-            # print "key:{key}; value:{value}\n".format(key=key, value=value)
-            if key in mapping and node.value:
-                raise ConstructorError("while constructing a mapping", node.start_mark,
-                                       "found duplicate key (%s)" % key, key_node.start_mark)
-            mapping[key] = value
-
-        ##########
+        # Each key and value is constructed once. Duplicates are looked for among the keys written in the mapping
+        # itself. Keys merged in with '<<' are added before them by flatten_mapping() and may be overridden.
+        explicit_count = len([key_node for key_node, value_node in node.value if key_node.tag != MERGE_TAG])
         loader.flatten_mapping(node)
+        merged_count = len(node.value) - explicit_count
 
-        return object_pairs_hook(loader.construct_pairs(node))
+        pairs = []
+        keys = set()
+        for index, (key_node, value_node) in enumerate(node.value):
+            key = loader.construct_object(key_node, deep=deep)
+            if index >= merged_count:
+                if key in keys:
+                    raise ConstructorError("while constructing a mapping", node.start_mark,
+                                           "found duplicate key (%s)" % key, key_node.start_mark)
+                keys.add(key)
+            pairs.append((key, loader.construct_object(value_node, deep=deep)))
+
+        return object_pairs_hook(pairs)
     OrderedLoader.add_constructor(
         yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
         construct_mapping)
     return yaml.load(stream, OrderedLoader)
 
-def get_param_data_YAML(filelines):
+def get_param_data_YAML(filelines, warnings):
     """ Parse YAML-formatted parameter files
+        Warnings are appended to warnings
     """
     def convert_param_format(param_dict):  # Gets the step part of the params dict
         yamlnames = [name for name in param_dict]
@@ -207,19 +319,16 @@ def get_param_data_YAML(filelines):
     # If there is a Variables section, interpolate any appearance of the variables in the params
     if "Vars" in list(yaml_params.keys()):
         
-        # Prepare the bunch for variable interpolation:
-        from munch import Munch
+        # Prepare the variables for interpolation:
         from .var_interpol_defs import make_interpol_func, walk, test_vars
         
-        test_vars(yaml_params["Vars"])
-        variables_bunch = Munch.fromDict({"Vars":yaml_params["Vars"]})
-        # print variables_bunch
-        f_interpol = make_interpol_func(variables_bunch)
+        test_vars(yaml_params["Vars"], warnings)
+        f_interpol = make_interpol_func(yaml_params["Vars"])
 
         # Actual code to run when 'Vars' exists:
         # Walk over params dict and interpolate strings:
 
-        yaml_params = walk(node=yaml_params,variables_bunch=variables_bunch, callback= f_interpol)
+        yaml_params = walk(node=yaml_params, callback=f_interpol)
 
 
     param_data = dict()
@@ -230,7 +339,7 @@ def get_param_data_YAML(filelines):
     except KeyError:
         raise Exception("You must include a 'Global_params' section in your parameter file!\n\n", "parameters")
 
-    param_data["Global"] = test_and_modify_global_params(param_data["Global"])
+    param_data["Global"] = test_and_modify_global_params(param_data["Global"], warnings)
 
     # Extract step-wise parameter dict from lines:
     param_data["Step"] = convert_param_format(yaml_params["Step_params"])
@@ -293,11 +402,12 @@ def param_data_testing_step_wise(param_data):
     issue_count = 1
     # List of all step names:
 
-    names = reduce(lambda x, y: x+y, [list(param_data[step].keys()) for step in list(param_data.keys())])
+    names = collections.Counter(name for step in param_data for name in param_data[step])
+    duplicate_names = [name for name in names if names[name] > 1]
 
-    if len(set([nam for nam in names if names.count(nam) > 1])) > 0:
+    if duplicate_names:
         
-        issue_warning += "%s. Duplicate values for the following step names: %s.\n" % (issue_count,",".join(set([nam for nam in names if names.count(nam) > 1])))
+        issue_warning += "%s. Duplicate values for the following step names: %s.\n" % (issue_count,",".join(duplicate_names))
         issue_count += 1
         
     # If one of parameter values is a list, create warning - multiple definitions of a param
@@ -338,6 +448,25 @@ def param_data_testing_step_wise(param_data):
                                          "in step {step} (name {name})\n".format(issuenum=issue_count,
                                                                                  step=step,name=name,
                                                                                  params=", ".join(NOT_PASSABLE_EXECUTOR_PARAMS))
+                if param == "resources":
+                    resources = param_data[step][name][param]
+                    if not isinstance(resources, dict) or set(resources) - set(RESOURCE_KEYS):
+                        issue_warning += "%s. 'resources' must contain only 'cpus' and 'mem' in step %s (name %s)\n" % \
+                                         (issue_count, step, name)
+                        issue_count += 1
+                        continue
+                    if resources.get("cpus") is not None and \
+                            (not isinstance(resources["cpus"], int) or resources["cpus"] < 1):
+                        issue_warning += "%s. 'cpus' in 'resources' must be a positive integer in step %s " \
+                                         "(name %s)\n" % (issue_count, step, name)
+                        issue_count += 1
+                    if resources.get("mem") is not None:
+                        try:
+                            parse_mem(resources["mem"])
+                        except ValueError:
+                            issue_warning += "%s. 'mem' in 'resources' must be a size such as 500M or 16G in step %s " \
+                                             "(name %s)\n" % (issue_count, step, name)
+                            issue_count += 1
 
     # Test that all steps have base steps and that the base steps are defined
     for step in list(param_data.keys()):
@@ -363,7 +492,7 @@ def param_data_testing_step_wise(param_data):
         return False
         
         
-def test_and_modify_global_params(global_params):
+def test_and_modify_global_params(global_params, warnings):
     
     # Setting default Executor to SGE:
     if "Executor" not in global_params:
@@ -375,6 +504,9 @@ def test_and_modify_global_params(global_params):
                                                               executor_list=", ".join(list(SUPPORTED_EXECUTORS.keys()))))
         raise Exception("Issues in parameters", "parameters")
 
+    global checked_module_paths
+    checked_module_paths = []
+
     # # This should not be done this way, but couldn't think of a better way.
     # # Setting global SUPPORTED_EXECUTORS according to value of Executor
     global NOT_PASSABLE_EXECUTOR_PARAMS
@@ -390,11 +522,13 @@ def test_and_modify_global_params(global_params):
             raise Exception("Unrecognised 'module_path' format. 'module_path' in 'Global_params' "
                             "must be a single path or a list. \n", "parameters")
 
-        bad_paths = [x for x in global_params["module_path"] if not os.path.isdir(x)]
-        good_paths = [x for x in global_params["module_path"] if os.path.isdir(x)]
+        # Stored with the cached parameters, which are used only while the paths' existence does not change
+        checked_module_paths = [(x, os.path.isdir(x)) for x in global_params["module_path"]]
+        bad_paths = [x for x, isdir in checked_module_paths if not isdir]
+        good_paths = [x for x, isdir in checked_module_paths if isdir]
         if bad_paths:
-            sys.stderr.write("WARNING: The following module paths do not exist and will be "
-                             "removed from search path: {badpaths}\n".format(badpaths=", ".join(bad_paths)))
+            warnings.append("WARNING: The following module paths do not exist and will be "
+                            "removed from search path: {badpaths}\n".format(badpaths=", ".join(bad_paths)))
             global_params["module_path"] = good_paths
 
 
@@ -439,6 +573,37 @@ def test_and_modify_global_params(global_params):
         pass
     # sys.exit("")
 
+    # Checking sample data store parameters:
+    if "sample_data_store" in global_params:
+        if global_params["sample_data_store"] not in SAMPLE_DATA_STORE_TYPES:
+            raise Exception("'sample_data_store' must be one of: {types}".format(types=", ".join(SAMPLE_DATA_STORE_TYPES)),
+                            "parameters")
+    if "sample_data_cache" in global_params:
+        if not isinstance(global_params["sample_data_cache"], int) or global_params["sample_data_cache"] < 1:
+            raise Exception("'sample_data_cache' must be a positive integer", "parameters")
+
+    if "array_jobs" in global_params:
+        if not isinstance(global_params["array_jobs"], bool):
+            raise Exception("'array_jobs' must be 'true' or 'false'", "parameters")
+
+    if "submit_pacing" in global_params:
+        if not isinstance(global_params["submit_pacing"], dict):
+            raise Exception("'submit_pacing' must be a block with one or more of: {keys}".
+                            format(keys=", ".join(SUBMIT_PACING_DEFAULTS)), "parameters")
+        bad_keys = [key for key in global_params["submit_pacing"] if key not in SUBMIT_PACING_DEFAULTS]
+        if bad_keys:
+            raise Exception("Unrecognised keys in 'submit_pacing': {bad}. Must be one of: {keys}".
+                            format(bad=", ".join(bad_keys), keys=", ".join(SUBMIT_PACING_DEFAULTS)), "parameters")
+        rate = global_params["submit_pacing"].get("rate", 0)
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate < 0:
+            raise Exception("'rate' in 'submit_pacing' must be a non-negative number of jobs per second",
+                            "parameters")
+        for key in ["retries", "backoff", "max_backoff"]:
+            value = global_params["submit_pacing"].get(key, SUBMIT_PACING_DEFAULTS[key])
+            if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+                raise Exception("'{key}' in 'submit_pacing' must be a positive integer".format(key=key), "parameters")
+        global_params["submit_pacing"] = dict(SUBMIT_PACING_DEFAULTS, **global_params["submit_pacing"])
+
     # Checking conda params are sensible:
     if "conda" in global_params:
         global_params["conda"] = manage_conda_params(global_params["conda"])
@@ -8,6 +8,7 @@ __version__ = "1.6.0"
 
 
 import os, sys
+import gzip
 from urllib.parse import urlparse
 
 import csv 
@@ -22,6 +23,10 @@ ALIGNMENT_FILE_TYPES = ['SAM','BAM','REFERENCE']
 VARIANT_FILE_TYPES = ['VCF','G.VCF']
 RECOGNIZED_FILE_TYPES = FASTQ_FILE_TPYES + FASTA_FILE_TYPES + ALIGNMENT_FILE_TYPES + VARIANT_FILE_TYPES 
 GLOBAL_SAMPLE_LIST = ['Title', 'Sample', 'Single', 'Sample_Control'] + RECOGNIZED_FILE_TYPES
+# Lower-case first words of sample file lines used for guessing the format. See guess_sample_data_format()
+FORMAT_WORDS = {"title", "sample", "#sampleid", "#type"} | set([x.lower() for x in RECOGNIZED_FILE_TYPES])
+WHITESPACE_RE = re.compile(r"\s+")
+GZIP_MAGIC = b"\x1f\x8b"
 
 from  neatseq_flow.modules.global_defs import ZIPPED_EXTENSIONS, ARCHIVE_EXTENSIONS, KNOWN_FILE_EXTENSIONS
 
@@ -57,55 +62,68 @@ def check_newlines(filelines):
         print("The sample and parameter files must not contain carriage returns. Convert newlines to UNIX style!\n")
         raise Exception("Issues in samples", "samples")
 
-def parse_sample_file(filename):
-    """Parses a file from filename
+def open_sample_file(filename):
+    """ Opens a sample (or grouping) file for reading. gzip-compressed files are recognized by their contents, so they
+        do not require a .gz extension.
     """
-    file_conts = []
+    with open(filename, "rb") as fileh:
+        magic = fileh.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(filename, "rt", encoding='utf-8')
+    return open(filename, encoding='utf-8')
 
-    filenames = filename.split(",")
-    for filename_raw in filenames:
+
+def read_sample_files(filenames):
+    """ Yields the lines of the comma-separated list of sample files, one file after the other
+    """
+
+    for filename_raw in filenames.split(","):
         # Expanding '~' and returning full path 
         filename = os.path.realpath(os.path.expanduser(filename_raw))
 
         if not os.path.isfile(filename):
             sys.exit("Sample file %s does not exist.\n" % filename)
-        with open(filename, encoding='utf-8') as fileh:
-            file_conts += fileh.readlines()
-                
-    check_newlines(file_conts)
-    sample_data = get_sample_data(file_conts)
+        with open_sample_file(filename) as fileh:
+            for line in fileh:
+                yield line
+
+
+def parse_sample_file(filename):
+    """Parses a file from filename
+       The file is read line by line (see get_sample_data()). It can be gzip-compressed.
+    """
+
+    sample_data = get_sample_data(read_sample_files(filename))
     # check_sample_constancy(sample_data)  # Letting user use both zipped and unzipped files. Not recommended
     
-    # pp(sample_data)
-    # sys.exit()
     return sample_data
-        
+
+
 def get_sample_data(filelines):
-    """return lines relevant to the sample data, if exist
+    """return the sample data in filelines, if exist
+       filelines can be any iterable of lines (e.g. a file). They are read once.
     """
-    
-    sample_file_type = guess_sample_data_format(filelines)
+
+    raw_data = get_tabular_sample_data_lines(filelines)
+
+    sample_file_type = guess_sample_data_format(raw_data["First_words"])
     if (sample_file_type == "Classic"):
         sys.exit("The classic sample file format is no longer supported. Please use the tab-separated format only.")
         # return get_classic_sample_data(filelines)
     elif (sample_file_type == "Tabular"):   
-        return get_tabular_sample_data(filelines)
+        return get_tabular_sample_data(raw_data)
     else:
         sys.exit("There is a problem with the sample file format. Make sure all lines begin with keywords.")
 
-def guess_sample_data_format(filelines):
+def guess_sample_data_format(first_words):
     """Guess the format of sample data. Could be tsv (preferable but not defined yet) or old pipeline format
+       first_words is the set of lower-case first words of the sample file lines which are relevant for determining the
+       format (see get_tabular_sample_data_lines())
     """
-    # Remove comments:  CANCELLED. Tabular format has #SampleID as header line prefix!
-    # filelines = remove_comments(filelines)
-    # Get all unique first words on line (=set)
     # This can contain parameter file stuff as well, when they are merged!
-    myset = {re.split("\s+", line, maxsplit=1)[0] for line in filelines}
-    # Changing to lower case:
-    myset = set([x.lower() for x in myset])
+    myset = first_words
     recognized_file_types = set([x.lower() for x in RECOGNIZED_FILE_TYPES])
     
-    # pp(set(recognized_file_types))
     # Check if one of the following words exists in the set by checking the intersection of the sets:
     if(({"title", "sample"} <= myset) & \
         (len(myset & set(recognized_file_types))>=1)):    
@@ -133,37 +151,22 @@ def parse_sample_control_data(Sample_Control, sample_names):
     # Extract and return data
     return {item.split(":")[0]:item.split(":")[1] for item in Sample_Control}
 
-def get_tabular_sample_data(filelines):
+def get_tabular_sample_data(raw_data):
     """
-    Get sample data from filelines
+    Get sample data from the raw data returned by get_tabular_sample_data_lines()
     """
-    # Extract sample-related data from filelines:
-    # Returns a dict with keys: "Title", "Sample_data" and/or "Project_data" and possibly "ChIP_data"
-    raw_data = get_tabular_sample_data_lines(filelines)
     sample_data = dict()
 
-    if "Sample_data" in raw_data:
-        sample_names = set([fileline[0] for fileline in raw_data["Sample_data"]])
-    else:
-        sample_names = []
-    
     # Add a list of sample names to sample_data
-    sample_data["samples"] = sorted(sample_names)  
-
-    # pp(raw_data["Sample_data"])     
-    for sample in sample_names:
-        # Parse lines for a single sample.
-        # Get the lines that have the sample name in first column and extract data from them
-        # with parse_tabular_sample_data()
-        # Note: Sample name is removed from element 0 (line[1:]) so that function
+    sample_data["samples"] = sorted(raw_data["Sample_data"])
+
+    for sample in sample_data["samples"]:
+        # Parse lines for a single sample. The lines are grouped by sample in get_tabular_sample_data_lines().
+        # Note: Sample name is removed from element 0 so that function
         # parse_tabular_sample_data() can be used for project wide table, too.
-        sample_data[sample] = parse_tabular_sample_data([line[1:]
-                                                         for line
-                                                         in raw_data["Sample_data"]
-                                                         if line[0]==sample])
-    # pp(sample_data)
-    
-    if "Project_data" in raw_data:
+        sample_data[sample] = parse_tabular_sample_data(raw_data["Sample_data"][sample])
+
+    if raw_data["Project_data"]:
         sample_data["project_data"] = parse_tabular_project_data(raw_data["Project_data"])
     else:
         # Create an empty project_data slot in case an instance needs it before it has been created
@@ -174,93 +177,115 @@ def get_tabular_sample_data(filelines):
         sample_data["Controls"] = parse_sample_control_data(raw_data["ChIP_data"],sample_names=list(sample_data.keys()))
         
     # Add project title sample_data
-    sample_data["Title"] = raw_data["Title"]
-    
+    sample_data["Title"] = get_title(raw_data["Title"])
 
     return sample_data
-    
-def get_tabular_sample_data_lines(filelines):
-    """ Get sample data from "Tabular" sample data lines
-        Will keep one line beginning with "Title" and all consecutive lines from "#SampleID" till first blank line
-        
-        The reason for this is that the user should have the option of embedding the sample file in the parameter file.
-        This way, all line except the title and the consecutive sample lines will be discarded
+
+
+def get_title(title_line):
+    """ Returns the title defined in the "Title" lines
     """
 
-    return_results = {}
-    
-    # filelines = remove_comments(filelines)
-    title_line = remove_comments([line for line in filelines if re.split("\s+", line, maxsplit=1)[0] == "Title"])
-    
     # Check there is only one title line (title is a list of length 1)
     if len(title_line)>1:   
         sys.stdout.write("More than 1 Title line defined. Using first: %s\n" % title_line[0])
 
     # Read CSV data with csv package. Store in return_results
-    linedata = StringIO("\n".join(title_line)) #("\n".join([line[1] for line in title_line])))
+    linedata = StringIO("\n".join(title_line))
     reader = csv.reader(linedata, dialect='excel-tab')
     title = [row[1] for row in reader][0]  # Get first element, 2nd (index 1) column:
     # Removing trailing spaces and converting whitespace to underscore
     if re.search("\s+", title):
-        # print "in here"
         title = title.strip()
         title = re.sub("\s+", "_", title)
         sys.stderr.write("The title contains white spaces. Converting to underscores. (%s)\n" % title)
-    return_results["Title"] = title
 
-    # Looking for contiguous blocks beginning with #SampleID and #Type.
-    # First, getting index of blank lines:
-    blank_ind = [ind for (ind,param_l) in list(enumerate(filelines)) if re.match("^\s+$", param_l)]
-    blank_ind.append(len(filelines))
-    
-    # looking for range begining with "#SampleID" till first blank line:
-    # Index of header line:
-    head_ind_list = [ind
-                for (ind,param_l)
-                in list(enumerate(filelines))
-                if re.split("\s+", param_l, maxsplit=1)[0].lower() == "#sampleid"]
-
-    # if head_ind:  # A line beginning with '#SampleID' exists.
-    return_results["Sample_data"] = []
-    for head_ind in head_ind_list:
-        # Range of lines to keep: from header index till first blank line
-        lines_range = list(range(head_ind,min([ind for ind in blank_ind if ind>head_ind])))
-        # Read CSV data with csv package. Store in return_results
-        linedata = StringIO("\n".join(remove_comments([filelines[i] for i in lines_range])))
-        reader = csv.reader(linedata, dialect='excel-tab')
-        return_results["Sample_data"].extend([row for row in reader])
+    return title
 
-    # looking for range begining with "#Type" till first blank line:
-    # Index of header line:
-    head_ind_list = [ind
-                     for (ind,param_l)
-                     in list(enumerate(filelines))
-                     if re.split("\s+", param_l, maxsplit=1)[0].lower() == "#type"]
 
-    # if head_ind:  # A line beginning with '#Type' exists.
-    return_results["Project_data"] = []
-    for head_ind in head_ind_list:
+def split_tabular_line(line):
+    """ Splits a tab-separated line (without newline) into fields, as csv.reader with the excel-tab dialect does.
+        Lines without quotes are split directly, which is much faster.
+    """
+    if '"' not in line:
+        return line.split("\t")
+    return next(csv.reader([line], dialect='excel-tab'))
 
-        # Range of lines to keep: from header index till first blank line
-        lines_range = list(range(head_ind,min([ind for ind in blank_ind if ind>head_ind])))
 
-        linedata = StringIO("\n".join(remove_comments([filelines[i] for i in lines_range])))
-        reader = csv.reader(linedata, dialect='excel-tab')
-        return_results["Project_data"].extend([row for row in reader])
+def get_tabular_sample_data_lines(filelines):
+    """ Get sample data from "Tabular" sample data lines
+        Will keep one line beginning with "Title" and all consecutive lines from "#SampleID" till first blank line
+        
+        The reason for this is that the user should have the option of embedding the sample file in the parameter file.
+        This way, all line except the title and the consecutive sample lines will be discarded
 
-    # print(return_results["Project_data"])
-    # sys.exit()
-    # Extract Sample_Control lines:
-    sample_control = [line for line in filelines if re.split("\s+", line, maxsplit=1)[0] == "Sample_Control"]
-    sample_control = remove_comments(sample_control)
+        The lines are read in one pass. Sample lines are grouped by sample as they are read.
+        Returns a dict with keys:
+            "Title": The "Title" lines
+            "Sample_data": {sample: list of [type, path, ...]}, with samples in order of appearance
+            "Project_data": list of [type, path, ...]
+            "ChIP_data": List of sample:control pairs, if "Sample_Control" lines exist
+            "First_words": The lower-case first words of the lines used by guess_sample_data_format()
+    """
+
+    return_results = {"Title": [],
+                      "Sample_data": dict(),
+                      "Project_data": []}
+    first_words = set()
+    sample_control = []
+    format_words = FORMAT_WORDS
+
+    # Blocks (sample or project lines) begin with a header line and end at the first blank line.
+    # Lines after a "STOP_HERE" line are not used, till the end of the block.
+    in_sample_block = in_project_block = False
+    sample_block_stopped = project_block_stopped = False
+    for line in filelines:
+        # Assert that the lines do not contain "\r" charaters.
+        if "\r" in line:
+            print("The sample and parameter files must not contain carriage returns. Convert newlines to UNIX style!\n")
+            raise Exception("Issues in samples", "samples")
+
+        if line.isspace():
+            in_sample_block = in_project_block = False
+            continue
+
+        first_word = WHITESPACE_RE.split(line, maxsplit=1)[0]
+        first_word_lower = first_word.lower()
+        if first_word_lower in format_words:
+            first_words.add(first_word_lower)
+        if first_word == "Title":
+            return_results["Title"].extend(remove_comments([line]))
+        elif first_word == "Sample_Control":
+            sample_control.extend(remove_comments([line]))
+        if first_word_lower == "#sampleid":
+            in_sample_block, sample_block_stopped = True, False
+        elif first_word_lower == "#type":
+            in_project_block, project_block_stopped = True, False
+
+        if not in_sample_block and not in_project_block:
+            continue
+        # Remove comments and trailing white space:
+        line = line.partition("#")[0].rstrip()
+        if not line.strip():
+            continue
+        if line == "STOP_HERE":
+            sample_block_stopped = sample_block_stopped or in_sample_block
+            project_block_stopped = project_block_stopped or in_project_block
+            continue
+        row = split_tabular_line(line)
+        if in_sample_block and not sample_block_stopped:
+            return_results["Sample_data"].setdefault(row[0], []).append(row[1:])
+        if in_project_block and not project_block_stopped:
+            return_results["Project_data"].append(row)
 
-    if sample_control and not "Sample_data" in return_results:
-        sys.exit("Sample-control info defined, but sample definition is absent!")
     if sample_control:  # ChIP-seq data exists:
         linedata = StringIO("\n".join(sample_control))
         reader = csv.reader(linedata, dialect='excel-tab')
         return_results["ChIP_data"] = [row[1] for row in reader]
 
+    # Only the first words relevant for determining the format are kept (see guess_sample_data_format())
+    return_results["First_words"] = first_words
+
     return return_results
     
 def parse_tabular_sample_data(sample_lines):
@@ -273,7 +298,7 @@ def parse_tabular_sample_data(sample_lines):
         # line_data = re.split("\s+", line)
 
         # print line_data[1]
-        if line[0] in list(sample_x_dict.keys()):
+        if line[0] in sample_x_dict:
             # If type exists, append path to list
             # sample_x_dict[line[0]].append(get_full_path(line[1]))
             sample_x_dict[line[0]].append(line[1])
@@ -283,9 +308,6 @@ def parse_tabular_sample_data(sample_lines):
             # sample_x_dict[line[0]] = [get_full_path(line[1])]
             sample_x_dict[line[0]] = [line[1]]
 
-    # pp(sample_x_dict)
-    # sys.exit()
-
     return(sample_x_dict)
 
 def parse_tabular_project_data(proj_lines):
@@ -338,7 +360,7 @@ def parse_grouping_file(grouping_file):
         # sys.exit("Grouping file {file} does not exist.\n".format(file=grouping_file))
         raise Exception("Issues in grouping", "Grouping file {file} does not exist.Unidentified extension in source\n".format(file=grouping_file))
 
-    with open(grouping_file, encoding='utf-8') as csvfile:
+    with open_sample_file(grouping_file) as csvfile:
         file_conts = csvfile.readlines()
 
     # Convert SampleID at line start to lower case
@@ -370,7 +392,8 @@ def parse_grouping_file(grouping_file):
     for row in grouping_rows:
         if row["#sampleid"] not in mapping_data:
             mapping_data[row["#sampleid"]] = dict()
-        for category in list(set(row.keys()) - {"#sampleid"}):
+        # In the order of the columns in the file
+        for category in [key for key in reader.fieldnames if key != "#sampleid"]:
             mapping_data[row["#sampleid"]][category] = row[category]
 
     return mapping_data
\ No newline at end of file
@@ -0,0 +1,216 @@
+""" Profiling the generation of the workflow scripts
+
+When NeatSeq-Flow is run with --profile, the wall time, CPU time and peak RSS of each phase of building the workflow
+(reading the files, making the step instances, building the scripts, plotting etc.) and of building each step are
+recorded. The report is written to objects/profile.json, with the step measurements summed up by module.
+
+Steps are measured in two parts:
+    * build: Creating the step's scripts (in the worker process when building in parallel), or restoring the step from
+      the build cache
+    * register: Adding the step's scripts and sample_data to the workflow-wide files and containers
+
+Peak RSS is the maximal resident set size of the process (in KB) at the end of the measured part. For steps built in
+worker processes, it is the worker's.
+
+External profilers can subscribe to the same measurement points with add_profile_hook(). The hooks are called whether
+or not --profile is used.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import sys
+import time
+import json
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:     # Not available on Windows. Peak RSS is not reported
+    resource = None
+
+
+PROFILE_FILENAME = "profile.json"
+
+# Functions subscribed to the profiling events. See add_profile_hook()
+profile_hooks = []
+
+
+def add_profile_hook(hook):
+    """ Subscribes hook to the profiling events. hook is called with (event, kind, name, record):
+        event:  "start" or "end"
+        kind:   "phase" or "step"
+        name:   Phase name or step name
+        record: The measurements, a dict with "wall" and "cpu" (seconds) and "peak_rss" (KB). None for "start" events.
+                Step records have "module", "status", "build" and "register", with the measurements of each part.
+    """
+    profile_hooks.append(hook)
+
+
+def remove_profile_hook(hook):
+
+    profile_hooks.remove(hook)
+
+
+def get_peak_rss():
+    """ Returns the peak resident set size of the current process in KB, or None if not available
+    """
+
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return peak_rss // 1024 if sys.platform == "darwin" else peak_rss
+
+
+class Measurement(object):
+    """ Measures wall time, CPU time and peak RSS from creation until get_record() is called
+    """
+
+    def __init__(self):
+
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def get_record(self):
+
+        return {"wall": round(time.perf_counter() - self.wall, 6),
+                "cpu": round(time.process_time() - self.cpu, 6),
+                "peak_rss": get_peak_rss()}
+
+
+class Profiler(object):
+    """ The measurements of the phases and steps of the current run.
+        If not enabled and no hooks are subscribed, nothing is measured.
+    """
+
+    def __init__(self, enabled=False):
+
+        self.enabled = enabled
+        self.measurement = Measurement()
+        # Phase records in order of execution: [{"phase": name, "wall": ..., "cpu": ..., "peak_rss": ...}]
+        self.phases = list()
+        # The current phase: (name, Measurement)
+        self.current_phase = None
+        # Step records in order of registration
+        self.steps = list()
+        # Steps being measured: {step name: {"module": ..., "status": ..., "build": ..., "register": ...}}
+        self.step_records = dict()
+
+    def is_active(self):
+
+        return self.enabled or bool(profile_hooks)
+
+    def call_hooks(self, event, kind, name, record=None):
+
+        for hook in list(profile_hooks):
+            hook(event, kind, name, record)
+
+    def start_phase(self, name):
+        """ Ends the current phase, if any, and starts measuring phase name
+        """
+
+        self.end_phase()
+        if not self.is_active():
+            return
+        self.call_hooks("start", "phase", name)
+        self.current_phase = (name, Measurement())
+
+    def end_phase(self):
+
+        if self.current_phase is None:
+            return
+        name, measurement = self.current_phase
+        self.current_phase = None
+        record = measurement.get_record()
+        self.phases.append(dict(phase=name, **record))
+        self.call_hooks("end", "phase", name, record)
+
+    @contextmanager
+    def measure_step(self, step, part):
+        """ Measures a part ("build" or "register") of building step. The step record is complete when the register
+            part ends.
+        """
+
+        if not self.is_active():
+            yield
+            return
+        name = step.get_step_name()
+        if part == "build":
+            self.call_hooks("start", "step", name)
+        measurement = Measurement()
+        yield
+        self.add_step_part(step, part, measurement.get_record())
+
+    def get_step_record(self, step):
+
+        return self.step_records.setdefault(step.get_step_name(), {"module": step.get_step_step(),
+                                                                   "status": "built",
+                                                                   "build": None,
+                                                                   "register": None})
+
+    def add_step_part(self, step, part, record):
+        """ Adds the measurements of a part of building step. Used directly for steps built in worker processes.
+        """
+
+        if not self.is_active():
+            return
+        name = step.get_step_name()
+        step_record = self.get_step_record(step)
+        step_record[part] = record
+        if part == "register":
+            del self.step_records[name]
+            self.steps.append(dict(step=name, **step_record))
+            self.call_hooks("end", "step", name, step_record)
+
+    def set_step_status(self, step, status):
+        """ Sets the status of step in its record: "built", "cached" (restored from the build cache) or "skipped" (a
+            step without scripts)
+        """
+
+        if self.is_active():
+            self.get_step_record(step)["status"] = status
+
+    def get_module_summary(self):
+        """ Returns the step measurements summed by module, with the maximal peak RSS
+        """
+
+        modules = dict()
+        for step_record in self.steps:
+            summary = modules.setdefault(step_record["module"], {"steps": 0, "wall": 0, "cpu": 0, "peak_rss": None})
+            summary["steps"] += 1
+            for part in ["build", "register"]:
+                if step_record[part] is None:
+                    continue
+                summary["wall"] += step_record[part]["wall"]
+                summary["cpu"] += step_record[part]["cpu"]
+                if step_record[part]["peak_rss"] is not None:
+                    summary["peak_rss"] = max(summary["peak_rss"] or 0, step_record[part]["peak_rss"])
+        for summary in modules.values():
+            summary["wall"] = round(summary["wall"], 6)
+            summary["cpu"] = round(summary["cpu"], 6)
+        return modules
+
+    def write_report(self, filename, **run_info):
+        """ Ends the current phase and, if profiling is enabled, writes the report to filename and prints a summary.
+            run_info is included in the report as is.
+        """
+
+        self.end_phase()
+        if not self.enabled:
+            return
+        report = {"version": __version__,
+                  "run": run_info,
+                  "total": self.measurement.get_record(),
+                  "phases": self.phases,
+                  "modules": self.get_module_summary(),
+                  "steps": self.steps}
+        with open(filename, "w") as profile_fh:
+            json.dump(report, profile_fh, indent=1)
+
+        sys.stdout.write("Profile (wall/CPU seconds):\n")
+        for phase in self.phases:
+            sys.stdout.write("    {phase:<20} {wall:>8.3f} {cpu:>8.3f}\n".format(**phase))
+        sys.stdout.write("    {phase:<20} {wall:>8.3f} {cpu:>8.3f}\n".format(phase="total", **report["total"]))
+        sys.stdout.write("Profile written to {filename}\n".format(filename=filename))
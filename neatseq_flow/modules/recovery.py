@@ -0,0 +1,313 @@
+""" Recovering a failed run: re-executing only the jobs which failed or did not finish, and the jobs depending on them
+
+The state of each job is read from the log file of the run: A job finished successfully if its last record in the log
+(written by the job's script, not the 'Queue' records of NSF_exec.sh) is 'Finished' and OK. With the executors keeping
+the states of the jobs in run_index (Local and SLURM), jobs which failed or were killed according to run_index and its
+journal are re-executed as well (see run_journal.py).
+
+The jobs re-executed are the low level jobs which did not finish successfully, and the jobs downstream of them (see
+JobGraph). The jobs downstream of a job are selected by sample: The dependencies in depend_index are between steps, but
+the job of a sample uses only the results of the same sample in the steps before it. Therefore, only the downstream jobs
+of the samples whose jobs failed are re-executed. Jobs which are not of a single sample (project and group level jobs,
+array jobs and preliminary and wrapping up jobs) use the results of all the jobs upstream of them, and are re-executed
+if any of the jobs upstream of them is. The sample level jobs downstream of them are re-executed only for the samples
+whose jobs failed, unless they themselves failed, in which case the jobs of all the samples downstream of them are
+re-executed.
+
+The jobs are re-executed with copies of their high level scripts containing only the code of the jobs to re-execute,
+and a copy of 00.workflow.commands.sh executing these scripts, all written to scripts/95.recover. So, the recovery works
+the same way with all the executors.
+
+Usage (see scripts/00.workflow.recover.sh):
+    python -m neatseq_flow.modules.recovery <objects dir> [--samples s1 s2 ...] [--steps step1 step2 ...] [--force]
+                                                          [--dry_run]
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import re
+import sys
+import shutil
+import argparse
+import subprocess
+
+from .workflow_json import load_index, get_sample_data
+from .job_graph import JobGraph, JID_NAME_SEP
+from .run_journal import get_view, get_line_id, ACTIVE_STATES
+
+
+RECOVERY_DIRNAME = "95.recover"
+MAIN_SCRIPT_NAME = "00.workflow.commands.sh"
+# The start of the code of each job in the high level scripts and in 00.workflow.commands.sh, and the end of the code
+# of the last job in the high level scripts (see HighScriptConstructor)
+CODE_MARK = re.compile(r"^# -+ Code for (\S+) -+$", re.MULTILINE)
+CLOSING_MARK = re.compile(r"^# -+ Closing \S+ -+$", re.MULTILINE)
+
+
+def get_log_states(log_file):
+    """ Returns {job id: 'done', 'failed' or 'started'}, by the last record of each job in the log file
+    """
+
+    states = dict()
+    with open(log_file, "r") as log_fh:
+        for line in log_fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 10 or fields[5] == "Queue":
+                continue
+            if fields[1] == "Started":
+                states[fields[4]] = "started"
+            elif fields[1] == "Finished":
+                states[fields[4]] = "done" if "OK" in fields[9] else "failed"
+    return states
+
+
+def get_run_index_states(run_index):
+    """ Returns {job id: 'active', 'done' or 'failed'} for the jobs with a state in run_index (with the records in its
+        journal applied)
+    """
+
+    states = dict()
+    try:
+        lines = get_view(run_index)[0]
+    except (IOError, OSError):
+        return states
+    for line in lines:
+        fields = line.split("\t")
+        if len(fields) < 2:
+            continue
+        if not line.startswith("#"):
+            states[fields[0]] = "active" if fields[1] in ACTIVE_STATES else "failed"
+        else:
+            states[get_line_id(line)] = "done" if fields[1] == "done" else "failed"
+    return states
+
+
+def filter_code(text, keep, closed=True):
+    """ Returns a script with only the code of the jobs in keep: The text before the first 'Code for' mark and from
+        the closing mark on is kept, and of the code between them, only the code of the jobs in keep.
+        If closed is not set, the code of the last job ends at the end of the script.
+    """
+
+    marks = list(CODE_MARK.finditer(text))
+    if not marks:
+        return text
+    end = len(text)
+    if closed:
+        closing = CLOSING_MARK.search(text, marks[-1].end())
+        if not closing:
+            raise Exception("The high level scripts were built by an older version of NeatSeq-Flow. Build the "
+                            "workflow again to recover it", "parameters")
+        end = closing.start()
+    parts = [text[:marks[0].start()]]
+    for ind, mark in enumerate(marks):
+        if mark.group(1) in keep:
+            parts.append(text[mark.start():marks[ind + 1].start() if ind + 1 < len(marks) else end])
+    parts.append(text[end:])
+    return "".join(parts)
+
+
+class Recovery(JobGraph):
+    """ Selects the jobs of a run to re-execute, and writes the scripts re-executing them (see module docstring)
+    """
+
+    def __init__(self, objects_dir):
+
+        index, objects_dir = load_index(objects_dir)
+        super(Recovery, self).__init__(index["pipe_data"])
+        self.samples = set(get_sample_data(index, objects_dir).get("samples", []))
+        # Set by get_states()
+        self.workflow_running = False
+        self.states = self.get_states()
+
+    def get_states(self):
+        """ Returns {job id: state} for the low level jobs. The states are 'done', 'failed', 'started' (started and
+            not finished according to the log), 'active' (held or running according to run_index) and 'not started'.
+            Sets workflow_running if any job, of any level, is active according to run_index or started and not
+            finished according to the log.
+        """
+
+        if not os.path.isfile(self.pipe_data["log_file"]):
+            raise Exception("Log file {log} not found".format(log=self.pipe_data["log_file"]), "parameters")
+        log_states = get_log_states(self.pipe_data["log_file"])
+        run_index_states = get_run_index_states(self.pipe_data["run_index"])
+        self.workflow_running = "active" in run_index_states.values() or "started" in log_states.values()
+
+        states = dict()
+        for job in self.jobs.values():
+            if job.level == "high":
+                continue
+            if run_index_states.get(job.id) in ["active", "failed"]:
+                states[job.id] = run_index_states[job.id]
+            else:
+                states[job.id] = log_states.get(job.id, "not started")
+        return states
+
+    def get_job_sample(self, job):
+        """ Returns the sample of a low level job, or None for jobs which are not of a single sample
+        """
+
+        parts = job.id.split(JID_NAME_SEP)
+        return parts[2] if len(parts) > 3 and parts[2] in self.samples else None
+
+    def get_failed_jobs(self, samples=None, steps=None):
+        """ Returns the ids of the low level jobs which did not finish successfully. If samples or steps are passed,
+            only the jobs of these samples (sample level jobs) and steps are returned.
+        """
+
+        for names, known, kind in [(samples, self.samples, "Samples"),
+                                   (steps, set(job.instance for job in self.jobs.values()), "Steps")]:
+            missing = set(names or []) - known
+            if missing:
+                raise Exception("{kind} not found in the workflow: {names}".format(kind=kind,
+                                                                                   names=", ".join(sorted(missing))),
+                                "parameters")
+
+        return [job_id
+                for job_id, state
+                in self.states.items()
+                if state != "done"
+                and (not samples or self.get_job_sample(self.jobs[job_id]) in samples)
+                and (not steps or self.jobs[job_id].instance in steps)]
+
+    def get_rerun_jobs(self, failed):
+        """ Returns the failed jobs and the low level jobs downstream of them (see module docstring), in script_index
+            order, as {job id: samples}. samples are the samples whose failed jobs cause the job to be re-executed, or
+            None if it is re-executed for all the samples.
+        """
+
+        def merge_samples(samples1, samples2):
+            return None if samples1 is None or samples2 is None else samples1 | samples2
+
+        selected = dict()
+        for job_id in failed:
+            sample = self.get_job_sample(self.jobs[job_id])
+            selected[job_id] = {sample} if sample else None
+        pending = list(failed)
+        while pending:
+            job = self.jobs[pending.pop()]
+            for dependent_id in job.dependents:
+                dependent = self.jobs[dependent_id]
+                if dependent.level == "high":
+                    continue
+                dependent_sample = self.get_job_sample(dependent)
+                if dependent_sample is None:
+                    samples = selected[job.id]
+                elif selected[job.id] is None or dependent_sample in selected[job.id]:
+                    samples = {dependent_sample}
+                else:
+                    continue
+                # A job already selected is passed on again only if it is re-executed for more samples
+                if dependent_id in selected:
+                    samples = merge_samples(selected[dependent_id], samples)
+                    if samples == selected[dependent_id]:
+                        continue
+                selected[dependent_id] = samples
+                pending.append(dependent_id)
+        return {job_id: selected[job_id]
+                for job_id
+                in sorted(selected, key=lambda job_id: self.jobs[job_id].order)}
+
+    def write_scripts(self, rerun):
+        """ Writes the scripts re-executing the jobs in rerun to scripts/95.recover. Returns the path to the copy of
+            00.workflow.commands.sh
+        """
+
+        recovery_dir = os.path.join(self.pipe_data["scripts_dir"], RECOVERY_DIRNAME)
+        shutil.rmtree(recovery_dir, ignore_errors=True)
+        os.makedirs(recovery_dir)
+
+        highs = list()
+        for job_id in rerun:
+            if self.jobs[job_id].high not in highs:
+                highs.append(self.jobs[job_id].high)
+        rerun = set(rerun)
+        with open(os.path.join(self.pipe_data["scripts_dir"], MAIN_SCRIPT_NAME), "r") as main_fh:
+            main_script = filter_code(main_fh.read(), highs, closed=False)
+        for high_id in highs:
+            high = self.jobs[high_id]
+            high_path = os.path.join(recovery_dir, os.path.basename(high.path))
+            with open(high.path, "r") as script_fh:
+                script = filter_code(script_fh.read(), rerun)
+            with open(high_path, "w") as script_fh:
+                script_fh.write(script)
+            main_script = re.sub(re.escape(high.path) + r"(?=\s)", high_path, main_script)
+
+        main_path = os.path.join(recovery_dir, MAIN_SCRIPT_NAME)
+        with open(main_path, "w") as main_fh:
+            main_fh.write(main_script)
+        return main_path
+
+    def check_active(self, failed):
+        """ Raises an exception if any of the failed jobs may still be running. While the workflow is running, jobs
+            which did not start may still be queued (e.g. by SGE or SLURM), and are not re-executed either.
+        """
+
+        if os.path.isfile(self.pipe_data["run_index"] + ".killall"):
+            raise Exception("{run_index}.killall exists. Remove it before recovering the run".
+                            format(run_index=self.pipe_data["run_index"]), "parameters")
+        active_states = ["active", "started"] + (["not started"] if self.workflow_running else [])
+        active = [job_id for job_id in failed if self.states[job_id] in active_states]
+        if active:
+            raise Exception("{running}The following jobs {state}: {jobs}{more}\nIf they are no longer running or "
+                            "queued, use --force to re-execute them".
+                            format(running="The workflow is still running. " if self.workflow_running else "",
+                                   state="did not finish" if self.workflow_running else "started and did not finish",
+                                   jobs=", ".join(active[:10]),
+                                   more=" and {num} more".format(num=len(active) - 10) if len(active) > 10 else ""),
+                            "parameters")
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description="Re-execute the jobs of a run which failed or did not finish, and "
+                                                 "the jobs depending on them")
+    parser.add_argument("objects_dir", help="The objects dir of the workflow (or the path to its WorkflowData.json)")
+    parser.add_argument("--samples", help="Re-execute only the failed jobs of these samples (and the jobs depending on "
+                                          "them)", nargs="+")
+    parser.add_argument("--steps", help="Re-execute only the failed jobs of these steps (and the jobs depending on "
+                                        "them)", nargs="+")
+    parser.add_argument("--force", help="Re-execute jobs which did not finish, even if they may still be running or "
+                                        "queued", action="store_true")
+    parser.add_argument("--dry_run", help="Only list the jobs to re-execute, without writing or executing the scripts",
+                        action="store_true")
+    args = parser.parse_args(args)
+
+    try:
+        recovery = Recovery(args.objects_dir)
+        failed = recovery.get_failed_jobs(args.samples, args.steps)
+        if not args.force:
+            recovery.check_active(failed)
+        rerun = recovery.get_rerun_jobs(failed)
+        if not rerun:
+            sys.stdout.write("No jobs to re-execute\n")
+            return
+        main_path = recovery.write_scripts(rerun) if not args.dry_run else None
+    except Exception as raisedex:
+        if len(raisedex.args) > 1 and raisedex.args[1] == "parameters":
+            sys.exit(raisedex.args[0])
+        raise
+
+    failed = set(failed)
+    done = [job_id for job_id in rerun if recovery.states[job_id] == "done"]
+    sys.stdout.write("{failed} jobs failed or did not finish. Re-executing them and {downstream} jobs depending on "
+                     "them ({done} of which finished successfully):\n".format(failed=len(failed),
+                                                                              downstream=len(rerun) - len(failed),
+                                                                              done=len(done)))
+    for job_id, samples in rerun.items():
+        if job_id in failed:
+            reason = ""
+        elif samples is None:
+            reason = "depends on failed project or group level jobs"
+        else:
+            reason = "depends on failed jobs of {samples}".format(samples=", ".join(sorted(samples)))
+        sys.stdout.write("\t{job}\t{state}\t{reason}\n".format(job=job_id, state=recovery.states[job_id], reason=reason))
+    if args.dry_run:
+        return
+    sys.exit(subprocess.call(["bash", main_path]))
+
+
+if __name__ == "__main__":
+    main()
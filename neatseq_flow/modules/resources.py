@@ -0,0 +1,89 @@
+""" The CPU and memory requested by the jobs of a step
+
+Used by the local scheduler to pack jobs onto the cores and memory of the host. The resources of a step are taken from
+the step's 'resources' parameter:
+
+    resources:
+        cpus:   32
+        mem:    64G
+
+If 'resources' is not defined (or defines only one of the two), they are read from the step's qsub_params:
+
+    cpus    '-pe' (e.g. 'shared 20'), '--cpus-per-task' or '-c', or 'ppn=' in '-l'
+    mem     '--mem', '--mem-per-cpu' (per cpu), or 'mem=', 'mem_free=', 'vmem=' or 'h_vmem=' (per slot) in '-l'
+
+Memory sizes are numbers with an optional K, M, G or T suffix. Numbers without a suffix are in MB (as in SLURM's --mem).
+Jobs request 1 cpu and no memory by default.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import re
+
+
+RESOURCE_KEYS = ["cpus", "mem"]
+MEM_UNITS = {"K": 1.0 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024}
+# '-l' resources holding memory per job, and per slot (multiplied by the number of cpus)
+MEM_RESOURCES = ["mem", "mem_free", "vmem"]
+MEM_PER_SLOT_RESOURCES = ["h_vmem"]
+
+
+def parse_mem(value):
+    """ Returns a memory size (e.g. 500M, 16G or 2048) in MB. Raises ValueError if the size can't be parsed.
+    """
+
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError("Unrecognised memory size '%s'" % value)
+    return int(float(match.group(1)) * MEM_UNITS[match.group(2).upper() or "M"])
+
+
+def get_qsub_resources(opts):
+    """ Returns the cpus and memory (MB) requested in qsub_params 'opts'. None for resources not requested.
+    """
+
+    cpus = None
+    mem = None
+    mem_per_cpu = None
+    for opt, value in opts.items():
+        value = str(value)
+        try:
+            if opt == "-pe":
+                cpus = int(value.split()[-1])
+            elif opt in ["--cpus-per-task", "-c"]:
+                cpus = int(value)
+            elif opt == "--mem":
+                mem = parse_mem(value)
+            elif opt == "--mem-per-cpu":
+                mem_per_cpu = parse_mem(value)
+            elif opt == "-l":
+                for resource in re.split(r"[,:\s]+", value):
+                    name, _, size = resource.partition("=")
+                    if name == "ppn":
+                        cpus = int(size)
+                    elif name in MEM_RESOURCES:
+                        mem = parse_mem(size)
+                    elif name in MEM_PER_SLOT_RESOURCES:
+                        mem_per_cpu = parse_mem(size)
+        except (ValueError, IndexError):
+            # Not a resource request the scheduler understands. Left to the job manager
+            pass
+    if mem is None and mem_per_cpu is not None:
+        mem = mem_per_cpu * (cpus or 1)
+    return cpus, mem
+
+
+def get_step_resources(params):
+    """ Returns (cpus, mem in MB) requested by each job of a step with parameters params (see module docstring)
+    """
+
+    qsub_opts = (params.get("qsub_params") or {}).get("opts") or {}
+    cpus, mem = get_qsub_resources(qsub_opts)
+    resources = params.get("resources") or {}
+    if resources.get("cpus"):
+        cpus = int(resources["cpus"])
+    if resources.get("mem"):
+        mem = parse_mem(resources["mem"])
+    return cpus or 1, mem or 0
@@ -0,0 +1,202 @@
+""" The journal of the states of the jobs in run_index
+
+The states of the jobs used to be written to run_index by each job with locksed, i.e. by rewriting the whole file under
+a lock, three times per job. Instead, each change is now appended as a single line to the journal (run_index.journal):
+
+    <job id>\t<state>\t<pid or job id, if any>
+
+run_index is kept as a view of the current states, in the same format as before (see apply_record()). Compacting applies
+the records added to the journal since the last compaction to run_index, and stores the offset of the records applied in
+run_index.journal.offset. The journal is then rotated to run_index.journal.1, so that it does not grow for the lifetime
+of the workflow. The offset file then holds two offsets, of the records applied in the rotated journal and in the new
+journal (0). Records appended to the rotated journal by jobs which opened it before the rotation are applied by the next
+compaction, which removes it. Compaction is done when steps finish, by the local scheduler and by running this module:
+
+    python -m neatseq_flow.modules.run_journal <run_index>         # Compact
+    python -m neatseq_flow.modules.run_journal <run_index> --view  # Print the current view, without compacting
+
+Readers needing the current states (e.g. the kill scripts) apply the records after the offsets to run_index without
+writing it (see run_index_view in 97.helper_funcs.sh). Compaction holds the lock (run_index.lock) and readers take it
+shared, so that they do not see a compaction half done. The jobs appending to the journal never take the lock.
+The same rules are implemented in awk in the helper functions of the executors (see ScriptConstructor).
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import sys
+import fcntl
+import argparse
+
+
+JOURNAL_SUFFIX = ".journal"
+OFFSET_SUFFIX = ".offset"
+ROTATED_SUFFIX = ".1"
+# States of jobs which are held or running. All other states are final (done, ERROR, TERMINATED, killed)
+ACTIVE_STATES = ["hold", "running", "PID"]
+
+
+def get_journal_filename(run_index):
+
+    return run_index + JOURNAL_SUFFIX
+
+
+def append_records(run_index, records):
+    """ Appends records, a list of (job id, state, pid or None), to the journal in a single write
+    """
+
+    if not records:
+        return
+    with open(get_journal_filename(run_index), "a") as journal_fh:
+        journal_fh.write("".join("{id}\t{state}\t{value}\n".format(id=job_id,
+                                                                  state=state,
+                                                                  value=value if value is not None else "")
+                                 for job_id, state, value in records))
+
+
+def get_line_id(line):
+
+    return line[2:].split("\t")[0] if line.startswith("# ") else line.split("\t")[0]
+
+
+def apply_record(line, job_id, state, value):
+    """ Returns the run_index line of a job after a change to state:
+        'hold' is set only for jobs not active in run_index (a commented line), or held jobs. A job is held by the
+            script submitting it, and again, with its pid, by NSF_exec.sh (see register_job in 97.helper_funcs.sh)
+        'running' and 'PID' are set only for active jobs
+        A final state is set only for active jobs, and makes them not active (so the first final state set is kept)
+    """
+
+    active = not line.startswith("#")
+    if state == "hold":
+        if not active or line.split("\t")[1:2] == ["hold"]:
+            return "\t".join([job_id, state] + ([value] if value else []))
+    elif state in ACTIVE_STATES:
+        if active:
+            return "\t".join([job_id, state] + ([value] if value else []))
+    elif active:
+        return "# {id}\t{state}".format(id=job_id, state=state)
+    return line
+
+
+def read_offsets(run_index):
+    """ Returns the offsets of the records applied in the rotated journal (None if it was already applied and removed)
+        and in the journal
+    """
+
+    try:
+        with open(get_journal_filename(run_index) + OFFSET_SUFFIX, "r") as offset_fh:
+            offsets = [int(offset) for offset in offset_fh.read().split()]
+    except (IOError, OSError, ValueError):
+        return None, 0
+    if len(offsets) == 2:
+        return offsets[0], offsets[1]
+    return None, offsets[0] if offsets else 0
+
+
+def write_offsets(run_index, *offsets):
+
+    offset_file = get_journal_filename(run_index) + OFFSET_SUFFIX
+    with open(offset_file + ".tmp", "w") as offset_fh:
+        offset_fh.write(" ".join("%d" % offset for offset in offsets) + "\n")
+    os.replace(offset_file + ".tmp", offset_file)
+
+
+def read_records(filename, offset):
+    """ Returns the records in a journal from offset. A record still being written (not ending with a newline) is not
+        returned
+    """
+
+    try:
+        with open(filename, "rb") as journal_fh:
+            journal_fh.seek(offset)
+            records = journal_fh.read()
+    except (IOError, OSError):
+        return b""
+    return records[:records.rfind(b"\n") + 1]
+
+
+def fold(run_index):
+    """ Returns the lines of run_index with the records in the journals after the offsets applied, and the offset in
+        the journal after the last record applied. Raises IOError if run_index does not exist.
+        Called under the lock (see get_view() and compact())
+    """
+
+    rotated_offset, offset = read_offsets(run_index)
+    with open(run_index, "r") as run_index_fh:
+        lines = run_index_fh.read().split("\n")
+    index = {get_line_id(line): ind for ind, line in enumerate(lines) if line and line != "----"}
+    journal = get_journal_filename(run_index)
+    records = read_records(journal, offset)
+    rotated_records = b""
+    if rotated_offset is not None:
+        rotated_records = read_records(journal + ROTATED_SUFFIX, rotated_offset)
+    for record in (rotated_records + records).decode("utf8", "replace").splitlines():
+        fields = record.split("\t")
+        if len(fields) < 2 or fields[0] not in index:
+            continue
+        ind = index[fields[0]]
+        lines[ind] = apply_record(lines[ind], fields[0], fields[1], fields[2] if len(fields) > 2 else "")
+
+    return lines, offset + len(records)
+
+
+def get_view(run_index):
+    """ Returns the lines of run_index with the records added to the journal since the last compaction applied, and
+        the offset in the journal after the last record applied. Raises IOError if run_index does not exist.
+    """
+
+    with open(run_index + ".lock", "a") as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_SH)
+        return fold(run_index)
+
+
+def compact(run_index):
+    """ Applies the records added to the journal since the last compaction to run_index, and rotates the journal.
+        Returns False if run_index does not exist.
+    """
+
+    journal = get_journal_filename(run_index)
+    with open(run_index + ".lock", "a") as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        rotated_offset, offset = read_offsets(run_index)
+        try:
+            lines, new_offset = fold(run_index)
+        except (IOError, OSError):
+            return False
+        if rotated_offset is None and new_offset == offset == 0:
+            return True
+        # run_index is replaced before the offsets are written, and the rotated journal is removed after, so that a
+        # crash at any point at most causes records to be applied twice
+        with open(run_index + ".tmp", "w") as run_index_fh:
+            run_index_fh.write("\n".join(lines))
+        os.replace(run_index + ".tmp", run_index)
+        write_offsets(run_index, new_offset)
+        if os.path.exists(journal + ROTATED_SUFFIX):
+            os.remove(journal + ROTATED_SUFFIX)
+        if new_offset > 0 and os.path.isfile(journal):
+            write_offsets(run_index, new_offset, 0)
+            os.replace(journal, journal + ROTATED_SUFFIX)
+
+    return True
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description="Apply the job states in the journal to run_index")
+    parser.add_argument("run_index", help="The run_index file (objects/run_index.txt)")
+    parser.add_argument("--view", help="Print the current run_index, without writing it", action="store_true")
+    args = parser.parse_args(args)
+
+    if not os.path.isfile(args.run_index):
+        sys.exit("{run_index} not found".format(run_index=args.run_index))
+    if args.view:
+        sys.stdout.write("\n".join(get_view(args.run_index)[0]))
+    else:
+        compact(args.run_index)
+
+
+if __name__ == "__main__":
+    main()
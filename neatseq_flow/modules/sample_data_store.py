@@ -0,0 +1,244 @@
+""" On-disk store for the sample_data and provenance of completed steps
+
+Used when 'sample_data_store' is set to 'sqlite' in the Global_params. Once a step's scripts are built, its
+sample_data and provenance are written to an SQLite database in the objects dir and replaced with read-only views
+reading from the database. The sample_data of later steps is layered on these views (see layered_sample_data), so only
+the step currently being built is held in memory.
+
+Each top level key (a sample, 'project_data', 'samples' etc.) is stored in a '<table>_keys' table. The slots of dict
+keys (i.e. samples) are stored in a '<table>_slots' table, indexed by (step, sample, slot). Values are JSON encoded.
+Recently read rows are kept in a bounded LRU cache.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import json
+# sqlite3 is imported when a store is created. Importing it slows down startup.
+from collections import OrderedDict
+from collections.abc import Mapping
+
+from .layered_sample_data import IMMUTABLE_TYPES, copy_value, get_raw_value, is_mapping, json_default
+
+
+SAMPLE_DATA_STORE_TYPES = ["memory", "sqlite"]
+DEFAULT_CACHE_SIZE = 100000
+# Seconds to wait for the database to be unlocked, when steps are built in parallel (see parallel_build)
+LOCK_TIMEOUT = 3600
+
+STORE_TABLES = ["sample_data", "provenance"]
+
+
+class SampleDataStore(object):
+    """ An SQLite database of step sample data, with an LRU cache of recently read rows
+    """
+
+    def __init__(self, filename, cache_size=DEFAULT_CACHE_SIZE):
+
+        # The store is specific to a run. Removing leftovers of previous runs with the same run code
+        if os.path.isfile(filename):
+            os.remove(filename)
+        self.filename = filename
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        import sqlite3
+
+        self.conn = sqlite3.connect(filename, timeout=LOCK_TIMEOUT)
+        # The store is rebuilt on every run, so durability is not required
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        for table in STORE_TABLES:
+            self.conn.execute("""CREATE TABLE {table}_keys (step TEXT, pos INTEGER, key TEXT, is_dict INTEGER,
+                                 value TEXT, PRIMARY KEY (step, key)) WITHOUT ROWID""".format(table=table))
+            self.conn.execute("CREATE INDEX {table}_keys_pos ON {table}_keys (step, pos)".format(table=table))
+            self.conn.execute("""CREATE TABLE {table}_slots (step TEXT, key TEXT, pos INTEGER, slot TEXT,
+                                 value TEXT, PRIMARY KEY (step, key, slot)) WITHOUT ROWID""".format(table=table))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def reconnect(self):
+        """ Opens a new connection to the database. Used in forked processes, which can not use the connection of the
+            parent process. The inherited connection is kept as is, since closing it would affect the parent process.
+        """
+        import sqlite3
+
+        self.inherited_conn = self.conn
+        self.conn = sqlite3.connect(self.filename, timeout=LOCK_TIMEOUT)
+
+    def _cache_get(self, cache_key):
+        """ Returns a cached row, marking it as recently used. Raises KeyError if not cached
+        """
+        value = self.cache[cache_key]
+        self.cache.move_to_end(cache_key)
+        return value
+
+    def _cache_set(self, cache_key, value):
+
+        self.cache[cache_key] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def put_step(self, table, step, data):
+        """ Writes the data of a step (a sample_data or provenance mapping) to the store.
+            Returns a read-only view of the stored data.
+        """
+
+        def key_rows():
+            for pos, key in enumerate(data):
+                value = get_raw_value(data, key)
+                if is_mapping(value):
+                    yield step, pos, key, 1, None
+                else:
+                    yield step, pos, key, 0, json.dumps(value, default=json_default)
+
+        def slot_rows():
+            for key in data:
+                value = get_raw_value(data, key)
+                if is_mapping(value):
+                    for pos, slot in enumerate(value):
+                        yield step, key, pos, slot, json.dumps(get_raw_value(value, slot), default=json_default)
+
+        self.conn.executemany("INSERT INTO {table}_keys VALUES (?,?,?,?,?)".format(table=table), key_rows())
+        self.conn.executemany("INSERT INTO {table}_slots VALUES (?,?,?,?,?)".format(table=table), slot_rows())
+        self.conn.commit()
+
+        return StoredSampleData(self, table, step)
+
+    def get_key(self, table, step, key):
+        """ Returns (is_dict, value) for a top level key. value is None for dicts. Raises KeyError
+        """
+        cache_key = (table, step, key)
+        try:
+            return self._cache_get(cache_key)
+        except KeyError:
+            pass
+        row = self.conn.execute("SELECT is_dict, value FROM {table}_keys WHERE step=? AND key=?".format(table=table),
+                                (step, key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        result = (True, None) if row[0] else (False, json.loads(row[1]))
+        self._cache_set(cache_key, result)
+        return result
+
+    def get_keys(self, table, step):
+        """ Returns a generator of the top level keys of a step, in order
+        """
+        cursor = self.conn.execute("SELECT key FROM {table}_keys WHERE step=? ORDER BY pos".format(table=table),
+                                   (step,))
+        return (row[0] for row in cursor)
+
+    def get_slot_names(self, table, step, key):
+        """ Returns the list of slots of a top level dict key, in order.
+            The values of the slots are read as well, since they are usually required next.
+        """
+        cache_key = (table, step, key, None)
+        try:
+            return self._cache_get(cache_key)
+        except KeyError:
+            pass
+        slots = list()
+        for slot, value in self.conn.execute("SELECT slot, value FROM {table}_slots WHERE step=? AND key=? "
+                                             "ORDER BY pos".format(table=table), (step, key)):
+            slots.append(slot)
+            self._cache_set((table, step, key, slot), json.loads(value))
+        self._cache_set(cache_key, slots)
+        return slots
+
+    def get_slot(self, table, step, key, slot):
+        """ Returns the value of a slot. Raises KeyError
+        """
+        cache_key = (table, step, key, slot)
+        try:
+            return self._cache_get(cache_key)
+        except KeyError:
+            pass
+        row = self.conn.execute("SELECT value FROM {table}_slots "
+                                "WHERE step=? AND key=? AND slot=?".format(table=table), (step, key, slot)).fetchone()
+        if row is None:
+            raise KeyError(slot)
+        value = json.loads(row[0])
+        self._cache_set(cache_key, value)
+        return value
+
+
+class StoredMapping(Mapping):
+    """ Base class for read-only views of stored data. Mutable values read from them are copies.
+    """
+
+    def get_raw(self, key):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+
+        value = self.get_raw(key)
+        if isinstance(value, StoredMapping) or isinstance(value, IMMUTABLE_TYPES):
+            return value
+        return copy_value(value)
+
+    def __contains__(self, key):
+        try:
+            self.get_raw(key)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __deepcopy__(self, memo):
+        return self.to_dict()
+
+    def to_dict(self):
+        """ Returns the data as a regular (nested) dict
+        """
+        return {key: copy_value(self.get_raw(key)) for key in self}
+
+
+class StoredSampleData(StoredMapping):
+    """ Read-only view of the stored sample_data (or provenance) of a step
+    """
+
+    def __init__(self, store, table, step):
+        self.store = store
+        self.table = table
+        self.step = step
+
+    def get_raw(self, key):
+
+        is_dict, value = self.store.get_key(self.table, self.step, key)
+        if is_dict:
+            return StoredSampleSlots(self.store, self.table, self.step, key)
+        return value
+
+    def __iter__(self):
+        return self.store.get_keys(self.table, self.step)
+
+    def to_dict(self):
+        return {key: value.to_dict() if isinstance(value, StoredMapping) else copy_value(value)
+                for key, value
+                in ((key, self.get_raw(key)) for key in self)}
+
+
+class StoredSampleSlots(StoredMapping):
+    """ Read-only view of the stored slots of a sample (or project_data) in a step
+    """
+
+    def __init__(self, store, table, step, key):
+        self.store = store
+        self.table = table
+        self.step = step
+        self.key = key
+
+    def get_raw(self, slot):
+        return self.store.get_slot(self.table, self.step, self.key, slot)
+
+    def __iter__(self):
+        return iter(self.store.get_slot_names(self.table, self.step, self.key))
@@ -0,0 +1,215 @@
+""" A compact graph of step instances and their bases
+
+Step names are interned to integer ids and the base/child adjacency is stored in flat arrays (CSR layout).
+Used by PLC_main for expanding dependencies, sorting the steps and checking instance names.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import heapq
+from array import array
+
+
+class StepGraph(object):
+    """ Dependency graph of step instances.
+        Edges point from a base to the steps based on it.
+    """
+
+    def __init__(self, base_dict):
+        """ base_dict: dict of form {step_name: [list of direct bases]}
+            Empty base names (as used for 'merge') are ignored.
+        """
+
+        # Interning names to integer ids:
+        self.names = list(base_dict.keys())
+        self.ids = {name: ind for ind, name in enumerate(self.names)}
+        num_nodes = len(self.names)
+
+        # Base adjacency (CSR):
+        self._base_ptr = array("l", [0])
+        self._base_idx = array("l")
+        for name in self.names:
+            for base in base_dict[name] or []:
+                if not base:
+                    continue
+                if base not in self.ids:
+                    raise Exception("Base {base} in step {step} is not defined".format(base=base, step=name),
+                                    "parameters")
+                self._base_idx.append(self.ids[base])
+            self._base_ptr.append(len(self._base_idx))
+
+        # Child adjacency (CSR), built from the base adjacency by counting sort:
+        child_count = array("l", [0] * (num_nodes + 1))
+        for base_id in self._base_idx:
+            child_count[base_id + 1] += 1
+        for ind in range(num_nodes):
+            child_count[ind + 1] += child_count[ind]
+        self._child_ptr = array("l", child_count)
+        self._child_idx = array("l", [0] * len(self._base_idx))
+        fill = array("l", child_count[:num_nodes])
+        for node in range(num_nodes):
+            for base_id in self.get_base_ids(node):
+                self._child_idx[fill[base_id]] = node
+                fill[base_id] += 1
+
+        self._closure_bits = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_base_ids(self, node):
+        return self._base_idx[self._base_ptr[node]:self._base_ptr[node + 1]]
+
+    def get_child_ids(self, node):
+        return self._child_idx[self._child_ptr[node]:self._child_ptr[node + 1]]
+
+    def kahn_order(self, priority=None):
+        """ Returns a list of node ids in topological order (bases before dependents).
+            Ready nodes are released by increasing priority[node] (by id, if priority is None).
+            If the graph contains a cycle, the nodes on and downstream of the cycle are missing from the list.
+        """
+
+        if priority is None:
+            priority = list(range(len(self)))
+        in_degree = array("l", [self._base_ptr[node + 1] - self._base_ptr[node] for node in range(len(self))])
+
+        ready = [(priority[node], node) for node in range(len(self)) if in_degree[node] == 0]
+        heapq.heapify(ready)
+        order = list()
+        while ready:
+            node = heapq.heappop(ready)[1]
+            order.append(node)
+            for child in self.get_child_ids(node):
+                in_degree[child] -= 1
+                if in_degree[child] == 0:
+                    heapq.heappush(ready, (priority[child], child))
+
+        return order
+
+    def find_cycles(self):
+        """ Returns a list of cycles, each as a list of step names (strongly connected components with more than
+            one step, or steps based on themselves). Iterative version of Tarjan's algorithm.
+        """
+
+        index = [-1] * len(self)
+        lowlink = [0] * len(self)
+        on_stack = [False] * len(self)
+        stack = list()
+        cycles = list()
+        counter = 0
+
+        for root in range(len(self)):
+            if index[root] != -1:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, child_pos = work.pop()
+                if child_pos == 0:
+                    index[node] = lowlink[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack[node] = True
+                children = self.get_child_ids(node)
+                if child_pos < len(children):
+                    work.append((node, child_pos + 1))
+                    child = children[child_pos]
+                    if index[child] == -1:
+                        work.append((child, 0))
+                    elif on_stack[child]:
+                        lowlink[node] = min(lowlink[node], index[child])
+                    continue
+                # All children visited. Propagate lowlink to parent and pop component if node is its root:
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = list()
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in self.get_base_ids(node):
+                        cycles.append([self.names[member] for member in sorted(component)])
+
+        return cycles
+
+    def get_closure_bits(self):
+        """ Returns, for every node id, an int bitset of all its ancestors (transitive bases).
+            Computed once, in a single pass over the topological order.
+        """
+
+        if self._closure_bits is None:
+            order = self.kahn_order()
+            if len(order) < len(self):
+                raise Exception("Cannot compute dependencies of a cyclic workflow", "parameters")
+            bits = [0] * len(self)
+            for node in order:
+                node_bits = 0
+                for base_id in self.get_base_ids(node):
+                    node_bits |= bits[base_id] | (1 << base_id)
+                bits[node] = node_bits
+            self._closure_bits = bits
+
+        return self._closure_bits
+
+    def get_closure(self):
+        """ Returns the transitive closure as a dict of form {step_name: [list of all ancestor names]}
+        """
+
+        closure = dict()
+        for node, node_bits in enumerate(self.get_closure_bits()):
+            ancestors = list()
+            while node_bits:
+                low_bit = node_bits & -node_bits
+                ancestors.append(self.names[low_bit.bit_length() - 1])
+                node_bits ^= low_bit
+            closure[self.names[node]] = ancestors
+
+        return closure
+
+    def get_transitive_reduction(self, names):
+        """ Returns the names in 'names' that are not ancestors of other names in 'names', keeping their order.
+        """
+
+        closure_bits = self.get_closure_bits()
+        covered_bits = 0
+        for name in names:
+            covered_bits |= closure_bits[self.ids[name]]
+
+        return [name for name in names if not covered_bits >> self.ids[name] & 1]
+
+    def topological_order(self):
+        """ Returns the list of step names in running order.
+            Steps are sorted by level, i.e. by the number of ancestors and then by name. Since a step always has
+            more ancestors than any of its ancestors, this is also a valid topological order.
+        """
+
+        priority = [(bin(node_bits).count("1"), self.names[node])
+                    for node, node_bits
+                    in enumerate(self.get_closure_bits())]
+
+        return [self.names[node] for node in self.kahn_order(priority)]
+
+    @staticmethod
+    def find_prefix_collisions(labels):
+        """ labels: dict of form {step_name: label}
+            Returns a list of (name1, name2) pairs where the label of name1 is a prefix of the label of name2.
+            After sorting, all labels prefixed by a given label directly follow it, so only those are compared.
+        """
+
+        sorted_labels = sorted((label, name) for name, label in labels.items())
+        collisions = list()
+        for ind, (label1, name1) in enumerate(sorted_labels):
+            next_ind = ind + 1
+            while next_ind < len(sorted_labels) and sorted_labels[next_ind][0].startswith(label1):
+                label2, name2 = sorted_labels[next_ind]
+                collisions.append((name1, name2))
+                if label2 == label1:
+                    collisions.append((name2, name1))
+                next_ind += 1
+
+        return collisions
@@ -6,92 +6,138 @@ __version__ = "1.6.0"
 
 
 
-import re, sys, collections
+import re, sys, copy
 from pprint import pprint as pp
 
+# A regular expression for variables (any contiguous alphanumeric or period between {})
+VAR_RE = re.compile(r"\{(Vars\.[\w\.\-]+?)\}")
+# A variable wrongly interpreted by the YAML parser as a dict, i.e. {Vars.x} without quotes
+MISPARSED_VAR_RE = re.compile(r"Vars\.([\w\.]+?)")
+
+
+class VarsTable(object):
+    """ The variables in the Vars section, by their full name (Vars.x.y, with list elements named by their index,
+        e.g. Vars.x.0).
+        Each variable is resolved once, i.e. the variables referenced in its value are interpolated into it, and
+        the resolved value is kept for all further references.
+    """
+
+    def __init__(self, variables):
+
+        # {name: value as defined in the Vars section}
+        self.defined = dict()
+        self.add_variables(variables, "Vars")
+        # {name: resolved value}
+        self.resolved = dict()
+        # Names of the variables currently being resolved, for detecting circular references
+        self.resolving = list()
+        # Strings already interpolated, with their interpolated values
+        self.strings = dict()
+
+    def add_variables(self, node, name):
+
+        self.defined[name] = node
+        if isinstance(node, dict):
+            for key, value in node.items():
+                self.add_variables(value, "{name}.{key}".format(name=name, key=key))
+        elif isinstance(node, list):
+            for index, value in enumerate(node):
+                self.add_variables(value, "{name}.{index}".format(name=name, index=index))
+
+    def get_value(self, name):
+        """ Returns the resolved value of variable name
+        """
+
+        if name in self.resolved:
+            return self.resolved[name]
+        if name not in self.defined:
+            raise Exception("Unrecognised variable '%s'" % name, "Variables")
+        if name in self.resolving:
+            raise Exception("Circular reference in variables: %s" %
+                            " -> ".join(self.resolving[self.resolving.index(name):] + [name]), "Variables")
+
+        self.resolving.append(name)
+        self.resolved[name] = self.resolve(self.defined[name])
+        self.resolving.pop()
+
+        return self.resolved[name]
+
+    def resolve(self, node):
+        """ Returns a copy of node with the variables in all its strings interpolated
+        """
+
+        if isinstance(node, dict):
+            return {key: self.resolve(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [self.resolve(value) for value in node]
+        if isinstance(node, str):
+            return self.interpolate(node)
+        return node
+
+    def interpolate(self, atom):
+        """ Returns atom with the variables in it replaced by their values.
+            If atom is only a reference to a dict or list variable, a copy of the dict or list is returned.
+        """
+
+        if atom in self.strings:
+            return self.strings[atom]
+
+        match = VAR_RE.fullmatch(atom)
+        if match and isinstance(self.get_value(match.group(1)), (dict, list)):
+            # Not stored in self.strings, since each reference needs its own copy
+            return copy.deepcopy(self.get_value(match.group(1)))
+
+        self.strings[atom] = VAR_RE.sub(self.get_replacement, atom)
+        return self.strings[atom]
+
+    def get_replacement(self, match):
+        """ Returns the string to replace a matched variable with
+        """
+
+        value = self.get_value(match.group(1))
+        if isinstance(value, (dict, list)):
+            raise Exception("Variable '%s' is a %s and can only be used on its own, not as part of a string" %
+                            (match.group(1), type(value).__name__), "Variables")
+        # Converting to str, in case value is int or float
+        return str(value) if value is not None else ""
+
+
 # A closure:
-# Function make_interpol_func returns a function with a local copy of variables_bunch
-# The local copy is loc_variables_bunch, and is set as global so that eval will recognise it.
-def make_interpol_func(variables_bunch):
-    # Define a regular expression for variables (any contiguous alphanumeric or period between {})
-    var_re = re.compile("\{(Vars\.[\w\.\-]+?)\}")
-    global loc_variables_bunch
-    loc_variables_bunch = variables_bunch
-    
+# Function make_interpol_func returns a function with a local VarsTable of variables
+def make_interpol_func(variables):
+
+    vars_table = VarsTable(variables)
+
     # Define function to return:
     def interpol_atom(atom):
 
         if isinstance(atom, str):
-
-            m = var_re.search(atom)
-            if not m:  # No variables match the atom
-                return atom
-
-            # While a match exists:
-            while (m):
-
-                try:
-                    # Replace the matched variable with something from variables_bunch
-                    # Also converting to str, in case value is int or float
-                    repl_str = eval("loc_variables_bunch.%s" % m.group(1))
-                    if repl_str is not None:
-                        repl_str = str(repl_str)
-                    else:
-                        repl_str = ""
-
-                    atom = var_re.sub(repl_str,atom,count=1)
-
-                except AttributeError:
-                    # If not found, raise exception
-                    raise Exception("Unrecognised variable '%s'" % m.group(1), "Variables")
-                except TypeError:
-                    raise Exception("A 'TypeError' exception has occured. This may happen when variables are left "
-                                    "empty. Make sure all your variables have values. ", "Variables")
-                m = var_re.search(atom)
-        if not atom:  # No variables match the atom
+            atom = vars_table.interpolate(atom)
+        if not atom:  # Empty strings are returned as None
             return None
 
         return atom
 
     return interpol_atom
 
-def walk(node, variables_bunch, callback):
+def walk(node, callback):
 
     if isinstance(node,dict):
         # Special case: The dict is actually a variable wrongly interpreted by the YAML parser as a dict!
-        if len(list(node.keys())) == 1 and list(node.values())==[None] and re.match("Vars\.([\w\.]+?)",list(node.keys())[0]):
+        if len(node) == 1 and list(node.values())==[None] and MISPARSED_VAR_RE.match(str(list(node.keys())[0])):
             node = callback("{%s}" % list(node.keys())[0])
         else:
             for key, item in list(node.items()):
-                if isinstance(item, collections.Iterable):
-                    node[key] = walk(item, variables_bunch, callback)
-                elif isinstance(item, str):
-                    # node[key] = interpol_atom(item, variables_bunch)
-                    node[key] = callback(item)
-                else:
-                    # node[key] = item
-                    pass
+                node[key] = walk(item, callback)
     elif isinstance(node,list):
-        # print "in 2\n"
         for i in range(0,len(node)):
-            if isinstance(node[i], collections.Iterable):
-                node[i] = walk(node[i], variables_bunch, callback)
-            elif isinstance(node[i], str):
-                # node[i] = interpol_atom(node[i], variables_bunch)
-                node[i] = callback(node[i])
-            else:
-                pass
-    else:
-        # print "in 3\n"
-        if isinstance(node, str):
-            node = callback(node)
-        else:
-            pass
-#        raise Exception("walk() works on dicts and lists only")
+            node[i] = walk(node[i], callback)
+    elif isinstance(node, str):
+        node = callback(node)
     return node
 
-    
-def test_vars(node):
+
+def test_vars(node, warnings):
 
     if isinstance(node,dict):
         for key in list(node.keys()):
@@ -101,10 +147,11 @@ def test_vars(node):
                 raise Exception("Variables must begin with a alphabetic symbol or underscore (%s)" % key, "Variables")
             if node[key] == None:
                 # sys.stderr.write("It seems you have an empty variable! (%s)" % key)
-                sys.stderr.write("ATTENTION: It seems you have an empty variable! (%s)\n" % key)
-            test_vars(node[key])
+                warnings.append("ATTENTION: It seems you have an empty variable! (%s)\n" % key)
+            test_vars(node[key], warnings)
     elif isinstance(node,list):
-        raise Exception("ERROR: Please don't use lists in variables section!", "Variables")
+        for item in node:
+            test_vars(item, warnings)
     elif type(node) in [str,int,float]:
         pass
     elif node==None:
@@ -0,0 +1,149 @@
+""" Writing and reading the JSON description of the workflow
+
+The workflow data (the global sample_data, pipe_data, the global parameters and the sample_data and parameters of every
+step) used to be written as a single WorkflowData.json. For large workflows this file reaches gigabytes and can not be
+loaded by the monitor or the GUI. It is now split into shards in the objects dir:
+
+    WorkflowData.json               The index: pipe_data, global_params and the relative paths of the shards
+    WorkflowData/sample_data.json   The global sample_data
+    WorkflowData/steps/<step>.json  The sample_data and param_data of each step
+
+Each shard is encoded and written on its own, so only one step's data is held as JSON text at any time. With compact
+set, the JSON is written without indentation.
+
+Consumers can load one step with load_step_data() or the whole workflow, in the layout of the single-file
+WorkflowData.json, with load_workflow_data(). Both also accept a single-file WorkflowData.json from older versions.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import json
+import shutil
+
+from .layered_sample_data import json_default
+
+
+WORKFLOW_DATA_FILENAME = "WorkflowData.json"
+QSUB_NAMES_FILENAME = "qsub_names.json"
+SHARDS_DIRNAME = "WorkflowData"
+# Value of "format" in the index
+SHARDED_FORMAT = "sharded"
+
+
+class WorkflowJSONWriter(object):
+    """ Writes the JSON files of the workflow to objects_dir
+    """
+
+    def __init__(self, objects_dir, compact=False):
+
+        self.objects_dir = objects_dir
+        self.compact = compact
+
+    def encode(self, obj):
+
+        if self.compact:
+            return json.dumps(obj, sort_keys=False, separators=(',', ':'), default=json_default)
+        return json.dumps(obj, sort_keys=False, indent=4, separators=(',', ': '), default=json_default)
+
+    def dump(self, obj, filename):
+        """ Writes obj to filename (relative to objects_dir)
+        """
+
+        with open(os.path.join(self.objects_dir, filename), "w") as json_fh:
+            json_fh.write(self.encode(obj))
+
+    def write_workflow(self, workflow):
+        """ Writes the shards of the workflow's data, and then the index.
+            Shards left from previous runs are removed first.
+        """
+
+        shards_dir = os.path.join(self.objects_dir, SHARDS_DIRNAME)
+        if os.path.isdir(shards_dir):
+            shutil.rmtree(shards_dir)
+        os.makedirs(os.path.join(shards_dir, "steps"))
+
+        index = {"format": SHARDED_FORMAT,
+                 "version": __version__,
+                 "pipe_data": workflow.pipe_data,
+                 "global_params": workflow.param_data["Global"],
+                 "sample_data": "/".join([SHARDS_DIRNAME, "sample_data.json"]),
+                 "step_data": dict()}
+        self.dump(workflow.sample_data, index["sample_data"])
+        for step in workflow.step_list:
+            index["step_data"][step.get_step_name()] = "/".join([SHARDS_DIRNAME,
+                                                                 "steps",
+                                                                 step.get_step_name() + ".json"])
+            self.dump(step.get_dict_encoding(), index["step_data"][step.get_step_name()])
+        self.dump(index, WORKFLOW_DATA_FILENAME)
+
+    def write_qsub_names(self, workflow):
+        """ Writes the qsub names of the steps (can be used by remote progress monitor)
+        """
+
+        self.dump({step.get_step_name(): step.get_qsub_names_dict() for step in workflow.step_list},
+                  QSUB_NAMES_FILENAME)
+
+
+def load_index(filename):
+    """ Returns the index in filename (the path to WorkflowData.json, or the objects dir containing it).
+        A single-file WorkflowData.json is returned as is.
+    """
+
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, WORKFLOW_DATA_FILENAME)
+    with open(filename, "r") as json_fh:
+        index = json.load(json_fh)
+    return index, os.path.dirname(os.path.abspath(filename))
+
+
+def load_shard(objects_dir, shard):
+
+    with open(os.path.join(objects_dir, shard), "r") as json_fh:
+        return json.load(json_fh)
+
+
+def load_step_data(filename, step_name):
+    """ Returns the data of step step_name (a dict with "sample_data" and "param_data"), reading only its shard
+    """
+
+    index, objects_dir = load_index(filename)
+    if step_name not in index["step_data"]:
+        raise Exception("Step %s not found in %s" % (step_name, filename), "parameters")
+    return get_step_data(index, objects_dir, step_name)
+
+
+def get_step_data(index, objects_dir, step_name):
+    """ Returns the data of step step_name from an index already loaded with load_index()
+    """
+
+    if index.get("format") != SHARDED_FORMAT:
+        return index["step_data"][step_name]
+    return load_shard(objects_dir, index["step_data"][step_name])
+
+
+def get_sample_data(index, objects_dir):
+    """ Returns the global sample_data from an index already loaded with load_index()
+    """
+
+    if index.get("format") != SHARDED_FORMAT:
+        return index["sample_data"]
+    return load_shard(objects_dir, index["sample_data"])
+
+
+def load_workflow_data(filename):
+    """ Returns the whole workflow data, as written to the single-file WorkflowData.json: a dict with "sample_data",
+        "pipe_data", "global_params" and "step_data"
+    """
+
+    index, objects_dir = load_index(filename)
+    if index.get("format") != SHARDED_FORMAT:
+        return index
+    return {"sample_data": load_shard(objects_dir, index["sample_data"]),
+            "pipe_data": index["pipe_data"],
+            "global_params": index["global_params"],
+            "step_data": {step_name: load_shard(objects_dir, shard)
+                          for step_name, shard
+                          in index["step_data"].items()}}
@@ -3,12 +3,17 @@ import sys
 import re
 
 from ..PLC_step import AssertionExcept
+from ..modules.global_defs import SUBMIT_PACING_DEFAULTS
 
 from pprint import pprint as pp
 
 __author__ = "Menachem Sklarz"
 __version__ = "1.6.0"
 
+# Prefix of the place holders used when compiling script templates (see LowScriptConstructor.compile_script_template())
+# The place holders include regular expression special characters, so that parts escaping them are not templated.
+TEMPLATE_MARK = "NSFtemplateFIELD"
+
 
 class ScriptConstructor(object):
     """ General class for script construction and management
@@ -27,10 +32,15 @@ class ScriptConstructor(object):
     @classmethod
     def get_helper_script(cls, pipe_data):
         """ Returns the code for the helper script
-            Note. The line with '## locksed command entry point' should be dealt with in inheriting classes.
+            Note. The line with '## job state command entry point' should be dealt with in inheriting classes.
             Either replace with nothing to remove (see scriptConstructorSGE) or replaced with a
-            locksed command, see scriptConstructorLocal.
+            journal_state command, see scriptConstructorLocal.
+            The states of the jobs are appended to the run_index journal by journal_state. run_index_view prints the
+            current run_index and compact_run_index applies the journal to run_index (see modules/run_journal.py).
+            Submissions to the job manager are paced by pace_submit and submit_with_backoff, as defined in the
+            'submit_pacing' global parameter (see SUBMIT_PACING_DEFAULTS).
         """
+        pacing = dict(SUBMIT_PACING_DEFAULTS, **pipe_data.get("submit_pacing", {}))
         script = """\
 #!/bin/bash
 
@@ -75,7 +85,7 @@ func_trap() {{
 
     echo -e $(date '+%d/%m/%Y %H:%M:%S')'\\tFinished\\t'$1'\\t'$2'\\t'$3'\\t'$4'\\t'$5'\\t'$6'\\t'$maxvmem'\\t[0;31m'$err_code'[m' >> {log_file}; 
 
-    ## locksed command entry point
+    ## job state command entry point
     exit 1;
 }}         
 
@@ -105,27 +115,142 @@ log_echo() {{
 
 }}
 
-locksed() {{
-    # $1: program
-    # $2: file
-    # Setting script as done in run index:
-    sedlock=${{2}}.lock
-    exec 200>$sedlock
-    flock -w 4000 200 || exit 1
+run_journal={run_index}.journal
+
+journal_state() {{
+    # Appends a change in the state of a job to the journal
+    # $1: job id
+    # $2: state
+    # $3: pid or job id (optional)
+    printf '%s\\t%s\\t%s\\n' "$1" "$2" "${{3:-}}" >> $run_journal
+}}
+
+fold_run_index() {{
+    # Prints run_index with the records added to the journal since the last compaction applied. Called under the lock
+    # $1: file to write the offset in the journal after the last record applied to (optional)
+    local rotated_offset="" offset="" rotated=/dev/null journal=/dev/null rotated_size=0 size=0
+    if [ -f $run_journal.offset ]; then read -r rotated_offset offset < $run_journal.offset || true; fi
+    # A single offset is the offset in the journal. Two are the offsets in the rotated journal and in the journal
+    if [ -z "$offset" ]; then offset=${{rotated_offset:-0}}; rotated_offset=""; fi
+    if [ -n "$rotated_offset" ] && [ -f $run_journal.1 ]; then
+        rotated=$run_journal.1; rotated_size=$(wc -c < $rotated)
+    fi
+    if [ -f $run_journal ]; then journal=$run_journal; size=$(wc -c < $journal); fi
+    LC_ALL=C awk -F'\\t' -v rotated_start=${{rotated_offset:-0}} -v rotated_end=$rotated_size \\
+        -v start=$offset -v end=$size -v offset_out="${{1:-}}" '
+        FILENAME == ARGV[1] {{
+            lines[FNR] = $0; nlines = FNR
+            id = $1; sub(/^# /, "", id)
+            if ($0 != "" && $0 != "----") line_of[id] = FNR
+            next
+        }}
+        FNR == 1 {{ pos = 0 }}
+        {{
+            from = pos; pos += length($0) + 1
+            # Records already applied, and a record still being written, are not applied
+            if (FILENAME == ARGV[2]) {{ if (from < rotated_start || pos > rotated_end) next }}
+            else {{ if (from < start || pos > end) next; applied = pos }}
+            if (!($1 in line_of)) next
+            ind = line_of[$1]
+            active = (lines[ind] !~ /^#/)
+            record = ($3 == "") ? $1 "\\t" $2 : $1 "\\t" $2 "\\t" $3
+            if ($2 == "hold") {{ if (!active || lines[ind] ~ /^[^\\t]*\\thold/) lines[ind] = record }}
+            else if ($2 == "running" || $2 == "PID") {{ if (active) lines[ind] = record }}
+            else if (active) lines[ind] = "# " $1 "\\t" $2
+        }}
+        END {{
+            for (i = 1; i <= nlines; i++) print lines[i]
+            if (offset_out != "") print (applied > start ? applied : start) > offset_out
+        }}' $run_index $rotated $journal
+}}
 
-    # echo do sed 
-    sed -i -e "$1" $2
+run_index_view() {{
+    # Prints the current run_index. The lock is taken shared, so that a compaction is not seen half done
+    (
+        flock -s -w 600 201 || exit 1
+        fold_run_index
+    ) 201> $run_index.lock
+}}
+
+compact_run_index() {{
+    # Applies the records added to the journal since the last compaction to run_index, and rotates the journal
+    if [ ! -f $run_index ]; then return 0; fi
+    (
+        flock -w 600 201 || exit 1
+        # run_index is replaced before the offsets are written, and the rotated journal is removed after
+        # (see modules/run_journal.py)
+        fold_run_index $run_journal.offset.tmp > $run_index.tmp && \\
+            mv $run_index.tmp $run_index && mv $run_journal.offset.tmp $run_journal.offset || exit 1
+        rm -f $run_journal.1
+        read -r offset < $run_journal.offset
+        if [ "$offset" -gt 0 ] && [ -f $run_journal ]; then
+            echo "$offset 0" > $run_journal.offset.tmp && mv $run_journal.offset.tmp $run_journal.offset && \\
+                mv $run_journal $run_journal.1
+        fi
+    ) 201> $run_index.lock
+}}
+
+submit_lock={run_index}.submit.lock
+submit_interval={submit_interval}
+submit_retries={retries}
+submit_backoff={backoff}
+submit_max_backoff={max_backoff}
+
+pace_submit() {{
+    # Caps the rate of submissions from all the scripts of the workflow: Each submission holds the submission lock for
+    # submit_interval seconds. Does nothing if no rate is set in submit_pacing
+    if [ -n "$submit_interval" ]; then
+        ( flock 202; sleep $submit_interval ) 202> $submit_lock
+    fi
+}}
 
-    # echo unlock
-    flock -u 200
+submit_with_backoff() {{
+    # Executes the submission command "$@". If the job manager reports an error (e.g. a queue limit was reached), the
+    # command is retried after submit_backoff seconds, doubling the wait on every retry up to submit_max_backoff
+    local delay=$submit_backoff
+    local attempt=1
+    pace_submit
+    until "$@"; do
+        if [ $attempt -ge $submit_retries ]; then
+            echo "Submission failed $attempt times: $*" >&2
+            return 1
+        fi
+        echo "Submission failed. Retrying in $delay seconds" >&2
+        sleep $delay
+        delay=$(( delay * 2 < submit_max_backoff ? delay * 2 : submit_max_backoff ))
+        attempt=$(( attempt + 1 ))
+        pace_submit
+    done
 }}
 
 """.format(log_file=pipe_data["log_file"],
            qstat_path=pipe_data["qsub_params"]["qstat_path"],
-           run_index=pipe_data["run_index"])
+           run_index=pipe_data["run_index"],
+           submit_interval="%g" % (1.0 / pacing["rate"]) if pacing["rate"] else "",
+           retries=pacing["retries"],
+           backoff=pacing["backoff"],
+           max_backoff=pacing["max_backoff"])
 
         return script
 
+    @classmethod
+    def get_recovery_script(cls, pipe_data):
+        """ Returns the code for re-executing the failed jobs of a run (see modules/recovery.py)
+        """
+
+        return """\
+#!/bin/bash
+
+# Re-executes the jobs which failed or did not finish, and the jobs depending on them.
+# Use '--samples s1 s2' or '--steps step1 step2' to re-execute only the failed jobs of some samples or steps,
+# '--dry_run' to only list the jobs and '--force' to re-execute jobs which did not finish even if they may still be
+# running or queued
+
+PYTHONPATH={package_dir}${{PYTHONPATH:+:$PYTHONPATH}} {python} -m neatseq_flow.modules.recovery {objects_dir} "$@"
+""".format(package_dir=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+           python=sys.executable,
+           objects_dir=pipe_data["objects_dir"])
+
     @classmethod
     def get_exec_script(cls, pipe_data):
         """ Returns the code for the helper script
@@ -157,7 +282,7 @@ echo "Running script: " $script_path
 
 # 2. Marking in run_index as running
 
-locksed "s:# \($qsubname\).*:\\1\\thold:" $run_index
+journal_state $qsubname hold
 
 # 3. Getting script dependencies
 
@@ -173,19 +298,19 @@ while [ $flag -eq 0 ]
 do
     if [ -f {run_index}.killall ]; then
         echo -e $run_index ".killall file created. Stopping all waiting jobs. \\nMake sure you delete the file before re-running!"
-        locksed "s:\($qsubname\).*:# \\1\\tkilled:" $run_index
+        journal_state $qsubname killed
         kill $$;
         exit 1;
     fi
     if [ ! -f {run_index} ]; then
         echo $run_index " file deleted. Stopping all waiting jobs"
-        locksed "s:\($qsubname\).*:# \\1\\tkilled:" $run_index
+        journal_state $qsubname killed
         kill $$;
         exit 1;
     fi
 
     # Get running jobs
-    running=$(grep -v "^#" $run_index)
+    running=$(run_index_view | grep -v "^#")
     # running=(${{running//\\n/ }})
     running=($(echo ${{running}})) 
 
@@ -260,7 +385,8 @@ done
     def __del__(self):
         """ Close filehandle when destructing class
         """
-        self.filehandle.close()
+        if getattr(self, "filehandle", None) is not None:
+            self.filehandle.close()
     
     def __str__(self):
         print("%s - %s - %s" % (self.step , self.name , self.shell))
@@ -370,6 +496,30 @@ while :; do if source {activate_path} {environ}; then break; else sleep 2; fi; d
     def write_command(self, command):
     
         self.filehandle.write(command)
+
+    def open_script(self, reuse_script=False):
+        """ Opens the script file. If reuse_script is True, an existing script is left as is until restart_script() is
+            called. Used for keeping the scripts of steps which may not have to be rebuilt (see modules/build_cache.py)
+        """
+
+        if reuse_script:
+            self.filehandle = open(self.script_path, "a")
+        else:
+            self.filehandle = open(self.script_path, "w")
+            self.start_script()
+
+    def start_script(self):
+        """ Writes the lines written when the script is opened. Defined in inheriting classes
+        """
+        pass
+
+    def restart_script(self):
+        """ Empties a script opened with reuse_script, for rewriting it
+        """
+
+        self.filehandle.seek(0)
+        self.filehandle.truncate()
+        self.start_script()
                 
 
 # ----------------------------------------------------------------------------------
@@ -393,7 +543,7 @@ class HighScriptConstructor(ScriptConstructor):
         self.script_id = self.master.jid_name_sep.join([self.script_id, self.pipe_data["run_code"]])
         self.level = "high"
         
-        self.filehandle = open(self.script_path, "w")
+        self.open_script(kwargs.get("reuse_script", False))
 
     def main_script_kill_commands(self, kill_script_filename_main):
         """
@@ -423,15 +573,17 @@ class HighScriptConstructor(ScriptConstructor):
 
         # Unsetting error trapping and flags before qalter, since qalter usually fails
         # (because dependencies don't exist, etc.)
+        # No waiting for the jobs to enter the queue: Jobs are registered when they are submitted
+        # The closing mark ends the code of the last low level job (see modules/recovery.py)
         script = """
-sleep {sleep}
+# ---------------- Closing {script_id} ------------------
 
 trap '' ERR
 
 {set_line}
 
 {log_line}
-""".format(sleep = self.pipe_data["Default_wait"],
+""".format(script_id = self.script_id,
            set_line = self.get_set_options_line(type = "unset"),
            log_line = self.get_log_lines(state = "Finished"))
 
@@ -457,6 +609,27 @@ trap '' ERR
 class LowScriptConstructor(ScriptConstructor):
     """
     """
+
+    # The parts of the script, in order: (method, keyword arguments). None stands for the script itself.
+    # The parts are joined with newlines, except for the last part (get_script_closing()) which is appended as is.
+    script_parts = [("get_script_preamble", {}),
+                    ("get_trap_line", {}),
+                    ("get_log_lines", {"state": "Started"}),
+                    ("get_activate_lines", {"type": "activate"}),
+                    ("get_set_options_line", {"type": "set"}),
+                    ("test_executed", {"state": "Start"}),
+                    (None, None),
+                    ("test_executed", {"state": "Stop"}),
+                    ("get_stamped_file_register", {}),
+                    ("get_set_options_line", {"type": "unset"}),
+                    # ("get_activate_lines", {"type": "deactivate"}),
+                    ("get_kill_line", {"state": "Stop"}),
+                    ("get_log_lines", {"state": "Finished"}),
+                    ("get_script_closing", {})]
+    # Parts depending on the stamped files. Not templated when the script has stamped files
+    stamped_file_parts = ["test_executed", "get_stamped_file_register"]
+    # Set to False to render all parts for every script
+    use_script_template = True
     
     def __init__(self,  **kwargs):
 
@@ -480,7 +653,9 @@ class LowScriptConstructor(ScriptConstructor):
 
         self.script_id = self.master.jid_name_sep.join([self.script_id, self.pipe_data["run_code"]])
         self.level = "low"
-        self.filehandle = open(self.script_path, "w")
+        # Scripts of array job tasks are not written to their own file (see ArrayScriptConstructor)
+        if kwargs.get("open_script", True):
+            self.filehandle = open(self.script_path, "w")
 
     def get_kill_line(self, state = "Start"):
         """ Add and remove qdel lines from qdel file.
@@ -570,25 +745,99 @@ if [ -e {filename} ]; then {echo_cmd} `date '+%%d/%%m/%%Y %%H:%%M:%%S'` '\\t{ste
         #              stamped_files,
         #              **kwargs):
         """ Assembles the scripts to writes to file
+            The parts which are the same in all the step's scripts are rendered once per step (see
+            get_script_template()). Only the script body, the stamped files lines and parts which could not be
+            compiled into the template are rendered for each script.
         """
 
-        script = "\n".join([
-            self.get_script_preamble(),  #dependency_jid_list
-            self.get_trap_line(),
-            self.get_log_lines(state="Started"),
-            self.get_activate_lines(type = "activate"),
-            self.get_set_options_line(type = "set"),
-            self.test_executed(state="Start"),
+        self.write_command(self.render_script())
+
+    def render_script(self):
+        """ Returns the text of the script
+        """
+
+        if not self.use_script_template:
+            return self.render_script_parts(range(len(self.script_parts)))
+
+        template, dynamic_parts = self.get_script_template()
+        return template.format(script_id=self.script_id,
+                               script_path=self.script_path,
+                               **self.render_script_parts(dynamic_parts, as_fields=True))
+
+    def get_script_part(self, part_ind):
+        """ Returns the text of part number part_ind in script_parts
+        """
+
+        method, kwargs = self.script_parts[part_ind]
+        if method is None:
             # THE SCRIPT!!!!
-            self.master.script,
-            self.test_executed(state="Stop"),
-            self.get_stamped_file_register(),
-            self.get_set_options_line(type = "unset"),
-            # self.get_activate_lines(type = "deactivate"),
-            self.get_kill_line(state = "Stop"),
-            self.get_log_lines(state = "Finished")])
+            return self.master.script
+        return getattr(self, method)(**kwargs)
 
-        self.write_command(script)
+    def render_script_parts(self, part_inds, as_fields=False):
+        """ Returns the script assembled from the parts in part_inds, or, if as_fields is True, a dict of template
+            fields for the parts
+        """
+
+        if as_fields:
+            return {"part{ind}".format(ind=part_ind): self.get_script_part(part_ind) for part_ind in part_inds}
+        parts = [self.get_script_part(part_ind) for part_ind in part_inds]
+        return "\n".join(parts[:-1]) + parts[-1]
+
+    def get_script_template(self):
+        """ Returns the step's script template for the current dependencies and (template, list of dynamic parts).
+            Templates are compiled once per step and dependency list (see compile_script_template())
+        """
+
+        template_key = (type(self),
+                        tuple(self.master.dependency_jid_list or []),
+                        tuple(getattr(self.master, "dependency_glob_jid_list", None) or []),
+                        bool(self.master.stamped_files))
+        if template_key not in self.master.script_templates:
+            self.master.script_templates[template_key] = self.compile_script_template()
+        return self.master.script_templates[template_key]
+
+    def compile_script_template(self):
+        """ Compiles script_parts into a str.format() template with 'script_id' and 'script_path' fields.
+            Each part is rendered with place holders for the fields. The script body, the stamped files lines and
+            parts which transform the place holders (e.g. with re.escape()) can not be templated. They are added as
+            'part<N>' fields and rendered for each script.
+            Returns (template, list of dynamic parts)
+        """
+
+        fields = {"script_id": self.script_id, "script_path": self.script_path}
+        place_holders = {field: "{mark}.{field}-".format(mark=TEMPLATE_MARK, field=field) for field in fields}
+
+        template_parts = list()
+        dynamic_parts = list()
+        for part_ind, (method, kwargs) in enumerate(self.script_parts):
+            text = None
+            if method is not None and not (self.master.stamped_files and method in self.stamped_file_parts):
+                for field in fields:
+                    setattr(self, field, place_holders[field])
+                try:
+                    text = self.get_script_part(part_ind)
+                finally:
+                    for field in fields:
+                        setattr(self, field, fields[field])
+                text = text.replace("{", "{{").replace("}", "}}")
+                for field in fields:
+                    text = text.replace(place_holders[field], "{%s}" % field)
+                if TEMPLATE_MARK.lower() in text.lower():
+                    text = None
+            if text is None:
+                dynamic_parts.append(part_ind)
+                text = "{part%d}" % part_ind
+            template_parts.append(text)
+
+        return "\n".join(template_parts[:-1]) + template_parts[-1], dynamic_parts
+
+    def get_script_closing(self):
+        """ Returns lines to add at the end of the script, after the 'Finished' log lines.
+            Defined in executors which mark finished scripts in the run index.
+        """
+
+        return ""
 
     def get_script_preamble(self):   #dependency_jid_list
     
@@ -599,6 +848,108 @@ if [ -e {filename} ]; then {echo_cmd} `date '+%%d/%%m/%%Y %%H:%%M:%%S'` '\\t{ste
         return script
         
         
+# ----------------------------------------------------------------------------------
+# ArrayScriptConstructor defintion
+# ----------------------------------------------------------------------------------
+
+
+class ArrayScriptConstructor(LowScriptConstructor):
+    """ A single array job running the low level scripts of a step as its tasks (see 'array_jobs' and
+        Step.add_array_task()).
+        The task scripts are written one after the other to a tasks file. The manifest lists the tasks, one per line:
+        task index (from 1), script id, task name (e.g. the sample), and the offset and length (in bytes) of the
+        task's script in the tasks file. The array script looks up its task in the manifest and runs the task's script.
+        Inheriting classes add the array definition to the script header and set task_index_var, the variable in
+        which the scheduler passes the task index.
+    """
+
+    # Whether the tasks of the array job can wait for the corresponding tasks of other array jobs only
+    supports_task_dependencies = False
+    task_index_var = None
+
+    def __init__(self, **kwargs):
+
+        super(ArrayScriptConstructor, self).__init__(**kwargs)
+
+        self.tasks_path = os.path.splitext(self.script_path)[0] + ".tasks"
+        self.manifest_path = os.path.splitext(self.script_path)[0] + ".manifest"
+        self.tasks_fh = open(self.tasks_path, "wb")
+        self.manifest_fh = open(self.manifest_path, "w")
+        # Names of the tasks, in order
+        self.task_names = list()
+        self.tasks_size = 0
+        # Array jobs of other steps whose corresponding tasks are waited for, instead of the whole job
+        self.corresponding_jids = list()
+
+    def __del__(self):
+
+        super(ArrayScriptConstructor, self).__del__()
+        for filehandle in [getattr(self, "tasks_fh", None), getattr(self, "manifest_fh", None)]:
+            if filehandle is not None:
+                filehandle.close()
+
+    def add_task(self, task_obj, task_name):
+        """ Adds the script of task_obj (a LowScriptConstructor created with open_script=False) as the next task
+        """
+
+        script = task_obj.render_script().encode("utf-8")
+        self.tasks_fh.write(script)
+        self.task_names.append(task_name)
+        self.manifest_fh.write("\t".join([str(len(self.task_names)),
+                                          task_obj.script_id,
+                                          task_name,
+                                          str(self.tasks_size),
+                                          str(len(script))]) + "\n")
+        self.tasks_size += len(script)
+
+    def get_task_function(self):
+        """ Returns the definition of run_task_script(), which runs the script of a task from the tasks file
+        """
+
+        return """
+# The tasks of this array job are listed in the manifest. Their scripts are in the tasks file.
+manifest={manifest}
+tasks={tasks}
+
+# Run the script of a task. $1: offset of the script in the tasks file. $2: length of the script
+run_task_script() {{
+    {shell} <(tail -c +$(($1+1)) $tasks | head -c $2)
+}}
+""".format(manifest=self.manifest_path,
+           tasks=self.tasks_path,
+           shell=self.shell)
+
+    def get_run_tasks_lines(self):
+        """ Returns the lines running the task whose index was passed by the scheduler. Sets task_status to 'done' or
+            'ERROR'
+        """
+
+        return """
+read task_id task_name task_offset task_length <<< $(awk -F'\\t' -v task=${index_var} '$1==task {{print $2, $3, $4, $5; exit}}' $manifest)
+
+if run_task_script $task_offset $task_length; then task_status="done"; else task_status="ERROR"; fi
+""".format(index_var=self.task_index_var)
+
+    def write_script(self):
+        """ Writes the array script. Called once all the tasks were added.
+        """
+
+        self.tasks_fh.close()
+        self.manifest_fh.close()
+        self.write_command("\n".join([self.get_script_header(),
+                                      self.get_task_function(),
+                                      self.get_run_tasks_lines(),
+                                      self.get_script_closing()]))
+
+    def get_script_closing(self):
+        """ Exits with the task's exit status
+        """
+
+        return """
+[ "$task_status" == "done" ]
+"""
+
+
 # ----------------------------------------------------------------------------------
 # KillScriptConstructor defintion
 # ----------------------------------------------------------------------------------
@@ -634,7 +985,9 @@ class KillScriptConstructor(ScriptConstructor):
                      "99.kill_all_{name}".format(name=self.name),
                      ".sh"])
 
-        self.filehandle = open(self.script_path, "w")
+        self.open_script(kwargs.get("reuse_script", False))
+
+    def start_script(self):
 
         self.filehandle.write("#!/bin/bash\n\n")
 
@@ -20,63 +20,227 @@ class ScriptConstructorLocal(ScriptConstructor):
     @classmethod
     def get_helper_script(cls, pipe_data):
         """ Returns the code for the helper script
+            The states of the jobs are kept in per-job state files as well as in the run_index journal, so that checking
+            whether a job's dependencies are finished and counting running jobs do not require reading run_index
         """
         script = super(ScriptConstructorLocal, cls).get_helper_script(pipe_data)
-        script = re.sub("## locksed command entry point", r"""locksed  "s:^\\($3\\).*:# \\1\\t$err_code:" $run_index""", script)
+        script = re.sub("## job state command entry point",
+                        r"""journal_state $3 $err_code; set_job_state $3 $err_code""",
+                        script)
         script = re.sub("## maxvmem calc entry point", 'maxvmem="-";', script)
 
+        script += """\
+# Per-job state files:
+#   <job id>.active                 The job is held or running
+#   running/<job id>                The job is a running child-level job (counted by count_running)
+#   <job id>.done, <job id>.failed  The job has finished
+run_state={run_index}.state
+
+set_job_state() {{
+    # $1: job id
+    # $2: state: hold, running, done or a failure state (ERROR, TERMINATED, killed)
+    [ -d $run_state/running ] || mkdir -p $run_state/running
+    case $2 in
+        hold)
+            rm -f $run_state/$1.done $run_state/$1.failed
+            : > $run_state/$1.active ;;
+        running)
+            if [[ $1 == *..*..*..* ]]; then : > $run_state/running/$1; fi ;;
+        done)
+            rm -f $run_state/$1.active $run_state/running/$1
+            : > $run_state/$1.done ;;
+        *)
+            rm -f $run_state/$1.active $run_state/running/$1
+            : > $run_state/$1.failed ;;
+    esac
+}}
+
+register_job() {{
+    # $1: job id
+    # Marks a job as held before starting its NSF_exec.sh, so that the jobs depending on it wait for it even if they
+    # are started first. NSF_exec.sh adds its pid to the job's line in run_index.
+    # Child-level jobs are counted by count_running from here on, so that job_limit is kept without waiting for the
+    # jobs to start
+    journal_state $1 hold
+    set_job_state $1 hold
+    set_job_state $1 running
+}}
+
+count_running() {{
+    # Sets numrun to the number of running child-level (merge..merge1..sample..runid) jobs
+    local running_jobs=($run_state/running/*)
+    if [ -e "${{running_jobs[0]}}" ]; then numrun=${{#running_jobs[@]}}; else numrun=0; fi
+}}
+
+""".format(run_index=pipe_data["run_index"])
+
         # Add job_limit function:
         if "job_limit" in pipe_data:
             script += """\
 job_limit={job_limit}
 
+read_job_limit() {{
+    # Sets maxrun and sleeptime from the job_limit file. maxrun is empty if not defined in the file
+    local limit_line=""
+    read -r limit_line < $job_limit || true
+    maxrun=""
+    sleeptime=60
+    if [[ $limit_line =~ limit=([0-9]+) ]]; then maxrun=${{BASH_REMATCH[1]}}; fi
+    if [[ $limit_line =~ sleep=([0-9]+) ]]; then sleeptime=${{BASH_REMATCH[1]}}; fi
+}}
+
 wait_limit() {{
     while : ; do
-        # Count active (PID), child-level (merge..merge1..sample..runid) jobs
-        numrun=$(grep  '\sPID\s' $run_index | grep -P ".*\.\..*\.\..*\.\." | wc -l);
-        maxrun=$(sed -ne "s/limit=\([0-9]*\).*/\\1/p" $job_limit);
-        sleeptime=$(sed -ne "s/.*sleep=\([0-9]*\).*/\\1/p" $job_limit);
-        [[ $numrun -ge $maxrun ]] || break;
+        # Count active, child-level (merge..merge1..sample..runid) jobs
+        count_running
+        read_job_limit
+        [[ -n $maxrun && $numrun -ge $maxrun ]] || break;
         sleep $sleeptime;
     done
 }}
 """.format(job_limit=pipe_data["job_limit"])
-#        numrun=$(awk 'BEGIN {{jobsc=0}} /^\w/ {{jobsc=jobsc+1}} END {{print jobsc}}' $run_index);
-#        numrun=$(grep -c '\sPID\s'  $run_index);
-
 
         return script
 
     @classmethod
     def get_exec_script(cls, pipe_data):
-        """ Not used for SGE. Returning None"""
+        """ Returns the code for the script executing a job: Waits for the job's dependencies to finish, executes the
+            job's script and waits for it, to set the job's state.
+            The script path is passed by the calling script, and the dependencies are read from the job's own script,
+            so no shared files are read.
+        """
 
-        script = super(ScriptConstructorLocal, cls).get_exec_script(pipe_data)
+        return """\
+#!/bin/bash
+qsubname=$1
+# Passed by the calling script. If not passed, looked up in script_index
+script_path=$2
+script_index="{script_index}"
+run_index="{run_index}"
 
-        # Adding PID after hold in run_index
-        script = re.sub("(locksed.*hold)",r"\1\\t$$", script)
+# Import helper functions
+. {helper_funcs}
 
-        script += """\
+echo "Running job: " $qsubname
+
+module=${{qsubname%%..*}}
+instance=${{qsubname#*..}}
+instance=${{instance%%..*}}
+
+# Setting trap
+trap_with_arg func_trap $module $instance $qsubname Queue $HOSTNAME $$ SIGUSR2 INT TERM
 
-iscsh=$(grep "csh" <<< $script_path)
-if [ -z $iscsh ]; then
+log_echo $module $instance $qsubname Queue $HOSTNAME $$ Started
+
+# 1. Find script path
+if [ -z "$script_path" ]; then
+    script_path=$(awk -v qsname="$qsubname" '$1 == qsname {{print $2; exit}}' $script_index)
+fi
+
+echo "Running script: " $script_path
+
+# 2. Marking in run_index and in the job's state files as held
+
+journal_state $qsubname hold $$
+set_job_state $qsubname hold
+
+# 3. Getting script dependencies from the '#$ -hold_jid' line in the script's header
+
+hold_jids=""
+while read -r line; do
+    if [[ $line == "#\$ -hold_jid "* ]]; then
+        hold_jids=${{line#"#\$ -hold_jid "}}
+        break
+    fi
+    [[ -z $line || $line == "#"* ]] || break
+done < $script_path
+set -f                     # avoid globbing (expansion of *).
+# Convert into array:
+hold_jids=(${{hold_jids//,/ }})
+set +f
+
+# 4. Waiting for dependencies to finish
+while : ; do
+    if [ -f {run_index}.killall ]; then
+        echo -e $run_index ".killall file created. Stopping all waiting jobs. \\nMake sure you delete the file before re-running!"
+        journal_state $qsubname killed
+        set_job_state $qsubname killed
+        kill $$;
+        exit 1;
+    fi
+    if [ ! -f {run_index} ]; then
+        echo $run_index " file deleted. Stopping all waiting jobs"
+        set_job_state $qsubname killed
+        kill $$;
+        exit 1;
+    fi
+
+    # Is any of the dependencies held or running?
+    waiting=""
+    for hold_jid in "${{hold_jids[@]}}"; do
+        if [ -e "$run_state/$hold_jid.active" ]; then
+            waiting=$hold_jid
+            break
+        fi
+    done
+    if [ -z "$waiting" ]; then
+        break
+    fi
+    echo "Job $waiting is running. Waiting..."
+    sleep 3
+done
+
+# 5. Execute script:
+# Marked as running before the script starts, so that array jobs can remove their own mark (their tasks are counted
+# instead)
+set_job_state $qsubname running
+
+if [[ $script_path == *csh* ]]; then
+    csh $script_path &
+else
     bash $script_path &
+fi
+script_pid=$!
+
+journal_state $qsubname PID $script_pid
+
+# 6. Setting the job's state when the script ends
+if wait $script_pid; then
+    set_job_state $qsubname done
 else
-    csh $script_path &
+    set_job_state $qsubname ERROR
 fi
 
-# gpid=$(ps -o pgid= $! | grep -o '[0-9]*')
-locksed "s:\($qsubname\).*$:\\1\\tPID\\t$!:" $run_index
+""".format(script_index=pipe_data["script_index"],
+           run_index=pipe_data["run_index"],
+           helper_funcs=pipe_data["helper_funcs"])
 
-"""
-        return script
+    @classmethod
+    def get_scheduler_script(cls, pipe_data):
+        """ Returns the code for running the workflow with the local scheduler (see modules/local_scheduler.py)
+        """
+
+        return """\
+#!/bin/bash
+
+# Runs the workflow with the NeatSeq-Flow local scheduler, instead of 00.workflow.commands.sh
+# Jobs are started as soon as the jobs they depend on have finished.
+# Use '-s step1 step2' to run only some of the steps and '-j N' to limit the number of jobs running at once
+
+PYTHONPATH={package_dir}${{PYTHONPATH:+:$PYTHONPATH}} {python} -m neatseq_flow.modules.local_scheduler {objects_dir} "$@"
+""".format(package_dir=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+           python=sys.executable,
+           objects_dir=pipe_data["objects_dir"])
 
     @classmethod
     def get_run_index_clean_script(cls, pipe_data):
             # Create run_index cleaning script
         return """\
 #!/bin/bash
-sed -i -E -e 's/^([^#][^[[:space:]]+).*/# \\1/g' -e 's/^(# [^[[:space:]]+).*/\\1/g' {run_index}\n""".\
+sed -i -E -e 's/^([^#][^[[:space:]]+).*/# \\1/g' -e 's/^(# [^[[:space:]]+).*/\\1/g' {run_index}
+rm -rf {run_index}.state
+rm -f {run_index}.journal {run_index}.journal.1 {run_index}.journal.offset
+""".\
                             format(run_index=pipe_data["run_index"])
 # sed -i -e 's/^\([^#]\w\+\).*/\# \\1/g' -e 's/^\(\# \w\+\).*/\\1/g' {run_index}\n""".\
 
@@ -90,8 +254,9 @@ sed -i -E -e 's/^([^#][^[[:space:]]+).*/# \\1/g' -e 's/^(# [^[[:space:]]+).*/\\1
             sys.exit("Slow release no longer supported. Use 'job_limit'")
         else:
             script += """\
-bash {nsf_exec} {script_id} 1> {stdout} 2> {stderr} & \n\n""".\
+bash {nsf_exec} {script_id} {script_path} 1> {stdout} 2> {stderr} & \n\n""".\
                 format(script_id = self.script_id,
+                       script_path = self.script_path,
                        nsf_exec = self.pipe_data["exec_script"],
                        stderr = "{dir}{id}.e".format(dir=self.pipe_data["stderr_dir"], id=self.script_id),
                        stdout = "{dir}{id}.o".format(dir=self.pipe_data["stdout_dir"], id=self.script_id))
@@ -235,14 +400,13 @@ wait_limit
 # ---------------- Code for {script_id} ------------------
 {job_limit}
 echo running {script_id}
+register_job {script_id}
 {command}
-
-sleep {sleep_time}
+pace_submit
 
 """.format(script_id=self.script_id,
            command=command,
-           job_limit=job_limit,
-           sleep_time=self.pipe_data["Default_wait"])
+           job_limit=job_limit)
 
         return script
 
@@ -264,19 +428,17 @@ wait_limit
         script = """
 # ---------------- Code for {script_id} ------------------
 {job_limit}
-
+register_job {script_id}
 {child_cmd}
-
-sleep {sleep_time}
+pace_submit
 """.format(script_id=script_obj.script_id,
            child_cmd=script_obj.get_command(),
-           sleep_time=self.pipe_data["Default_wait"],
            job_limit=job_limit)
 
         return script
 
     def get_script_postamble(self):
-        """ Local script postamble is same as general postamble with addition of sed command to mark as finished in run_index
+        """ Local script postamble is same as general postamble with addition of marking as finished in run_index
         """
 
         # Write the kill command to the kill script
@@ -293,9 +455,10 @@ sleep {sleep_time}
 
 wait 
 
-# Setting script as done in run index:
-# Using locksed provided in helper functions
-locksed  "s:^\({script_id}\).*:# \\1\\tdone:" {run_index}
+# Setting script as done in run index, and applying the journal to run_index when the step is done:
+# Using journal_state and compact_run_index provided in helper functions
+journal_state {script_id} done
+compact_run_index
 
 """.format(\
             postamble=postamble,
@@ -323,32 +486,84 @@ class LowScriptConstructorLocal(ScriptConstructorLocal, LowScriptConstructor):
 
         return general_header + "\n\n"
 
-    def write_script(self):
-        # ,
-        #              script,
-        #              dependency_jid_list,
-        #              stamped_files,
-        #              **kwargs):
-        """ Assembles the scripts to writes to file
+    def get_script_closing(self):
+        """ Sets the script as done in the run index
+        """
+
+        return """\
+
+# Setting script as done in run index:
+# Using journal_state provided in helper functions
+journal_state {script_id} done
+
+""".format(run_index=self.pipe_data["run_index"],
+           script_id=self.script_id)
+
+# ----------------------------------------------------------------------------------
+# ArrayScriptConstructorLocal defintion
+# ----------------------------------------------------------------------------------
+
+
+class ArrayScriptConstructorLocal(LowScriptConstructorLocal, ArrayScriptConstructor):
+    """ A step's low level scripts as the tasks of a single array job.
+        There is no scheduler to expand the array, so the array script runs all the tasks in the background and
+        waits for them.
+    """
+
+    def get_run_tasks_lines(self):
+        """ Runs all the tasks. Sets task_status to 'ERROR' if any of the tasks failed
         """
 
-        # if "level" not in kwargs:
-        #     kwargs["level"] = "low"
+        job_limit = ""
+        if "job_limit" in list(self.pipe_data.keys()):
+            job_limit = """\
+    # Sleeping while jobs exceed limit
+    wait_limit
+"""
 
-        super(LowScriptConstructorLocal, self).write_script()
-        # script,
-        #                                                 dependency_jid_list,
-        #                                                 stamped_files,
-        #                                                 **kwargs)
+        return """
+# Import helper functions
+. {helper_funcs}
 
-        self.write_command("""\
+# The running tasks are counted as running jobs, rather than the array job itself
+mkdir -p $run_state/running
+rm -f $run_state/running/{script_id}
+
+task_pids=()
+while IFS=$'\\t' read task_index task_id task_name task_offset task_length; do
+{job_limit}
+    echo running $task_id
+    : > $run_state/running/$task_id
+    {{ run_task_script $task_offset $task_length 1> {stdout_dir}$task_id.o 2> {stderr_dir}$task_id.e
+       task_exit=$?
+       rm -f $run_state/running/$task_id
+       exit $task_exit; }} &
+    task_pids+=($!)
+done < $manifest
+
+task_status="done"
+for task_pid in "${{task_pids[@]}}"; do
+    wait $task_pid || task_status="ERROR"
+done
+""".format(helper_funcs=self.pipe_data["helper_funcs"],
+           job_limit=job_limit,
+           script_id=self.script_id,
+           stdout_dir=self.pipe_data["stdout_dir"],
+           stderr_dir=self.pipe_data["stderr_dir"])
+
+    def get_script_closing(self):
+        """ Sets the array job as done in the run index, or as failed if any of the tasks failed
+        """
+
+        return """\
 
 # Setting script as done in run index:
-# Using locksed provided in helper functions
-locksed  "s:^\({script_id}\).*:# \\1\\tdone:" {run_index}
+# Using journal_state provided in helper functions
+journal_state {script_id} $task_status
 
+[ "$task_status" == "done" ]
 """.format(run_index=self.pipe_data["run_index"],
-           script_id=self.script_id))
+           script_id=self.script_id)
 
 # ----------------------------------------------------------------------------------
 # KillScriptConstructorLocal defintion
@@ -389,14 +604,15 @@ rm -rf {run_index}.killall
 
         # Create one killing routine for all instance jobs:
         script = """\
-line2kill=$(grep '^{step}{sep}{name}' {run_index} | awk '{{print $3}}')
+. {helper_funcs}
+line2kill=$(run_index_view | grep '^{step}{sep}{name}' | awk '{{print $3}}')
 line2kill=(${{line2kill//,/ }})
 for item1 in "${{line2kill[@]}}"; do 
     echo running "kill -- -$(ps -o pgid= $item1 | grep -o '[0-9]'*)"
     kill -- -$(ps -o pgid= $item1 | grep -o '[0-9]'*)
 done
 
-""".format(run_index = self.pipe_data["run_index"],
+""".format(helper_funcs=self.pipe_data["helper_funcs"],
            step=caller_script.step,
            name=caller_script.name,
            sep=caller_script.master.jid_name_sep)
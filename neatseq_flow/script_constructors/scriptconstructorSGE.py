@@ -25,8 +25,8 @@ class ScriptConstructorSGE(ScriptConstructor):
         """
         script = super(ScriptConstructorSGE, cls).get_helper_script(pipe_data)
 
-        # Add locksed command. For SGE, just remove
-        script = re.sub("## locksed command entry point", r"", script)
+        # Add job state command. For SGE, just remove
+        script = re.sub("## job state command entry point", r"", script)
 
         # Add maxvmem calculation command:
         # $6 is the job_id!
@@ -72,43 +72,14 @@ wait_limit() {{
 
         util_script = super(ScriptConstructorSGE, cls).get_utilities_script(pipe_data)
 
-        # # Steps:
-        # 1. Find failed steps in log file
-        # 2. Find downstream steps in depend_file
-        # 3. Get qsub commands from main script
-        # 4. Execute the qsub command
+        # The failed jobs are found and re-executed by modules/recovery.py
 
         recover_script = util_script + """
-# Recover a failed execution
+# Recover a failed execution: re-execute the jobs which failed and the jobs depending on them
 function recover_run {{
-    cat {log_file} \\
-        | awk '{{  if(NR<=9) {{next}}; 
-                    if($3=="Started" && $11 ~ "OK") {{jobs[$6]=$5;}}
-                    if($3=="Finished" && $11 ~ "OK") {{delete jobs[$6]}}
-                }}
-                END {{
-                    for (key in jobs) {{ 
-                        print jobs[key]
-                    }} 
-                
-                }}'  \\
-        | while read step; do \\
-            echo $step; \\
-            grep $step {depend_file} | cut -f2; 
-          done \\
-        | sort -u \\
-        | while read step; do \\
-            grep $step {main} | egrep -v "^#|^echo" | cut -f2 -d" ";
-          done \\
-        | sort -u \\
-        | while read line; do \\
-            echo $line;
-            qsub $line; \\
-          done
+    bash {recover_script} "$@"
 }}
-        """.format(log_file=pipe_data["log_file"],
-                   depend_file=pipe_data["dependency_index"],
-                   main=pipe_data["scripts_dir"] + "00.workflow.commands.sh")
+        """.format(recover_script=pipe_data["scripts_dir"] + "00.workflow.recover.sh")
 
         return recover_script + """
 # Show active jobs
@@ -153,7 +124,7 @@ function kill_all_PL_jobs {
             sys.exit("Slow release no longer supported. Use 'job_limit'")
         else:
             script = """\
-qsub {script_path}
+submit_with_backoff qsub {script_path}
 """.format(script_path = self.script_path)
 
         return script
@@ -252,9 +223,16 @@ class HighScriptConstructorSGE(ScriptConstructorSGE,HighScriptConstructor):
         # return "qalter \\\n\t-hold_jid %s \\\n\t%s\n\n" % (dependency_list, self.script_id)
         # New methods wirh glob:
 
+        # With array jobs, the high level script depends on other jobs than the low level scripts (see
+        # Step.get_high_dependency_lists())
+        if self.master.array_jobs:
+            glob_jid_list = self.master.high_dependency_glob_jid_list
+        else:
+            glob_jid_list = self.master.dependency_glob_jid_list
+
         return "qalter \\\n\t-hold_jid {glob_jid_list} \\\n\t{script_id}\n\n".format(
             # Comma separated list of double-quote enclosed glob jids:
-            glob_jid_list=",".join(['"%s"' % x for x in self.master.dependency_glob_jid_list]),
+            glob_jid_list=",".join(['"%s"' % x for x in glob_jid_list]),
             script_id=self.script_id)
 
     def get_script_header(self, **kwargs):
@@ -335,7 +313,7 @@ wait_limit
 {job_limit}
 echo '{qdel_line}' >> {step_kill_file}
 # Adding qsub command:
-qsub {script_name}
+submit_with_backoff qsub {script_name}
 
 """.format(qdel_line = script_obj.get_kill_command(),
            job_limit=job_limit,
@@ -416,6 +394,30 @@ class LowScriptConstructorSGE(ScriptConstructorSGE,LowScriptConstructor):
                           qsub_queue,
                           qsub_opts]).replace("\n\n", "\n") + "\n\n"
 
+# ----------------------------------------------------------------------------------
+# ArrayScriptConstructorSGE definition
+# ----------------------------------------------------------------------------------
+
+
+class ArrayScriptConstructorSGE(LowScriptConstructorSGE, ArrayScriptConstructor):
+    """ A step's low level scripts as the tasks of a single SGE array job (qsub -t)
+    """
+
+    supports_task_dependencies = True
+    task_index_var = "SGE_TASK_ID"
+
+    def get_script_header(self, **kwargs):
+        """ Adds the task range and the task-by-task dependencies (-hold_jid_ad) to the low level script header
+        """
+
+        general_header = super(ArrayScriptConstructorSGE, self).get_script_header(**kwargs)
+
+        array_lines = "#$ -t 1-{num_tasks}\n".format(num_tasks=len(self.task_names))
+        if self.corresponding_jids:
+            array_lines += "#$ -hold_jid_ad {jid_list}\n".format(jid_list=",".join(self.corresponding_jids))
+
+        return general_header.rstrip("\n") + "\n" + array_lines + "\n\n"
+
 # ----------------------------------------------------------------------------------
 # KillScriptConstructorSGE definition
 # ----------------------------------------------------------------------------------
@@ -22,7 +22,17 @@ class ScriptConstructorSLURM(ScriptConstructor):
         """ Returns the code for the helper script
         """
         script = super(ScriptConstructorSLURM, cls).get_helper_script(pipe_data)
-        script = re.sub("## locksed command entry point", r"""locksed  "s:^\\($3\\).*:# \\1\\t$err_code:" $run_index""", script)
+        script = re.sub("## job state command entry point", r"""journal_state $3 $err_code""", script)
+
+        script += """\
+register_job() {
+    # $1: job id
+    # Marks a job as held before starting its NSF_exec.sh, so that the jobs depending on it wait for it even if they
+    # are started first
+    journal_state $1 hold
+}
+
+"""
 
         # Add job_limit function:
         if "job_limit" in pipe_data:
@@ -31,7 +41,7 @@ job_limit={job_limit}
 
 wait_limit() {{
     while : ; do
-        numrun=$(grep -c '\sPID\s'  $run_index);
+        numrun=$(run_index_view | grep -c '\sPID\s');
         maxrun=$(sed -ne "s/limit=\([0-9]*\).*/\\1/p" $job_limit);
         sleeptime=$(sed -ne "s/.*sleep=\([0-9]*\).*/\\1/p" $job_limit);
         [[ $numrun -ge $maxrun ]] || break;
@@ -49,9 +59,19 @@ wait_limit() {{
         script = super(ScriptConstructorSLURM, cls).get_exec_script(pipe_data)
 
         script += """\
-jobid=$(sbatch $script_path | cut -d " " -f 4)
+# Array jobs waiting for the corresponding tasks of other array jobs (see ArrayScriptConstructorSLURM):
+# Wait for the other jobs to be submitted, and pass their job ids in an 'aftercorr' dependency
+dependency=""
+for corr_jid in $(grep '^#NSF -aftercorr' $script_path | cut -f 3 -d " " | tr "," " "); do
+    while run_index_view | grep -q "^$corr_jid[[:space:]]hold"; do sleep 3; done
+    corr_jobid=$(run_index_view | awk -v jid="$corr_jid" '$1==jid && $2=="running" {print $3}')
+    if [ -n "$corr_jobid" ]; then dependency="$dependency,aftercorr:$corr_jobid"; fi
+done
+if [ -n "$dependency" ]; then dependency="--dependency=${dependency#,}"; fi
 
-locksed "s:\($qsubname\).*$:\\1\\trunning\\t$jobid:" $run_index
+jobid=$(submit_with_backoff sbatch $dependency $script_path | cut -d " " -f 4)
+
+journal_state $qsubname running $jobid
 
 """
         return script
@@ -61,7 +81,9 @@ locksed "s:\($qsubname\).*$:\\1\\trunning\\t$jobid:" $run_index
 
         return """\
 #!/bin/bash
-sed -i -E -e 's/^([^#][^[[:space:]]+).*/# \\1/g' -e 's/^(# [^[[:space:]]+).*/\\1/g' {run_index}\n""".\
+sed -i -E -e 's/^([^#][^[[:space:]]+).*/# \\1/g' -e 's/^(# [^[[:space:]]+).*/\\1/g' {run_index}
+rm -f {run_index}.journal {run_index}.journal.1 {run_index}.journal.offset
+""".\
             format(run_index=pipe_data["run_index"])
 # sed -i -e 's/^\([^#]\w\+\).*/\# \\1/g' -e 's/^\(\# \w\+\).*/\\1/g' {run_index}\n""". \
 
@@ -209,14 +231,13 @@ wait_limit
 # ---------------- Code for {script_id} ------------------
 echo running {script_id}
 {job_limit}
+register_job {script_id}
 {command}
-
-sleep {sleep_time}
+pace_submit
 
 """.format(script_id = self.script_id,
            command = command,
-           job_limit=job_limit,
-           sleep_time=self.pipe_data["Default_wait"])
+           job_limit=job_limit)
 
         return script
 
@@ -239,20 +260,18 @@ wait_limit
         script = """
 # ---------------- Code for {script_id} ------------------
 {job_limit}
-
+register_job {script_id}
 {child_cmd}
-
-sleep {sleep_time}
+pace_submit
 """.format(script_id = script_obj.script_id,
            child_cmd = script_obj.get_command(),
            kill_line = script_obj.get_kill_command(),
-           sleep_time=self.pipe_data["Default_wait"],
            job_limit=job_limit)
             
         return script
 
     def get_script_postamble(self):
-        """ Local script postamble is same as general postamble with addition of sed command to mark as finished in run_index
+        """ Local script postamble is same as general postamble with addition of marking as finished in run_index
         """
     
         # Get general postamble
@@ -264,9 +283,10 @@ sleep {sleep_time}
 
 wait
 
-# Setting script as done in run index:
-# Using locksed provided in helper functions
-locksed  "s:^\({script_id}\).*:# \\1\\tdone:" {run_index}
+# Setting script as done in run index, and applying the journal to run_index when the step is done:
+# Using journal_state and compact_run_index provided in helper functions
+journal_state {script_id} done
+compact_run_index
 
 """.format(postamble=postamble,
            run_index=self.pipe_data["run_index"],
@@ -314,32 +334,67 @@ class LowScriptConstructorSLURM(ScriptConstructorSLURM,LowScriptConstructor):
         # Sometimes qsub_opts is empty and then there is an ugly empty line in the middle of the qsub definition. Removing the empty line with replace()
         return general_header + "\n\n"
 
-    def write_script(self):
-                     # script,
-                     # dependency_jid_list,
-                     # stamped_files,
-                     # **kwargs):
-        """ Assembles the scripts to writes to file
+    def get_script_closing(self):
+        """ Sets the script as done in the run index
         """
 
-        # if "level" not in kwargs:
-        #     kwargs["level"] = "low"
-
-        super(LowScriptConstructorSLURM, self).write_script()
-    # script,
-    #                                                     dependency_jid_list,
-    #                                                     stamped_files,
-    #                                                     **kwargs)
-
-        
-        self.write_command("""\
+        return """\
 
 # Setting script as done in run index:
-# Using locksed provided in helper functions
-locksed  "s:^\({script_id}\).*:# \\1\\tdone:" {run_index}
+# Using journal_state provided in helper functions
+journal_state {script_id} done
 
 """.format(run_index = self.pipe_data["run_index"],
-           script_id = self.script_id))
+           script_id = self.script_id)
+
+# ----------------------------------------------------------------------------------
+# ArrayScriptConstructorSLURM definition
+# ----------------------------------------------------------------------------------
+
+
+class ArrayScriptConstructorSLURM(LowScriptConstructorSLURM, ArrayScriptConstructor):
+    """ A step's low level scripts as the tasks of a single SLURM array job (sbatch --array)
+    """
+
+    supports_task_dependencies = True
+    task_index_var = "SLURM_ARRAY_TASK_ID"
+
+    def get_script_header(self, **kwargs):
+        """ Adds the task range to the low level script header. The array jobs whose corresponding tasks the tasks
+            depend on are passed to the exec script in a '#NSF -aftercorr' line (see get_exec_script())
+        """
+
+        general_header = super(ArrayScriptConstructorSLURM, self).get_script_header(**kwargs)
+
+        general_header = general_header.rstrip("\n") + "\n#SBATCH --array=1-{num_tasks}\n".\
+            format(num_tasks=len(self.task_names))
+        if self.corresponding_jids:
+            general_header += "#NSF -aftercorr {jid_list}\n".format(jid_list=",".join(self.corresponding_jids))
+
+        return general_header + "\n\n"
+
+    def get_script_closing(self):
+        """ Each task adds its status to a file shared by the tasks of the job. The last task to finish sets the array
+            job as done (or failed, if any task failed) in the run index.
+        """
+
+        return """\
+
+# Setting the array job as done in run index when all tasks have finished:
+. {helper_funcs}
+tasks_done={manifest}.$SLURM_ARRAY_JOB_ID.done
+echo "$SLURM_ARRAY_TASK_ID $task_status" >> $tasks_done
+if [ $(wc -l < $tasks_done) -ge {num_tasks} ]; then
+    if grep -q ERROR $tasks_done; then array_status="ERROR"; else array_status="done"; fi
+    journal_state {script_id} $array_status
+fi
+
+[ "$task_status" == "done" ]
+""".format(helper_funcs=self.pipe_data["helper_funcs"],
+           manifest=self.manifest_path,
+           num_tasks=len(self.task_names),
+           run_index=self.pipe_data["run_index"],
+           script_id=self.script_id)
 
 # ----------------------------------------------------------------------------------
 # KillScriptConstructorSLURM defintion
@@ -380,14 +435,15 @@ rm -rf {run_index}.killall
 
         # Create one killing routine for all instance jobs:
         script = """\
-line2kill=$(grep '^{step}{sep}{name}' {run_index} | awk '{{print $3}}')
+. {helper_funcs}
+line2kill=$(run_index_view | grep '^{step}{sep}{name}' | awk '{{print $3}}')
 line2kill=(${{line2kill//,/ }})
 for item1 in "${{line2kill[@]}}"; do 
     echo running "scancel --full --signal TERM $item1"
     scancel --full --signal TERM $item1 
 done
 
-""".format(run_index = self.pipe_data["run_index"],
+""".format(helper_funcs=self.pipe_data["helper_funcs"],
            step=caller_script.step,
            name=caller_script.name,
            sep=caller_script.master.jid_name_sep)
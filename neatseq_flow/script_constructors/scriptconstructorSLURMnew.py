@@ -22,7 +22,17 @@ class ScriptConstructorSLURMnew(ScriptConstructor):
         """ Returns the code for the helper script
         """
         script = super(ScriptConstructorSLURMnew, cls).get_helper_script(pipe_data)
-        script = re.sub("## locksed command entry point", r"""locksed  "s:^\\($3\\).*:# \\1\\t$err_code:" $run_index""", script)
+        script = re.sub("## job state command entry point", r"""journal_state $3 $err_code""", script)
+
+        script += """\
+register_job() {
+    # $1: job id
+    # Marks a job as held before starting its NSF_exec.sh, so that the jobs depending on it wait for it even if they
+    # are started first
+    journal_state $1 hold
+}
+
+"""
 
         # Add job_limit function:
         if "job_limit" in pipe_data:
@@ -31,7 +41,7 @@ job_limit={job_limit}
 
 wait_limit() {{
     while : ; do
-        numrun=$(grep -c '\sPID\s'  $run_index);
+        numrun=$(run_index_view | grep -c '\sPID\s');
         maxrun=$(sed -ne "s/limit=\([0-9]*\).*/\\1/p" $job_limit);
         sleeptime=$(sed -ne "s/.*sleep=\([0-9]*\).*/\\1/p" $job_limit);
         [[ $numrun -ge $maxrun ]] || break;
@@ -49,9 +59,9 @@ wait_limit() {{
         script = super(ScriptConstructorSLURMnew, cls).get_exec_script(pipe_data)
 
         script += """\
-jobid=$(sbatch $script_path | cut -d " " -f 4)
+jobid=$(submit_with_backoff sbatch $script_path | cut -d " " -f 4)
 
-locksed "s:\($qsubname\).*$:\\1\\trunning\\t$jobid:" $run_index
+journal_state $qsubname running $jobid
 
 """
         return script
@@ -61,7 +71,9 @@ locksed "s:\($qsubname\).*$:\\1\\trunning\\t$jobid:" $run_index
 
         return """\
 #!/bin/bash
-sed -i -E -e 's/^([^#][^[[:space:]]+).*/# \\1/g' -e 's/^(# [^[[:space:]]+).*/\\1/g' {run_index}\n""".\
+sed -i -E -e 's/^([^#][^[[:space:]]+).*/# \\1/g' -e 's/^(# [^[[:space:]]+).*/\\1/g' {run_index}
+rm -f {run_index}.journal {run_index}.journal.1 {run_index}.journal.offset
+""".\
             format(run_index=pipe_data["run_index"])
 # sed -i -e 's/^\([^#]\w\+\).*/\# \\1/g' -e 's/^\(\# \w\+\).*/\\1/g' {run_index}\n""". \
 
@@ -209,14 +221,13 @@ wait_limit
 # ---------------- Code for {script_id} ------------------
 echo running {script_id}
 {job_limit}
+register_job {script_id}
 {command}
-
-sleep {sleep_time}
+pace_submit
 
 """.format(script_id = self.script_id,
            command = command,
-           job_limit=job_limit,
-           sleep_time=self.pipe_data["Default_wait"])
+           job_limit=job_limit)
 
         return script
 
@@ -239,20 +250,18 @@ wait_limit
         script = """
 # ---------------- Code for {script_id} ------------------
 {job_limit}
-
+register_job {script_id}
 {child_cmd}
-
-sleep {sleep_time}
+pace_submit
 """.format(script_id = script_obj.script_id,
            child_cmd = script_obj.get_command(),
            kill_line = script_obj.get_kill_command(),
-           sleep_time=self.pipe_data["Default_wait"],
            job_limit=job_limit)
             
         return script
 
     def get_script_postamble(self):
-        """ Local script postamble is same as general postamble with addition of sed command to mark as finished in run_index
+        """ Local script postamble is same as general postamble with addition of marking as finished in run_index
         """
     
         # Get general postamble
@@ -264,9 +273,10 @@ sleep {sleep_time}
 
 wait
 
-# Setting script as done in run index:
-# Using locksed provided in helper functions
-locksed  "s:^\({script_id}\).*:# \\1\\tdone:" {run_index}
+# Setting script as done in run index, and applying the journal to run_index when the step is done:
+# Using journal_state and compact_run_index provided in helper functions
+journal_state {script_id} done
+compact_run_index
 
 """.format(postamble=postamble,
            run_index=self.pipe_data["run_index"],
@@ -344,16 +354,6 @@ class LowScriptConstructorSLURMnew(ScriptConstructorSLURMnew,LowScriptConstructo
     #                                                     stamped_files,
     #                                                     **kwargs)
 
-        
-        self.write_command("""\
-
-# Setting script as done in run index:
-# Using locksed provided in helper functions
-locksed  "s:^\({script_id}\).*:# \\1\\tdone:" {run_index}
-
-""".format(run_index = self.pipe_data["run_index"],
-           script_id = self.script_id))
-
         slurm_cmd = r"""
 # Run script on hold
 jobid=$(sbatch -H {script_path} | grep -P -o "\d+")
@@ -373,6 +373,19 @@ scontrol release $jobid
         self.filehandle_slurm.write(slurm_cmd)
         print("in here")
 
+    def get_script_closing(self):
+        """ Sets the script as done in the run index
+        """
+
+        return """\
+
+# Setting script as done in run index:
+# Using journal_state provided in helper functions
+journal_state {script_id} done
+
+""".format(run_index = self.pipe_data["run_index"],
+           script_id = self.script_id)
+
 # ----------------------------------------------------------------------------------
 # KillScriptConstructorSLURMnew defintion
 # ----------------------------------------------------------------------------------
@@ -412,14 +425,15 @@ rm -rf {run_index}.killall
 
         # Create one killing routine for all instance jobs:
         script = """\
-line2kill=$(grep '^{step}{sep}{name}' {run_index} | awk '{{print $3}}')
+. {helper_funcs}
+line2kill=$(run_index_view | grep '^{step}{sep}{name}' | awk '{{print $3}}')
 line2kill=(${{line2kill//,/ }})
 for item1 in "${{line2kill[@]}}"; do 
     echo running "scancel --full --signal TERM $item1"
     scancel --full --signal TERM $item1 
 done
 
-""".format(run_index = self.pipe_data["run_index"],
+""".format(helper_funcs=self.pipe_data["helper_funcs"],
            step=caller_script.step,
            name=caller_script.name,
            sep=caller_script.master.jid_name_sep)
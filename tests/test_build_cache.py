@@ -0,0 +1,119 @@
+""" Tests of incremental regeneration (see neatseq_flow/modules/build_cache.py)
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import re
+import sys
+import subprocess
+
+
+NEATSEQ_FLOW = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bin", "neatseq_flow.py")
+
+PARAM_FILE = """\
+Global_params:
+    Qsub_q:     bio.q
+    Executor:   Local
+Step_params:
+    Merge:
+        module:         merge
+        script_path:
+    FastQC_Merge:
+        module:         fastqc_html
+        base:           Merge
+        script_path:    fastqc
+    Trimmo:
+        module:         trimmo
+        base:           Merge
+        script_path:    trimmomatic
+        todo:           LEADING:20 TRAILING:20
+    FastQC_Trimmo:
+        module:         fastqc_html
+        base:           Trimmo
+        script_path:    fastqc
+    Tags:
+        module:         add_trinity_tags
+        base:           Trimmo
+        script_path:
+    MultiQC:
+        module:         Multiqc
+        base:           [FastQC_Trimmo, FastQC_Merge]
+        script_path:    multiqc
+"""
+
+
+GROUPING_FILE = """\
+#SampleID\tGroup\tBatch\tTreatment
+Sample1\tA\tb1\tt1
+Sample2\tA\tb2\tt2
+Sample3\tB\tb1\tt1
+"""
+
+
+def write_workflow_files(work_dir):
+    """ Writes a sample file with paired-end and single-end samples, a grouping file and the parameter file. Returns
+        their paths
+    """
+
+    sample_lines = ["Title\tTest_project", "", "#SampleID\tType\tPath"]
+    for sample, types in [("Sample1", ["Forward", "Reverse"]),
+                          ("Sample2", ["Forward", "Reverse"]),
+                          ("Sample3", ["Single"])]:
+        for file_type in types:
+            path = os.path.join(work_dir, "{sample}_{type}.fastq".format(sample=sample, type=file_type))
+            open(path, "w").close()
+            sample_lines.append("\t".join([sample, file_type, path]))
+    sample_file = os.path.join(work_dir, "samples.nsfs")
+    with open(sample_file, "w") as sample_fh:
+        sample_fh.write("\n".join(sample_lines) + "\n")
+    grouping_file = os.path.join(work_dir, "grouping.txt")
+    with open(grouping_file, "w") as grouping_fh:
+        grouping_fh.write(GROUPING_FILE)
+    param_file = os.path.join(work_dir, "params.yaml")
+    with open(param_file, "w") as param_fh:
+        param_fh.write(PARAM_FILE)
+    return sample_file, grouping_file, param_file
+
+
+def build(work_dir, sample_file, param_file, hash_seed, grouping_file=None):
+    """ Builds the workflow incrementally in a new interpreter. Returns (steps reused, total steps)
+    """
+
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed))
+    args = [sys.executable, NEATSEQ_FLOW,
+            "-s", sample_file, "-p", param_file, "-d", work_dir, "-r", "RUN1", "--incremental"]
+    if grouping_file:
+        args += ["-g", grouping_file]
+    output = subprocess.run(args, cwd=work_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True).stdout
+    reused = re.search(r"Reused the scripts of (\d+) of (\d+) steps", output)
+    assert reused, output
+    return int(reused.group(1)), int(reused.group(2))
+
+
+def test_reused_with_different_hash_seeds(tmp_path):
+    """ Steps are reused when the workflow is built again with a different PYTHONHASHSEED, i.e. the cache does not
+        depend on the order of sets
+    """
+
+    work_dir = str(tmp_path)
+    sample_file, grouping_file, param_file = write_workflow_files(work_dir)
+
+    assert build(work_dir, sample_file, param_file, 1) == (0, 6)
+    for hash_seed in [2, 3]:
+        assert build(work_dir, sample_file, param_file, hash_seed) == (6, 6)
+
+
+def test_reused_with_grouping_file(tmp_path):
+    """ Same, with a grouping file (the categories of each sample must not depend on the order of sets)
+    """
+
+    work_dir = str(tmp_path)
+    sample_file, grouping_file, param_file = write_workflow_files(work_dir)
+
+    assert build(work_dir, sample_file, param_file, 1, grouping_file) == (0, 6)
+    for hash_seed in range(2, 7):
+        assert build(work_dir, sample_file, param_file, hash_seed, grouping_file) == (6, 6)
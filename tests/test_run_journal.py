@@ -0,0 +1,158 @@
+""" Tests of the run_index journal (see neatseq_flow/modules/run_journal.py), and of the agreement between its rules and
+the awk implementation in the helper functions (see ScriptConstructor.get_helper_script())
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import subprocess
+
+import pytest
+
+from neatseq_flow.modules import run_journal
+from neatseq_flow.script_constructors.scriptconstructorLocal import ScriptConstructorLocal
+
+
+JOBS = ["merge..Merge..Sample1..RUN1", "merge..Merge..Sample2..RUN1", "merge..Merge..RUN1"]
+
+# Record sequences: (name, records, a partial record appended to the journal after them)
+SEQUENCES = [("hold_running_done",
+              [(JOBS[0], "hold", None), (JOBS[0], "hold", "101"), (JOBS[0], "running", "101"),
+               (JOBS[0], "done", None)],
+              None),
+             ("second_final_state_ignored",
+              [(JOBS[1], "hold", None), (JOBS[1], "running", "102"), (JOBS[1], "ERROR", None),
+               (JOBS[1], "done", None), (JOBS[1], "running", "102")],
+              None),
+             ("running_without_hold_ignored",
+              [(JOBS[2], "running", "103"), (JOBS[2], "done", None)],
+              None),
+             ("partial_last_line",
+              [(JOBS[0], "hold", None), (JOBS[0], "running", "104")],
+              "{job}\tdone".format(job=JOBS[0])),
+             ("unknown_job_ignored",
+              [("other..job..RUN1", "hold", None), (JOBS[2], "hold", None)],
+              None),
+             ("resubmitted",
+              [(JOBS[0], "hold", None), (JOBS[0], "running", "105"), (JOBS[0], "ERROR", None),
+               (JOBS[0], "hold", None), (JOBS[0], "running", "106")],
+              None)]
+
+
+@pytest.fixture
+def run_index(tmp_path):
+    """ Returns the path of a run_index with the jobs done in a previous run, and writes the helper script of the Local
+        executor next to it
+    """
+
+    run_index = str(tmp_path / "run_index.txt")
+    with open(run_index, "w") as run_index_fh:
+        run_index_fh.write("\n----\n" + "".join("# {job}\tdone\n".format(job=job) for job in JOBS))
+    pipe_data = {"log_file": str(tmp_path / "log.txt"),
+                 "qsub_params": {"qstat_path": ""},
+                 "run_index": run_index}
+    with open(str(tmp_path / "97.helper_funcs.sh"), "w") as helper_fh:
+        helper_fh.write(ScriptConstructorLocal.get_helper_script(pipe_data))
+    return run_index
+
+
+def helper(run_index, command):
+    """ Executes command with the helper functions and returns its output
+    """
+
+    helper_funcs = os.path.join(os.path.dirname(run_index), "97.helper_funcs.sh")
+    return subprocess.check_output(["bash", "-c", "source {helper}; {command}".format(helper=helper_funcs,
+                                                                                  command=command)],
+                                   universal_newlines=True)
+
+
+def awk_view(run_index):
+
+    return helper(run_index, "run_index_view").rstrip("\n").split("\n")
+
+
+def python_view(run_index):
+
+    lines = run_journal.get_view(run_index)[0]
+    return "\n".join(lines).rstrip("\n").split("\n")
+
+
+def append_partial(run_index, partial, rotated=False):
+    """ Appends partial to the journal or the rotated journal as is, as done by a job still writing its record
+    """
+
+    journal = run_journal.get_journal_filename(run_index)
+    with open(journal + run_journal.ROTATED_SUFFIX if rotated else journal, "a") as journal_fh:
+        journal_fh.write(partial)
+
+
+def journal_files(run_index):
+
+    journal = run_journal.get_journal_filename(run_index)
+    return [os.path.basename(filename) for filename in [journal, journal + run_journal.ROTATED_SUFFIX]
+            if os.path.exists(filename)]
+
+
+@pytest.mark.parametrize("name, records, partial", SEQUENCES, ids=[sequence[0] for sequence in SEQUENCES])
+def test_views_agree(run_index, name, records, partial):
+
+    run_journal.append_records(run_index, records)
+    if partial:
+        append_partial(run_index, partial)
+    assert awk_view(run_index) == python_view(run_index)
+
+
+def test_view_rules(run_index):
+
+    for name, records, partial in SEQUENCES[:4]:
+        run_journal.append_records(run_index, records)
+        if partial:
+            append_partial(run_index, partial + "\n")
+    view = python_view(run_index)
+    # The first final state is kept, and the partial line is applied once complete
+    assert "# {job}\tdone".format(job=JOBS[0]) in view
+    assert "# {job}\tERROR".format(job=JOBS[1]) in view
+    assert "# {job}\tdone".format(job=JOBS[2]) in view
+
+
+@pytest.mark.parametrize("compact", ["python", "awk"])
+def test_compaction_rotates_journal(run_index, compact):
+    """ Compacting by either implementation gives the same views, rotates the journal and removes the rotated journal
+        on the next compaction
+    """
+
+    def do_compact():
+        if compact == "python":
+            run_journal.compact(run_index)
+        else:
+            helper(run_index, "compact_run_index")
+
+    run_journal.append_records(run_index, SEQUENCES[0][1][:2])
+    do_compact()
+    assert journal_files(run_index) == ["run_index.txt.journal.1"]
+    # Records appended after the rotation by a job which opened the journal before it are applied
+    append_partial(run_index, "{job}\trunning\t101\n".format(job=JOBS[0]), rotated=True)
+    run_journal.append_records(run_index, SEQUENCES[1][1][:2])
+    append_partial(run_index, "{job}\tdo".format(job=JOBS[1]))
+    assert awk_view(run_index) == python_view(run_index)
+    assert "{job}\trunning\t101".format(job=JOBS[0]) in python_view(run_index)
+
+    do_compact()
+    assert journal_files(run_index) == ["run_index.txt.journal.1"]
+    # The partial record is left in the rotated journal, and applied when complete
+    append_partial(run_index, "ne\n", rotated=True)
+    run_journal.append_records(run_index, SEQUENCES[0][1][3:])
+    assert awk_view(run_index) == python_view(run_index)
+
+    do_compact()
+    view = python_view(run_index)
+    assert "# {job}\tdone".format(job=JOBS[0]) in view
+    assert "# {job}\tdone".format(job=JOBS[1]) in view
+    with open(run_index) as run_index_fh:
+        assert run_index_fh.read().rstrip("\n").split("\n") == view
+    # Nothing was added since the last compaction, so the journal is gone once the rotated journal is removed
+    do_compact()
+    assert journal_files(run_index) == []
+    assert awk_view(run_index) == python_view(run_index) == view
@@ -0,0 +1,94 @@
+""" Tests of the interpolation of the variables in the Vars section (see neatseq_flow/modules/var_interpol_defs.py)
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import pytest
+
+from neatseq_flow.modules.var_interpol_defs import VarsTable, make_interpol_func, walk, test_vars as check_vars
+
+
+VARIABLES = {"root": "/opt",
+             "paths": {"bin": "{Vars.root}/bin",
+                       "blast": "{Vars.paths.bin}/blastp"},
+             "nodes": ["node1", "node2"],
+             "opts": {"evalue": 0.001, "outfmt": 6},
+             "threads": 4}
+
+
+def interpolate(params, variables=VARIABLES):
+    """ Returns params with the variables interpolated, as done by get_param_data_YAML()
+    """
+    return walk(node=params, callback=make_interpol_func(variables))
+
+
+def test_nested_references():
+
+    assert interpolate({"script_path": "{Vars.paths.blast} -h"}) == {"script_path": "/opt/bin/blastp -h"}
+    assert interpolate({"redirects": {"-num_threads": "{Vars.threads}"}}) == {"redirects": {"-num_threads": "4"}}
+
+
+def test_unrecognised_variable():
+
+    with pytest.raises(Exception, match="Unrecognised variable 'Vars.paths.missing'"):
+        interpolate({"script_path": "{Vars.paths.missing}"})
+
+
+def test_circular_reference():
+
+    variables = {"a": "{Vars.b}/x", "b": "{Vars.c.d}", "c": {"d": "{Vars.a}"}}
+    with pytest.raises(Exception, match="Circular reference in variables: Vars.a -> Vars.b -> Vars.c.d -> Vars.a"):
+        interpolate({"script_path": "{Vars.a}"}, variables)
+
+
+def test_list_indexing():
+
+    assert interpolate({"node": "{Vars.nodes.0}", "path": "/data/{Vars.nodes.1}"}) == {"node": "node1",
+                                                                                      "path": "/data/node2"}
+
+
+def test_list_used_whole():
+
+    assert interpolate({"qsub_params": {"node": "{Vars.nodes}"}}) == {"qsub_params": {"node": ["node1", "node2"]}}
+
+
+def test_dict_used_whole():
+
+    params = interpolate({"first": {"redirects": "{Vars.opts}"},
+                          "second": {"redirects": "{Vars.opts}"}})
+    assert params["first"]["redirects"] == {"evalue": 0.001, "outfmt": 6}
+    # Each reference is a separate copy
+    params["first"]["redirects"]["outfmt"] = 5
+    assert params["second"]["redirects"]["outfmt"] == 6
+
+
+def test_unquoted_dict_reference():
+    """ {Vars.opts} without quotes is parsed by YAML as a dict with a single key and no value
+    """
+
+    assert interpolate({"redirects": {"Vars.opts": None}}) == {"redirects": {"evalue": 0.001, "outfmt": 6}}
+
+
+@pytest.mark.parametrize("reference", ["{Vars.opts}", "{Vars.nodes}"])
+def test_dict_or_list_in_string(reference):
+
+    with pytest.raises(Exception, match="can only be used on its own, not as part of a string"):
+        interpolate({"script_path": "blastp " + reference})
+
+
+def test_each_variable_resolved_once():
+
+    table = VarsTable(VARIABLES)
+    assert table.interpolate("{Vars.paths.blast}") == "/opt/bin/blastp"
+    assert table.resolved["Vars.paths.bin"] == "/opt/bin"
+
+
+def test_check_variables():
+
+    warnings = []
+    check_vars({"nodes": ["node1", None], "empty": None}, warnings)
+    assert warnings == ["ATTENTION: It seems you have an empty variable! (empty)\n"]
+    with pytest.raises(Exception, match="alphanumeric"):
+        check_vars({"bad-name": "x"}, [])
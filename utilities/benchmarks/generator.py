@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+
+""" Scaling benchmark for the workflow generator
+
+Synthesizes a sample file, a grouping file and a parameter file for each combination of sample count, step count and
+workflow shape, and builds the workflow with bin/neatseq_flow.py --profile for each executor. For every build, reports
+the time taken by the generator (excluding Python startup), its peak RSS and the number of files it wrote.
+
+Workflow shapes (all steps after the first 'merge' step are fastqc_html steps):
+    chain       Each step is based on the previous step
+    fanout      All steps are based on the merge step
+    diamond     Repeated diamonds: two steps based on the previous join step, and a join step based on both
+    manybases   Each step is based on up to --bases previous steps
+
+For each shape and executor, the time is compared between consecutive sizes (samples x steps). The scaling exponent,
+log(time ratio) / log(size ratio), is reported, and builds whose exponent is above --max_exponent are marked as
+superlinear.
+
+Usage:
+    python utilities/benchmarks/generator.py [-n 50 200] [-t 10 40] [--shapes chain fanout diamond manybases]
+                                             [-e Local SGE SLURM] [-j 1] [--json results.json] [--keep]
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import sys
+import math
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+
+PACKAGE_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+NEATSEQ_FLOW = os.path.join(PACKAGE_DIR, "bin", "neatseq_flow.py")
+SHAPES = ["chain", "fanout", "diamond", "manybases"]
+EXECUTORS = ["Local", "SGE", "SLURM"]
+# Levels of the categories in the grouping file
+GROUP_LEVELS = 10
+BATCH_LEVELS = 4
+
+
+def write_sample_file(filename, num_samples):
+
+    with open(filename, "w") as file_fh:
+        file_fh.write("Title\tGenerator_benchmark\n\n")
+        file_fh.write("#Type\tPath\nNucleotide\t/path/to/reference.fasta\n\n")
+        file_fh.write("#SampleID\tType\tPath\n")
+        for ind in range(num_samples):
+            for direction, suffix in [("Forward", "R1"), ("Reverse", "R2")]:
+                file_fh.write("Sample{ind}\t{direction}\t/path/to/Sample{ind}_{suffix}.fastq.gz\n".
+                              format(ind=ind, direction=direction, suffix=suffix))
+
+
+def write_grouping_file(filename, num_samples):
+
+    with open(filename, "w") as file_fh:
+        file_fh.write("#SampleID\tGroup\tBatch\n")
+        for ind in range(num_samples):
+            file_fh.write("Sample{ind}\tG{group}\tB{batch}\n".format(ind=ind,
+                                                                     group=ind % GROUP_LEVELS,
+                                                                     batch=ind % BATCH_LEVELS))
+
+
+def get_step_bases(shape, num_steps, num_bases):
+    """ Returns a list of (step name, list of base names) for the steps after the merge step
+    """
+
+    steps = list()
+    if shape == "diamond":
+        top = "Merge"
+        while len(steps) < num_steps - 1:
+            ind = len(steps) // 3
+            branches = ["Left%d" % ind, "Right%d" % ind]
+            steps += [(branch, [top]) for branch in branches] + [("Join%d" % ind, branches)]
+            top = "Join%d" % ind
+        return steps[:num_steps - 1]
+
+    names = ["Merge"] + ["Step%d" % ind for ind in range(1, num_steps)]
+    for ind in range(1, num_steps):
+        if shape == "chain":
+            bases = [names[ind - 1]]
+        elif shape == "fanout":
+            bases = ["Merge"]
+        elif shape == "manybases":
+            bases = names[max(0, ind - num_bases):ind]
+        else:
+            raise Exception("Unknown shape %s" % shape)
+        steps.append((names[ind], bases))
+    return steps
+
+
+def write_param_file(filename, executor, shape, num_steps, num_bases):
+
+    with open(filename, "w") as file_fh:
+        file_fh.write("Global_params:\n"
+                      "    Default_wait: 10\n"
+                      "    Qsub_q: bench.q\n"
+                      "    Executor: {executor}\n"
+                      "Step_params:\n"
+                      "    Merge:\n"
+                      "        module: merge\n"
+                      "        script_path:\n".format(executor=executor))
+        for ind, (name, bases) in enumerate(get_step_bases(shape, num_steps, num_bases)):
+            file_fh.write("    {name}:\n"
+                          "        module: fastqc_html\n"
+                          "        base: [{bases}]\n"
+                          "        script_path: fastqc\n"
+                          "        qsub_params:\n"
+                          "            -pe: shared 4\n"
+                          "        redirects:\n"
+                          "            --threads: 4\n".format(name=name, bases=", ".join(bases)))
+            # Some steps work on a subset of the samples
+            if ind % 5 == 4:
+                file_fh.write("        sample_list:\n"
+                              "            category: Group\n"
+                              "            levels: G0\n")
+
+
+def count_files(dirname):
+
+    return sum(len(files) for root, dirs, files in os.walk(dirname))
+
+
+def run_generator(work_dir, sample_file, grouping_file, param_file, build_jobs):
+    """ Builds the workflow in work_dir and returns the generator's profile report and the number of files written
+    """
+
+    os.makedirs(work_dir)
+    proc = subprocess.run([sys.executable, NEATSEQ_FLOW,
+                           "-s", sample_file,
+                           "-g", grouping_file,
+                           "-p", param_file,
+                           "-r", "bench",
+                           "-j", str(build_jobs),
+                           "--profile"],
+                          cwd=work_dir,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,
+                          universal_newlines=True)
+    profile_file = os.path.join(work_dir, "objects", "profile.json")
+    if proc.returncode != 0 or not os.path.isfile(profile_file):
+        sys.exit("Building {param_file} failed:\n{output}".format(param_file=param_file, output=proc.stdout))
+    with open(profile_file) as profile_fh:
+        profile = json.load(profile_fh)
+
+    return profile, count_files(work_dir)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Measure how the workflow generator scales")
+    parser.add_argument("-n", "--samples", type=int, nargs="+", default=[50, 200], help="Sample counts")
+    parser.add_argument("-t", "--steps", type=int, nargs="+", default=[10, 40], help="Step counts")
+    parser.add_argument("--shapes", nargs="+", default=SHAPES, choices=SHAPES, help="Workflow shapes")
+    parser.add_argument("-e", "--executors", nargs="+", default=EXECUTORS, choices=EXECUTORS, help="Executors")
+    parser.add_argument("--bases", type=int, default=10, help="Number of bases of each step in 'manybases'")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of steps to build in parallel (see -j in "
+                                                                  "neatseq_flow.py)")
+    parser.add_argument("--max_exponent", type=float, default=1.25,
+                        help="Scaling exponent above which a build is marked as superlinear")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="Do not remove the benchmark dir")
+    args = parser.parse_args()
+
+    sizes = sorted(set((num_samples, num_steps) for num_samples in args.samples for num_steps in args.steps),
+                   key=lambda size: (size[0] * size[1], size))
+    bench_dir = tempfile.mkdtemp(prefix="nsf_generator_")
+    results = list()
+    superlinear = 0
+    try:
+        print("shape\texecutor\tsamples\tsteps\tseconds\tpeak_rss_MB\tfiles\texponent")
+        for shape in args.shapes:
+            for executor in args.executors:
+                previous = None
+                for num_samples, num_steps in sizes:
+                    name = "{shape}_{executor}_{samples}_{steps}".format(shape=shape, executor=executor,
+                                                                         samples=num_samples, steps=num_steps)
+                    sample_file = os.path.join(bench_dir, "samples_%d.nsfs" % num_samples)
+                    grouping_file = os.path.join(bench_dir, "grouping_%d.txt" % num_samples)
+                    if not os.path.isfile(sample_file):
+                        write_sample_file(sample_file, num_samples)
+                        write_grouping_file(grouping_file, num_samples)
+                    param_file = os.path.join(bench_dir, name + ".yaml")
+                    write_param_file(param_file, executor, shape, num_steps, args.bases)
+
+                    profile, num_files = run_generator(os.path.join(bench_dir, name),
+                                                       sample_file, grouping_file, param_file, args.jobs)
+                    result = {"shape": shape,
+                              "executor": executor,
+                              "samples": num_samples,
+                              "steps": num_steps,
+                              "seconds": profile["total"]["wall"],
+                              "cpu_seconds": profile["total"]["cpu"],
+                              "peak_rss": profile["total"]["peak_rss"],
+                              "files": num_files,
+                              "phases": {phase["phase"]: phase["wall"] for phase in profile["phases"]},
+                              "exponent": None}
+                    # Compared with the previous size, if the size and the time both grew
+                    if previous is not None and previous["seconds"] > 0 and \
+                            num_samples * num_steps > previous["samples"] * previous["steps"]:
+                        result["exponent"] = math.log(result["seconds"] / previous["seconds"]) / \
+                                             math.log(float(num_samples * num_steps) /
+                                                      (previous["samples"] * previous["steps"]))
+                    results.append(result)
+                    previous = result
+
+                    flag = ""
+                    if result["exponent"] is not None and result["exponent"] > args.max_exponent:
+                        flag = "\tSUPERLINEAR"
+                        superlinear += 1
+                    print("\t".join([shape,
+                                     executor,
+                                     str(num_samples),
+                                     str(num_steps),
+                                     "%.2f" % result["seconds"],
+                                     "%.1f" % (result["peak_rss"] / 1024.0) if result["peak_rss"] else "-",
+                                     str(num_files),
+                                     "%.2f" % result["exponent"] if result["exponent"] is not None else "-"]) + flag)
+                    sys.stdout.flush()
+    finally:
+        if args.keep:
+            print("Benchmark dir: %s" % bench_dir)
+        else:
+            shutil.rmtree(bench_dir)
+
+    if args.json:
+        with open(args.json, "w") as json_fh:
+            json.dump({"version": __version__,
+                       "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "jobs": args.jobs,
+                       "results": results},
+                      json_fh,
+                      indent=1)
+    if superlinear:
+        print("{num} builds scaled superlinearly (exponent above {max})".format(num=superlinear,
+                                                                                max=args.max_exponent))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+
+""" Benchmark for sample file parsing
+
+Writes a tabular sample file with a large number of samples (100,000 by default), each with a Forward and a Reverse
+file, both uncompressed and gzip-compressed, and reports the time taken to parse each of them with
+parse_sample_file(). Also checks that both files are parsed to the same sample data.
+
+Usage:
+    python utilities/benchmarks/sample_parsing.py [-n 100000] [-r 3]
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import sys
+import gzip
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")))
+from neatseq_flow.modules.parse_sample_data import parse_sample_file
+
+
+def write_sample_file(file_fh, num_samples):
+
+    file_fh.write("Title\tSample_parsing_benchmark\n\n")
+    file_fh.write("#Type\tPath\nNucleotide\t/path/to/reference.fasta\n\n")
+    file_fh.write("#SampleID\tType\tPath\n")
+    for ind in range(num_samples):
+        for direction, suffix in [("Forward", "R1"), ("Reverse", "R2")]:
+            file_fh.write("Sample{ind}\t{direction}\t/path/to/Sample{ind}_{suffix}.fastq.gz\n".
+                          format(ind=ind, direction=direction, suffix=suffix))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark sample file parsing")
+    parser.add_argument("-n", "--samples", type=int, default=100000, help="Number of samples in the sample file")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Number of times to parse each file")
+    args = parser.parse_args()
+
+    bench_dir = tempfile.mkdtemp(prefix="nsf_bench_")
+    try:
+        sample_file = os.path.join(bench_dir, "samples.nsfs")
+        with open(sample_file, "w") as file_fh:
+            write_sample_file(file_fh, args.samples)
+        with open(sample_file, "rb") as in_fh, gzip.open(sample_file + ".gz", "wb") as out_fh:
+            shutil.copyfileobj(in_fh, out_fh)
+
+        print("file\tsamples\tseconds\tusec/sample")
+        results = dict()
+        for filename in [sample_file, sample_file + ".gz"]:
+            times = list()
+            for repeat in range(args.repeats):
+                start_time = time.time()
+                results[filename] = parse_sample_file(filename)
+                times.append(time.time() - start_time)
+            if len(results[filename]["samples"]) != args.samples:
+                sys.exit("Expected {expected} samples in {file}. Found {found}".
+                         format(expected=args.samples, file=filename, found=len(results[filename]["samples"])))
+            print("{file}\t{samples}\t{seconds:.2f}\t{usec:.1f}".format(file=os.path.basename(filename),
+                                                                       samples=args.samples,
+                                                                       seconds=min(times),
+                                                                       usec=1e6 * min(times) / args.samples))
+        if results[sample_file] != results[sample_file + ".gz"]:
+            sys.exit("Sample data parsed from the compressed and uncompressed files differ")
+    finally:
+        shutil.rmtree(bench_dir)
+
+
+if __name__ == "__main__":
+    main()
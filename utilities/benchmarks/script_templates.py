@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+
+""" Micro-benchmark for low level script construction
+
+Emits a large number of low level scripts (100,000 by default) with the LowScriptConstructor of each executor, with and
+without the compiled script templates (see LowScriptConstructor.get_script_template()), and reports the time per
+script. Also checks that both ways produce identical scripts.
+
+Usage:
+    python utilities/benchmarks/script_templates.py [-n 100000] [-e Local SGE SLURM] [--in-memory]
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import importlib
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")))
+from neatseq_flow.script_constructors import scriptconstructor
+
+
+class BenchmarkStep(object):
+    """ The attributes of a step required by LowScriptConstructor
+    """
+
+    def __init__(self, pipe_data, samples):
+
+        self.step = "bench"
+        self.name = "bench_step"
+        self.step_number = "01"
+        self.shell = "bash"
+        self.jid_name_sep = ".."
+        self.base_dir = pipe_data["data_dir"]
+        self.pipe_data = pipe_data
+        self.params = {"qsub_params": {"queue": "bench.q",
+                                       "node": None,
+                                       "opts": {"-pe": "shared 4"}},
+                       "kill_script_path": os.path.join(pipe_data["scripts_dir"], "99.kill_all_bench_step.sh")}
+        # Compiled templates. Reset before each run
+        self.script_templates = dict()
+        self.dependency_jid_list = ["base..base_step..%s..%s" % (sample, pipe_data["run_code"])
+                                    for sample in samples[:10]]
+        self.dependency_glob_jid_list = ["base..base_step..*%s" % pipe_data["run_code"]]
+
+    def set_sample(self, sample):
+        """ Sets the per-script attributes, as done by the step before creating a low level script
+        """
+
+        self.spec_script_name = self.jid_name_sep.join([self.step, self.name, sample])
+        self.script = "cd {dir}\nbench_command --in {dir}{sample}.fq --out {dir}{sample}.out\n\n".\
+            format(dir=self.base_dir, sample=sample)
+        self.stamped_files = ["{dir}{sample}.out".format(dir=self.base_dir, sample=sample)]
+
+
+def get_pipe_data(executor, home_dir):
+
+    pipe_data = {"Executor": executor,
+                 "run_code": "20200101000000",
+                 "verbose": False,
+                 "Default_wait": 10,
+                 "job_limit": os.path.join(home_dir, "job_limit.txt"),
+                 "qsub_params": {"qstat_path": "/usr/bin/qstat"}}
+    for name in ["scripts_dir", "stderr_dir", "stdout_dir", "data_dir"]:
+        pipe_data[name] = os.path.join(home_dir, name) + os.sep
+        os.makedirs(pipe_data[name])
+    for name in ["run_index", "script_index", "dependency_index", "log_file", "registration_file", "helper_funcs",
+                 "exec_script", "depends_script_name"]:
+        pipe_data[name] = os.path.join(home_dir, name + ".txt")
+    os.makedirs(os.path.join(pipe_data["scripts_dir"], "01.bench_bench_step"))
+
+    return pipe_data
+
+
+def emit_scripts(script_class, master, samples, use_template):
+    """ Creates a script for each sample. Returns the time taken
+    """
+
+    script_class.use_script_template = use_template
+    master.script_templates = dict()
+    start_time = time.time()
+    try:
+        for sample in samples:
+            master.set_sample(sample)
+            script_obj = script_class(master=master)
+            script_obj.write_script()
+            script_obj.__del__()
+    finally:
+        del script_class.use_script_template
+
+    return time.time() - start_time
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark low level script construction")
+    parser.add_argument("-n", "--scripts", type=int, default=100000, help="Number of scripts per executor")
+    parser.add_argument("-e", "--executors", nargs="+", default=["Local", "SGE", "SLURM"],
+                        help="Executors to benchmark")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="Write scripts to memory instead of to files (measures script construction only)")
+    args = parser.parse_args()
+
+    if args.in_memory:
+        # The constructors open their files by name. Replacing open() in the constructors' modules
+        scripts_written = dict()
+
+        class MemoryFile(io.StringIO):
+            def __init__(self, path, mode="w"):
+                super(MemoryFile, self).__init__()
+                self.path = path
+
+            def close(self):
+                if not self.closed:
+                    scripts_written[self.path] = self.getvalue()
+                super(MemoryFile, self).close()
+
+    samples = ["Sample%d" % ind for ind in range(args.scripts)]
+    # Scripts include the paths of the run files. Using the same directory for all runs, so they can be compared
+    bench_dir = tempfile.mkdtemp(prefix="nsf_bench_")
+    home_dir = os.path.join(bench_dir, "run")
+    print("executor\ttemplate\tscripts\tseconds\tusec/script")
+    for executor in args.executors:
+        module = importlib.import_module("neatseq_flow.script_constructors.scriptconstructor" + executor)
+        script_class = getattr(module, "LowScriptConstructor" + executor)
+        results = dict()
+        for use_template in [False, True]:
+            try:
+                master = BenchmarkStep(get_pipe_data(executor, home_dir), samples)
+                if args.in_memory:
+                    scripts_written.clear()
+                    for constructor_module in [module, scriptconstructor]:
+                        constructor_module.open = MemoryFile
+                try:
+                    seconds = emit_scripts(script_class, master, samples, use_template)
+                finally:
+                    for constructor_module in [module, scriptconstructor]:
+                        constructor_module.__dict__.pop("open", None)
+                # Comparing the last script
+                script_path = os.path.join(master.pipe_data["scripts_dir"], "01.bench_bench_step",
+                                           "01.bench_bench_step_%s.sh" % samples[-1])
+                if args.in_memory:
+                    results[use_template] = scripts_written[script_path]
+                else:
+                    with open(script_path) as script_fh:
+                        results[use_template] = script_fh.read()
+            finally:
+                shutil.rmtree(home_dir)
+            print("{executor}\t{template}\t{scripts}\t{seconds:.2f}\t{usec:.1f}".format(
+                executor=executor,
+                template="yes" if use_template else "no",
+                scripts=len(samples),
+                seconds=seconds,
+                usec=1e6 * seconds / len(samples)))
+        if results[False] != results[True]:
+            shutil.rmtree(bench_dir)
+            sys.exit("Scripts created with and without templates differ for executor %s" % executor)
+    shutil.rmtree(bench_dir)
+
+
+if __name__ == "__main__":
+    main()
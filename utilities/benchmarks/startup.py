@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+
+""" Cold-start timing for bin/neatseq_flow.py
+
+Runs the NeatSeq-Flow command line in a new Python process for each of the common invocations (--version, --help,
+--list_modules and building a workflow) and reports the wall time of each, in milliseconds. Each invocation is run
+several times (5 by default) and the minimum and median are reported.
+With --importtime, the slowest imports of each invocation are listed as well (using python -X importtime).
+
+--list_modules and building are timed only if a sample file and a parameter file are passed with -s and -p. The workflow
+is built in a temporary directory.
+
+Usage:
+    python utilities/benchmarks/startup.py [-n 5] [-s sample_file -p param_file] [--importtime 10]
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+
+PACKAGE_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+NEATSEQ_FLOW = os.path.join(PACKAGE_DIR, "bin", "neatseq_flow.py")
+
+
+def run_cli(cli_args, cwd, python_args=None):
+    """ Runs neatseq_flow.py with cli_args in a new process. Returns the wall time and the process's stderr
+    """
+
+    start_time = time.time()
+    proc = subprocess.run([sys.executable] + (python_args or []) + [NEATSEQ_FLOW] + cli_args,
+                          cwd=cwd,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    elapsed = time.time() - start_time
+    if proc.returncode != 0:
+        sys.exit("Command failed: neatseq_flow.py {args}\n{stderr}".format(args=" ".join(cli_args),
+                                                                           stderr=proc.stderr))
+    return elapsed, proc.stderr
+
+
+def get_slowest_imports(importtime_output, num):
+    """ Returns the num imports with the highest cumulative time in the output of python -X importtime, as a list of
+        (module, cumulative usec). Only top level imports are included, since their times include their sub-imports.
+    """
+
+    imports = list()
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if fields[0].strip() == "self [us]":
+            continue
+        module = fields[2].rstrip()
+        # Top level imports are indented by one space
+        if module.startswith("  "):
+            continue
+        imports.append((module.strip(), int(fields[1])))
+
+    return sorted(imports, key=lambda item: -item[1])[:num]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Measure the cold-start time of neatseq_flow.py")
+    parser.add_argument("-n", "--repeats", type=int, default=5, help="Number of runs of each invocation")
+    parser.add_argument("-s", "--sample_file", help="Sample file for --list_modules and build")
+    parser.add_argument("-p", "--param_file", help="Parameter file for --list_modules and build")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N",
+                        help="List the N slowest top level imports of each invocation")
+    args = parser.parse_args()
+
+    invocations = [("version", ["--version"]),
+                   ("help", ["--help"])]
+    if args.sample_file and args.param_file:
+        files_args = ["-s", os.path.realpath(args.sample_file), "-p", os.path.realpath(args.param_file)]
+        invocations += [("list_modules", files_args + ["--list_modules"]),
+                        ("build", files_args + ["-r", "startup"])]
+
+    work_dir = tempfile.mkdtemp(prefix="nsf_startup_")
+    try:
+        print("invocation\truns\tmin_ms\tmedian_ms")
+        for name, cli_args in invocations:
+            times = list()
+            for repeat in range(args.repeats):
+                times.append(run_cli(cli_args, work_dir)[0])
+            times.sort()
+            print("{name}\t{runs}\t{min:.0f}\t{median:.0f}".format(name=name,
+                                                                 runs=len(times),
+                                                                 min=1000 * times[0],
+                                                                 median=1000 * times[len(times) // 2]))
+            if args.importtime:
+                stderr = run_cli(cli_args, work_dir, python_args=["-X", "importtime"])[1]
+                for module, usec in get_slowest_imports(stderr, args.importtime):
+                    print("\t{module}\t{ms:.1f} ms".format(module=module, ms=usec / 1000.0))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()